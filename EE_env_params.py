@@ -15,8 +15,13 @@ Create buffer around each animal data point for more accurate env. cond
 ###Imports
 import ee
 import pandas
+from stage_timing import RunLog
+from ee_cache import ReductionCache, reduction_key, geometry_hash
 ee.Initialize()
 
+## Timing of each Earth Engine request, written to Data/runs at the end
+run = RunLog('EE_env_params')
+
 
 ######### Functions #############
 def imageParams(image, shapefile):
@@ -36,16 +41,24 @@ def imageParams(image, shapefile):
     
 
 
-def getYearlyParams(collection, shapefile, startYear, endYear, first=True):
+def getYearlyParams(collection, shapefile, startYear, endYear, first=True, cache=None, collectionId=None, bands=None):
     """
     Gets the selected yearly parameters as a dataframe for an image collection.
+    With a ReductionCache, months already reduced over the same regions are read from disk
+    (collectionId and bands name the collection in the cache key; see ee_cache.py).
     """
     yearlyParams=pandas.DataFrame(columns=['ADM2_EN'])
+    regions=geometry_hash(shapefile) if cache is not None else None
     for year in range(startYear, endYear+1):
-        print(year)
         for month in range(1, 13):
-            print(month, end=' ')
-            if(first):
+            #Cached months skip both the filtering and the round trip
+            params=None
+            if cache is not None:
+                key=reduction_key(collectionId or collection, str(year)+'-'+str(month).zfill(2), ('first' if first else 'mean')+'/mean', 'native', bands, regions)
+                params=cache.get(key)
+            if params is not None:
+                cache.hits+=1
+            elif(first):
                 image=collection.filter(ee.Filter.calendarRange(year,year,'year')).filter(ee.Filter.calendarRange(month, month,'month'))\
                 .first()
             else:
@@ -53,11 +66,21 @@ def getYearlyParams(collection, shapefile, startYear, endYear, first=True):
                 .mean()
                 
             
-            yearlyParams=yearlyParams.merge(imageParams(image, shapefile),\
-                                            how='outer',\
-                                            on='ADM2_EN',\
-                                            suffixes=('', '_'+str(year)+str(month).zfill(2)))
-    print("done")
+            if params is None:
+                #Each getInfo is a round trip to Earth Engine, so it is timed as its own stage
+                with run.stage('ee_getInfo', year=year, month=month) as st:
+                    params=imageParams(image, shapefile)
+                    st.rows_out(params)
+                if cache is not None:
+                    cache.misses+=1
+                    cache.put(key, params)
+
+            with run.stage('ee_merge', yearlyParams, year=year, month=month) as st:
+                yearlyParams=yearlyParams.merge(params,\
+                                                how='outer',\
+                                                on='ADM2_EN',\
+                                                suffixes=('', '_'+str(year)+str(month).zfill(2)))
+                st.rows_out(yearlyParams)
     return yearlyParams
 
 
@@ -72,12 +95,22 @@ ndvi2=ee.ImageCollection("MODIS/006/MOD13A2").select('NDVI')
 moWeather = ee.ImageCollection("ECMWF/ERA5/MONTHLY").select("mean_2m_air_temperature","total_precipitation") #Loads the ERA5 monthly collection
 
 
+#Reductions already fetched are read from Data/cache/ee instead of Earth Engine
+cache=ReductionCache()
+
 start=2008
 end=2008
-weatherParams=getYearlyParams(moWeather, iran, start, end)
-ndviParams=getYearlyParams(ndvi, iran, start, end, False)
-elevParams=imageParams(dem, iran)
+weatherParams=getYearlyParams(moWeather, iran, start, end, cache=cache, collectionId="ECMWF/ERA5/MONTHLY",
+                              bands=["mean_2m_air_temperature","total_precipitation"])
+ndviParams=getYearlyParams(ndvi, iran, start, end, False, cache=cache, collectionId="NOAA/CDR/AVHRR/NDVI/V5", bands=["NDVI"])
+with run.stage('ee_getInfo', image='dem'):
+    elevParams=cache.get_or_compute(reduction_key("JAXA/ALOS/AW3D30/V2_2", None, 'mean', 'native', ['AVE_DSM'], geometry_hash(iran)),
+                                    lambda: imageParams(dem, iran))
 
 allParams=weatherParams.merge(ndviParams, on='ADM2_EN').merge(elevParams, on='ADM2_EN')
 #Writing data to a .csv file
 #allParams.to_csv(r'allParams.csv', index=False)
+
+print(run.summary())
+print('EE cache: '+str(cache.hits)+' hits, '+str(cache.misses)+' misses')
+run.write()
@@ -52,6 +52,10 @@ import geopandas as gpd
 import numpy as np
 import Levenshtein as leven
 
+from stage_timing import RunLog
+from lazy_joins import join
+from animal_aggregation import aggregate_animal, check_totals
+
 
 # In[2]:
 
@@ -59,6 +63,12 @@ import Levenshtein as leven
 ## File path
 fp = os.getcwd()
 
+## Join backend: 'pandas', or 'polars' to run the joins lazily (see lazy_joins.py)
+backend = 'pandas'
+
+## Per-stage timings and memory, written to Data/runs at the end
+run = RunLog('Tanner_regression', out_dir = os.path.join(fp, 'Data', 'runs'))
+
 ## Read animal data and update columns
 animal_data = pd.read_csv(os.path.join(fp, 'Data','animal_vac_data.csv'))
 animal_data.columns = ['id', 'unitCode', 'unitType', 'province',
@@ -482,16 +492,13 @@ match_dict_ani.update(match_dict_man_ani)
 perf_matches = np.intersect1d(iran_data['county_en'], animal_data['county'])
 match_dict_ani.update(dict(zip(perf_matches, perf_matches)))
 
-## Update county names in animal data and do the join
+## Update county names in animal data
 animal_data['county'] = animal_data['county'].map(match_dict_ani).fillna(animal_data['county'])
-ani_sp_data = pd.merge(animal_data, iran_data, how = 'outer', left_on = 'county', right_on = 'county_en')
-
-## Sum infection data grouped by county, year, and month and remerge on animal data
-ani_sp_data_grp = ani_sp_data.groupby(['county', 'year', 'month'], as_index = False)[ani_sp_data.columns[10:15]].sum()
-ani_sp_data = pd.merge(ani_sp_data, ani_sp_data_grp, how = 'left')
 
-## Calculate infection rate
-ani_sp_data['animal_inf_rate'] = ani_sp_data['n_infected']/ani_sp_data['n_sample']
+## Sum test counts by county, year and month with the infection rate (animal_aggregation.py):
+## one row per county-month, instead of merging the sums back onto every record
+ani_cm_data = aggregate_animal(animal_data)
+check_totals(animal_data, ani_cm_data)
 
 ## Write mapping dictionary to csv for ease of QA
 # pd.DataFrame.from_dict(data=match_dict_ani, orient='index').to_csv(fp + '/animal_data_mappings.csv', index_label = ['animal_county'], header = ['shp_county'])
@@ -908,14 +915,22 @@ envData = pd.read_csv(envFP, index_col='ADM2_EN')
 
 ## Clean up human data, add date column
 human_sp_data.loc[pd.isna(human_sp_data['Outbreak_yr']), 'Outbreak_yr']='Null'
-addGregorian(human_sp_data, 'Outbreak_yr', 'Outbreak_mth')
+with run.stage('addGregorian', human_sp_data) as st:
+    addGregorian(human_sp_data, 'Outbreak_yr', 'Outbreak_mth')
+    st.rows_out(human_sp_data)
 
-## Clean up animal data
-ani_sp_data.rename(columns={"county": "County"}, inplace=True)
+## Clean up animal data: addEnvData looks up two digit years and months as strings
+ani_cm_data = ani_cm_data.rename(columns={"county": "County"})
+ani_cm_data['year'] = (ani_cm_data['year'] % 100).astype(str).str.zfill(2)
+ani_cm_data['month'] = ani_cm_data['month'].astype(str)
 
 ## Adding environmental data to both dataframes
-addEnvData(ani_sp_data, envData, 'year', 'month')
-addEnvData(human_sp_data, envData, 'year', 'month')
+with run.stage('addEnvData', ani_cm_data, table='animal') as st:
+    addEnvData(ani_cm_data, envData, 'year', 'month')
+    st.rows_out(ani_cm_data)
+with run.stage('addEnvData', human_sp_data, table='human') as st:
+    addEnvData(human_sp_data, envData, 'year', 'month')
+    st.rows_out(human_sp_data)
 
 
 # # The Future Steps
@@ -956,8 +971,8 @@ def regress(df, attribute, labels):
         r2=metrics.r2_score(y_test, y_pred)
         
         #add to the storage lists
-        intercepts.append(float(intercept))
-        coefs.append(float(coef))
+        intercepts.append(intercept.item())
+        coefs.append(coef.item())
         rmses.append(float(rmse))
         r2s.append(float(r2))
         
@@ -988,7 +1003,7 @@ def mvRegress(df, attribute, labels):
     rmse=np.sqrt(metrics.mean_squared_error(y_test, y_pred))
     r2=metrics.r2_score(y_test, y_pred)
     
-    print('Intercept: ', float(reg.intercept_))
+    print('Intercept: ', reg.intercept_.item())
     print('RMSE: ', rmse)
     print('R2: ', r2, '\n')
     
@@ -1003,14 +1018,21 @@ from sklearn.linear_model import LinearRegression
 from sklearn.model_selection import train_test_split 
 from sklearn import metrics 
 
-#Merging population/infection data with all other human data
-human_all=human_sp_data.merge(ag_data2, left_on='County', right_index=True)
+run.start('aggregation', human_sp_data)
+
+#Merging population/infection data with all other human data (ag_data2 is indexed by county)
+human_all=join(human_sp_data, ag_data2.rename_axis('County').reset_index(), 'County', how='inner', backend=backend)
 
 #Calculating incidence per 100,000
 human_all['Incidence']=pd.to_numeric(100000*human_all['bruc']/human_all['population'])
 
 #Summarizing data by county
 means=human_all.groupby(['County']).mean()
+run.stop(means)
+
+#Every regression fit is recorded as a stage
+regress=run.timed('regress')(regress)
+mvRegress=run.timed('mvRegress')(mvRegress)
 
 #Getting single variable regressions for the normal and summarized
 human_single=regress(human_all, 'Incidence', ['mean_ndvi', 'mean_2m_air_temperature', 'mean_total_precipitation', 'mean_elevation'])
@@ -1020,9 +1042,14 @@ human_mean_single=regress(means, 'Incidence', ['mean_ndvi', 'mean_2m_air_tempera
 human_multi=mvRegress(human_all, 'Incidence', ['mean_ndvi', 'mean_2m_air_temperature', 'mean_total_precipitation', 'mean_elevation'])
 human_mean_multi=mvRegress(means, 'Incidence', ['mean_ndvi', 'mean_2m_air_temperature', 'mean_total_precipitation', 'mean_elevation'])
 
-#####Animal data
-animal_single=regress(ani_sp_data, 'animal_inf_rate', ['mean_2m_air_temperature','mean_total_precipitation', 'mean_ndvi', 'mean_elevation'])
-animal_mean_single=regress(ani_sp_data.groupby(['County']).mean(), 'animal_inf_rate', ['mean_2m_air_temperature','mean_total_precipitation', 'mean_ndvi', 'mean_elevation'])
+#####Animal data (one row per county-month)
+ani_means=ani_cm_data.groupby(['County']).mean(numeric_only=True)
+
+animal_single=regress(ani_cm_data, 'animal_inf_rate', ['mean_2m_air_temperature','mean_total_precipitation', 'mean_ndvi', 'mean_elevation'])
+animal_mean_single=regress(ani_means, 'animal_inf_rate', ['mean_2m_air_temperature','mean_total_precipitation', 'mean_ndvi', 'mean_elevation'])
+
+animal_multi=mvRegress(ani_cm_data, 'animal_inf_rate', ['mean_2m_air_temperature','mean_total_precipitation', 'mean_ndvi', 'mean_elevation'])
+animal_mean_multi=mvRegress(ani_means, 'animal_inf_rate', ['mean_2m_air_temperature','mean_total_precipitation', 'mean_ndvi', 'mean_elevation'])
 
-animal_multi=mvRegress(ani_sp_data, 'animal_inf_rate', ['mean_2m_air_temperature','mean_total_precipitation', 'mean_ndvi', 'mean_elevation'])
-animal_mean_multi=mvRegress(ani_sp_data.groupby(['County']).mean(), 'animal_inf_rate', ['mean_2m_air_temperature','mean_total_precipitation', 'mean_ndvi', 'mean_elevation'])
+print(run.summary())
+run.write()
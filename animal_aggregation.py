@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+County-month animal test totals
+
+The cleaning scripts sum ani_sp_data.columns[10:15] per county/year/month and merge the
+sums back onto the record-level frame (and data_merge_withEnv.py divides by n_sample from
+a different frame), which repeats rows and can misalign the rates. aggregate_animal does
+the whole thing in one groupby over integer keys, on named columns, and returns one row per
+county-month (optionally per livestock type) with the totals and rates:
+
+    ani_cm = aggregate_animal(animal_data)
+    ani_cm_type = aggregate_animal(animal_data, by_type = True)
+
+The test counts always add up to the record totals (check_totals).
+"""
+
+import numpy as np
+import pandas as pd
+
+from county_month import month_key
+from streaming_ingest import ANIMAL_COUNTS
+
+
+######### Functions #############
+def _codes(values):
+    """
+    Integer codes and categories for a key column (missing values get -1).
+    """
+    codes, cats = pd.factorize(pd.Series(values), sort = True)
+    return codes.astype(np.int32), cats
+
+
+def rates(totals):
+    """
+    Infection and rejection rates per tested animal (NaN where nothing was sampled).
+    """
+    sampled = totals['n_sample'].where(totals['n_sample'] > 0)
+    totals['animal_inf_rate'] = totals['n_infected']/sampled
+    totals['animal_rej_rate'] = totals['n_rejected']/sampled
+    return totals
+
+
+def aggregate_animal(animal_data, county_col = 'county', year_col = 'year', month_col = 'month', by_type = False,
+                     type_col = 'livestock_type', counts = ANIMAL_COUNTS):
+    """
+    Sums the test counts per county and month (and livestock type with by_type = True) and adds
+    n_records, animal_inf_rate and animal_rej_rate. Records without a county or a valid date are
+    left out, as in the county-month arrays. Returns county, year, month, month_key, [livestock_type],
+    the counts and rates, one row per group.
+    """
+    key = month_key(animal_data[year_col], animal_data[month_col])
+    cty, counties = _codes(animal_data[county_col])
+    keep = (cty >= 0) & ~np.isnan(key)
+
+    keys = {'county_code': cty[keep], 'month_key': key[keep].astype(np.int32)}
+    if by_type:
+        typ, types = _codes(animal_data[type_col])
+        keys['type_code'] = typ[keep]
+
+    vals = animal_data.loc[keep, list(counts)].apply(pd.to_numeric, errors = 'coerce').fillna(0).reset_index(drop = True)
+    frame = pd.DataFrame(keys).join(vals)
+    frame['n_records'] = 1
+
+    totals = frame.groupby(list(keys), sort = True).sum().reset_index()
+
+    totals.insert(0, county_col, counties.take(totals['county_code']).values)
+    totals.insert(1, 'year', totals['month_key']//12)
+    totals.insert(2, 'month', totals['month_key']%12 + 1)
+    if by_type:
+        ## Records with no livestock type keep their own group
+        totals.insert(4, type_col, np.where(totals['type_code'] >= 0, types.take(totals['type_code'].clip(lower = 0)), None))
+        totals = totals.drop(columns = 'type_code')
+
+    return rates(totals.drop(columns = 'county_code'))
+
+
+def check_totals(animal_data, totals, county_col = 'county', year_col = 'year', month_col = 'month', counts = ANIMAL_COUNTS):
+    """
+    Checks that the aggregated counts add up to the counts of the records they came from, per
+    county and overall. Raises ValueError otherwise.
+    """
+    key = month_key(animal_data[year_col], animal_data[month_col])
+    keep = animal_data[county_col].notna().values & ~np.isnan(key)
+    records = animal_data.loc[keep, [county_col] + list(counts)]
+    records = records.assign(**{c: pd.to_numeric(records[c], errors = 'coerce').fillna(0) for c in counts})
+
+    source = records.groupby(county_col)[list(counts)].sum().sort_index()
+    agg = totals.groupby(county_col)[list(counts)].sum().reindex(source.index, fill_value = 0)
+    if len(totals[county_col].unique()) != len(source) or not np.allclose(source.values, agg.values):
+        raise ValueError('Aggregated counts differ from the records')
+    if totals['n_records'].sum() != keep.sum():
+        raise ValueError('Records lost in aggregation: {} of {}'.format(keep.sum() - totals['n_records'].sum(), keep.sum()))
+    return True
+
+
+#%%
+if __name__ == '__main__':
+
+    import synthetic_data as syn
+    from streaming_ingest import clean_animal
+
+    gaz = syn.gazetteer(429)
+    animal_data = clean_animal(syn.animal_tests(100000, gaz), {})
+
+    ani_cm = aggregate_animal(animal_data)
+    ani_cm_type = aggregate_animal(animal_data, by_type = True)
+    print(ani_cm.head())
+    print(ani_cm_type.head())
+
+    ## Totals are conserved at both levels, and the type-level totals add up to the county-month ones
+    check_totals(animal_data, ani_cm)
+    check_totals(animal_data, ani_cm_type)
+    rolled = ani_cm_type.groupby(['county', 'month_key'])[ANIMAL_COUNTS].sum().reset_index(drop = True)
+    assert np.allclose(rolled.values, ani_cm[ANIMAL_COUNTS].values)
+    print('Totals conserved')
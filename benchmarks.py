@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite
+
+Times the pipeline's main steps on synthetic inputs (synthetic_data.py) at multiples of the
+real data size, and keeps every result with the commit it was run on so slowdowns show up:
+
+    name_matching   match_names from place_names.py (used by data_merge2.py), noisy register spellings vs the gazetteer
+    joins           register-to-county outer merge, as in data_merge2.py
+    jalali          addGregorian (Tanner_regression.py) vs national_0911.jalali_to_gregorian
+    env_enrichment  addEnvData (Tanner_regression.py) on an env cube of scale x the counties
+    aggregation     county-month counts, groupby and county_month_array
+    moran           global and local Moran's I (moran_permutation.py) on a lattice of scale x the counties
+    regression      mvRegress (Tanner_regression.py)
+
+Functions that live in the cleaning/analysis scripts are compiled straight from the script
+files (script_functions), so the benchmark always times the code the scripts run.
+
+Usage:
+    python benchmarks.py                        ## scales 1 and 10, all benchmarks
+    python benchmarks.py --scale 1 10 100 --only jalali aggregation
+    python benchmarks.py --no-record            ## don't append to the history
+
+Results are appended to Data/runs/benchmarks.jsonl. Each run is compared with the latest
+result from a different commit and anything more than --tolerance times slower is reported
+(and makes the script exit with status 1, as does any benchmark that raises).
+"""
+
+import os
+import ast
+import sys
+import json
+import time
+import argparse
+import contextlib
+import subprocess
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import synthetic_data as syn
+from streaming_ingest import clean_human, aggregate
+from county_month import county_month_array
+from national_0911 import jalali_to_gregorian
+from moran_permutation import moran_global, moran_local
+
+
+## Folder with the scripts whose functions are benchmarked
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+## Where results are kept (relative to the working directory when they are read or written)
+BENCH_FILE = os.path.join('Data', 'runs', 'benchmarks.jsonl')
+
+## Size of the real data the scales are multiples of
+BASE_HUMAN = 4500
+BASE_COUNTIES = 429
+BASE_QUERIES = 50
+
+## The row-by-row script functions are only timed up to this scale
+SLOW_CAP = 10
+
+
+######### Functions #############
+def script_functions(path, names):
+    """
+    Compiles the named top-level functions from a script without running the rest of it.
+    The script's imports are run first (ones that fail are skipped) so the functions find their modules.
+    """
+    path = os.path.join(HERE, path)
+    with open(path, encoding = 'utf-8') as fh:
+        tree = ast.parse(fh.read(), path)
+
+    namespace = {'__name__': 'script_functions'}
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            try:
+                exec(compile(ast.Module([node], []), path, 'exec'), namespace)
+            except Exception:
+                pass
+
+    found = [node for node in tree.body if isinstance(node, ast.FunctionDef) and node.name in names]
+    exec(compile(ast.Module(found, []), path, 'exec'), namespace)
+    return {name: namespace[name] for name in names}
+
+
+def _quiet(func):
+    """
+    Runs func with its printing suppressed.
+    """
+    def inner():
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            return func()
+    return inner
+
+
+def _register(scale, seed, gaz = None):
+    """
+    Cleaned synthetic human register with 2-digit gregorian year and month strings, as after addGregorian.
+    Records without an outbreak date are dropped.
+    """
+    gaz = syn.gazetteer(BASE_COUNTIES) if gaz is None else gaz
+    human = clean_human(syn.human_register(BASE_HUMAN*scale, gaz, seed = seed), {})
+    yr, mth = jalali_to_gregorian(human['Outbreak_yr'], human['Outbreak_mth'])
+    ok = ~np.isnan(yr)
+    human = human[ok].reset_index(drop = True)
+    human['year'] = pd.Series(yr[ok]).astype(int).astype(str).str[2:]
+    human['month'] = pd.Series(mth[ok]).astype(int).astype(str)
+    return human
+
+
+## Each setup builds the inputs (not timed) and returns {variant: function to time}
+def setup_name_matching(scale, seed):
+    from place_names import match_names
+    gaz = syn.gazetteer(BASE_COUNTIES)
+    queries = syn.name_variants(gaz['county_en'].sample(BASE_QUERIES*scale, replace = True, random_state = seed),
+                                share = 1.0, seed = seed)['variant']
+    targets = gaz['county_en']
+    return {'match_names_df': lambda: match_names(queries, targets, as_df = True),
+            'match_names_dict': lambda: match_names(queries, targets, as_df = False)}
+
+
+def setup_joins(scale, seed):
+    gaz = syn.gazetteer(BASE_COUNTIES)
+    human = _register(scale, seed, gaz)
+    iran_data = gaz.assign(shape_area = 1.0, shape_len = 1.0)
+    return {'human_outer_merge': lambda: pd.merge(human, iran_data, how = 'outer', left_on = 'County', right_on = 'county_en')}
+
+
+def setup_jalali(scale, seed):
+    gaz = syn.gazetteer(BASE_COUNTIES)
+    human = clean_human(syn.human_register(BASE_HUMAN*scale, gaz, seed = seed), {})
+    out = {'jalali_to_gregorian': lambda: jalali_to_gregorian(human['Outbreak_yr'], human['Outbreak_mth'])}
+    if scale <= SLOW_CAP:
+        add_gregorian = script_functions('Tanner_regression.py', ['addGregorian'])['addGregorian']
+        out['addGregorian'] = lambda: add_gregorian(human, 'Outbreak_yr', 'Outbreak_mth')
+    return out
+
+
+def setup_env_enrichment(scale, seed):
+    if scale > SLOW_CAP:
+        return {}
+    gaz = syn.gazetteer(BASE_COUNTIES*scale)
+    human = _register(scale, seed, gaz)
+    ## addEnvData looks counties up by their shapefile names, so use the true names here
+    human['County'] = np.random.default_rng(seed).choice(gaz['county_en'], size = len(human))
+    env = syn.env_cube(gaz['county_en'], 2015, 2019, seed = seed)
+    add_env = script_functions('Tanner_regression.py', ['addEnvData'])['addEnvData']
+    return {'addEnvData': lambda: add_env(human, env, 'year', 'month')}
+
+
+def setup_aggregation(scale, seed):
+    human = _register(scale, seed)
+    by = ['County', 'Outbreak_yr', 'Outbreak_mth']
+    return {'groupby_counts': lambda: aggregate(human, by),
+            'county_month_array': lambda: county_month_array(human, county_col = 'County',
+                                                             year_col = 'year', month_col = 'month')}
+
+
+def setup_moran(scale, seed):
+    W = syn.grid_counties(BASE_COUNTIES*scale, seed)
+    y = np.random.default_rng(seed).gamma(2.0, size = W.shape[0])
+    return {'moran_global': lambda: moran_global(y, W, permutations = 999, seed = seed, workers = 1),
+            'moran_local': lambda: moran_local(y, W, permutations = 99, seed = seed, workers = 1)}
+
+
+def setup_regression(scale, seed):
+    import matplotlib
+    matplotlib.use('Agg')
+    mv_regress = script_functions('Tanner_regression.py', ['mvRegress'])['mvRegress']
+    rng = np.random.default_rng(seed)
+    n = BASE_HUMAN*scale
+    labels = ['mean_ndvi', 'mean_2m_air_temperature', 'mean_total_precipitation', 'mean_elevation']
+    df = pd.DataFrame(rng.normal(size = (n, 4)), columns = labels)
+    df['Incidence'] = df.values @ rng.normal(size = 4) + rng.normal(size = n)
+    return {'mvRegress': _quiet(lambda: mv_regress(df, 'Incidence', labels))}
+
+
+BENCHMARKS = {'name_matching': setup_name_matching,
+              'joins': setup_joins,
+              'jalali': setup_jalali,
+              'env_enrichment': setup_env_enrichment,
+              'aggregation': setup_aggregation,
+              'moran': setup_moran,
+              'regression': setup_regression}
+
+
+def time_call(func, repeat = 3):
+    """
+    Best wall time of repeat calls.
+    """
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def git_commit():
+    """
+    Short hash of the checked-out commit, with '+dirty' if there are uncommitted changes to tracked files.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True, text = True).stdout.strip()
+        dirty = subprocess.run(['git', 'diff', '--quiet', 'HEAD']).returncode != 0
+        return commit + ('+dirty' if dirty else '')
+    except OSError:
+        return 'unknown'
+
+
+def run_benchmarks(scales = (1, 10), only = None, repeat = 3, seed = 0, keep_going = False):
+    """
+    Runs each benchmark at each scale. Returns one row per (benchmark, variant, scale).
+    A variant that raises stops the run, unless keep_going, in which case it gets
+    seconds = NaN and the error message (and the script exits with status 1 at the end).
+    """
+    commit, stamp = git_commit(), datetime.now().isoformat(timespec = 'seconds')
+    rows = []
+    for name, setup in BENCHMARKS.items():
+        if only and name not in only:
+            continue
+        for scale in scales:
+            for variant, func in setup(scale, seed).items():
+                try:
+                    seconds, error = time_call(func, repeat), None
+                except Exception as err:
+                    if not keep_going:
+                        raise
+                    seconds, error = np.nan, '{}: {}'.format(type(err).__name__, err)
+                rows.append({'commit': commit, 'date': stamp, 'benchmark': name, 'variant': variant,
+                             'scale': scale, 'seconds': seconds, 'error': error})
+                print('{:<15} {:<20} x{:<5} {:9.4f} s {}'.format(name, variant, scale, seconds, error or ''))
+    return pd.DataFrame(rows)
+
+
+def load_history(path = BENCH_FILE):
+    if not os.path.exists(path):
+        return pd.DataFrame(columns = ['commit', 'date', 'benchmark', 'variant', 'scale', 'seconds', 'error'])
+    return pd.read_json(path, lines = True, dtype = {'commit': str, 'error': str})
+
+
+def record(results, path = BENCH_FILE):
+    """
+    Appends results to the history file.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    with open(path, 'a') as fh:
+        for row in results.to_dict('records'):
+            row = {k: (None if not isinstance(v, str) and pd.isna(v) else v) for k, v in row.items()}
+            fh.write(json.dumps(row) + '\n')
+
+
+def compare(results, history, tolerance = 1.3):
+    """
+    Compares each result with the latest result for the same benchmark, variant and scale from another commit.
+    Returns the comparisons with a 'slower' flag where the new time is over tolerance x the old one.
+    """
+    key = ['benchmark', 'variant', 'scale']
+    if history.empty:
+        return pd.DataFrame(columns = key + ['seconds', 'previous', 'commit_prev', 'ratio', 'slower'])
+
+    current = set(results['commit'])
+    prev = history[~history['commit'].isin(current)].dropna(subset = ['seconds'])
+    prev = prev.sort_values('date').groupby(key).last()
+    prev = prev[['seconds', 'commit']].rename(columns = {'seconds': 'previous', 'commit': 'commit_prev'})
+
+    out = results.join(prev, on = key, how = 'inner')[key + ['seconds', 'previous', 'commit_prev']]
+    out['ratio'] = out['seconds']/out['previous']
+    out['slower'] = out['ratio'] > tolerance
+    return out
+
+
+#%%
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Benchmark the pipeline on synthetic data.')
+    parser.add_argument('--scale', type = int, nargs = '+', default = [1, 10])
+    parser.add_argument('--only', nargs = '+', choices = list(BENCHMARKS))
+    parser.add_argument('--repeat', type = int, default = 3)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--tolerance', type = float, default = 1.3)
+    parser.add_argument('--no-record', action = 'store_true')
+    parser.add_argument('--keep-going', action = 'store_true', help = 'run the other benchmarks if one raises')
+    args = parser.parse_args()
+
+    history = load_history()
+    results = run_benchmarks(args.scale, args.only, args.repeat, args.seed, args.keep_going)
+    changes = compare(results, history, args.tolerance)
+
+    if not args.no_record:
+        record(results)
+
+    if len(changes):
+        print('\nCompared with previous commits:')
+        print(changes.to_string(index = False))
+
+    failed = results[results['error'].notna()]
+    if len(failed):
+        print('\n{} benchmark(s) failed:'.format(len(failed)))
+        print(failed[['benchmark', 'variant', 'scale', 'error']].to_string(index = False))
+
+    slower = changes[changes['slower']] if len(changes) else changes
+    if len(slower):
+        print('\n{} benchmark(s) slower than {}x the previous result'.format(len(slower), args.tolerance))
+    if len(failed) or len(slower):
+        sys.exit(1)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Cleaned-data output layer
+
+Writes the cleaned human, animal, SES and population tables as typed, uncompressed Feather
+files (so they can be memory-mapped), with the county polygons stored once as GeoParquet. Each attribute table keeps
+county_en as the key to the shared geometry, so nothing is written twice.
+
+Shapefiles cut column names to 10 characters and CSVs lose all dtypes; these keep the
+full names and types and read back memory-mapped:
+
+    from clean_outputs import read_table
+    human_sp_data = read_table('human', with_geometry = True)
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+
+## Default output folder (relative to the working directory when a table is written or read)
+CLEAN_DIR = os.path.join('Data', 'clean')
+
+## Geometry layer shared by every table
+GEOMETRY_FILE = 'counties.parquet'
+
+## Columns that come from the shapefile join and live in the geometry layer instead
+SHAPE_COLUMNS = ['county_fa', 'province_fa', 'shape_len', 'shape_area', 'geometry']
+
+
+######### Functions #############
+def typed(df, max_share = 0.5):
+    """
+    Compact column types for writing: low-cardinality text becomes categorical and
+    numbers are downcast to the smallest type that holds them exactly.
+    """
+    df = df.copy()
+    for col in df.columns:
+        s = df[col]
+        if s.dtype == object or pd.api.types.is_string_dtype(s.dtype):
+            ## Text columns sometimes mix in numbers (e.g. years next to 'Null'), so store everything as strings
+            s = s.where(s.isna(), s.astype(str))
+            df[col] = s.astype('category') if s.nunique(dropna = True) <= max_share*len(s) else s.astype('string')
+        elif pd.api.types.is_integer_dtype(s.dtype):
+            df[col] = pd.to_numeric(s, downcast = 'integer')
+        elif pd.api.types.is_float_dtype(s.dtype):
+            down = pd.to_numeric(s, downcast = 'float')
+            ## NaN != NaN, so compare with equal_nan (and no tolerance: the values must survive exactly)
+            same = np.allclose(down.to_numpy(dtype = float, na_value = np.nan), s.to_numpy(dtype = float, na_value = np.nan),
+                               rtol = 0, atol = 0, equal_nan = True)
+            if same:
+                df[col] = down
+    return df
+
+
+def arrow_table(df):
+    """
+    Arrow table of df. Categorical columns are written with a valid code under missing values
+    (pandas uses -1, which Arrow readers such as Polars' reject).
+    """
+    table = pa.Table.from_pandas(df, preserve_index = False)
+    for col in df.columns:
+        s = df[col]
+        if isinstance(s.dtype, pd.CategoricalDtype) and s.isna().any():
+            codes = s.cat.codes.to_numpy()
+            arr = pa.DictionaryArray.from_arrays(pa.array(np.where(codes < 0, 0, codes), mask = codes < 0),
+                                                 pa.array(s.cat.categories.astype(object)))
+            table = table.set_column(table.schema.get_field_index(col), col, arr)
+    return table
+
+
+def write_geometry(iran_data, folder = CLEAN_DIR):
+    """
+    Writes the county polygons and shapefile attributes once, as GeoParquet keyed by county_en.
+    """
+    os.makedirs(folder, exist_ok = True)
+    gdf = gpd.GeoDataFrame(iran_data, geometry = 'geometry', crs = iran_data.crs or 'EPSG:4326')
+    gdf.to_parquet(os.path.join(folder, GEOMETRY_FILE), compression = 'zstd')
+
+
+def write_table(df, name, folder = CLEAN_DIR, compression = 'uncompressed'):
+    """
+    Writes one attribute table as Feather, without the geometry and other shapefile columns
+    (they are in the shared geometry layer). Uncompressed by default so read_table can memory-map
+    it; 'lz4' or 'zstd' give smaller files that are decoded on read.
+    """
+    os.makedirs(folder, exist_ok = True)
+    df = pd.DataFrame(df).drop(columns = [c for c in SHAPE_COLUMNS if c in df.columns])
+    feather.write_feather(arrow_table(typed(df).reset_index(drop = True)), os.path.join(folder, name + '.feather'),
+                          compression = compression)
+
+
+def write_clean_tables(iran_data, tables, folder = CLEAN_DIR):
+    """
+    Writes the shared geometry and every table in a {name: dataframe} dict.
+    """
+    write_geometry(iran_data, folder)
+    for name, df in tables.items():
+        write_table(df, name, folder)
+
+
+def read_table(name, folder = CLEAN_DIR, columns = None, with_geometry = False):
+    """
+    Reads a table back. Uncompressed files are memory-mapped; compressed ones are decoded column by column.
+    columns limits the read to those columns. with_geometry joins the shared county polygons
+    back on county_en and returns a GeoDataFrame.
+    """
+    table = feather.read_table(os.path.join(folder, name + '.feather'), columns = columns, memory_map = True)
+    df = table.to_pandas()
+
+    if not with_geometry:
+        return df
+
+    geom = read_geometry(folder)
+    geom = geom[['county_en'] + [c for c in geom.columns if c not in df.columns]]
+    return gpd.GeoDataFrame(df.merge(geom, how = 'left', on = 'county_en'), geometry = 'geometry', crs = geom.crs)
+
+
+def read_geometry(folder = CLEAN_DIR, columns = None):
+    """
+    Reads the shared county layer.
+    """
+    return gpd.read_parquet(os.path.join(folder, GEOMETRY_FILE), columns = columns)
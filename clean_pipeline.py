@@ -0,0 +1,460 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel cleaning pipeline
+
+In data_merge2.py the human, animal, SES and population sections each need only the county
+layer and their own raw file, but run one after another. This runs the same steps as four
+branches in a process pool and merges the results at the end:
+
+    human       register -> codes, province names, province-blocked county links
+    animal      tests -> province names, county links (with test locations), county-month totals
+    ses         province SES table -> shapefile province names
+    pop         census hierarchy -> county populations keyed by county ID
+
+then the cross-branch steps (combine: vaccination coverage, county-month rates with their
+smoothed versions, the 2009-2011 national cases re-based onto today's counties, the Katharine table),
+the analysis steps (analyse: space-time clusters of human cases, lagged animal-human correlations)
+and the writes (write_outputs).
+data_merge2.py runs the same branch, combine, analyse and write functions one after another,
+so both scripts write the same set of clean tables.
+
+The county layer (the gazetteer every branch links against) is written once as an
+uncompressed Arrow file with the polygons as WKB, and each worker memory-maps it instead
+of receiving a pickled copy. The attributes stay views of the mapped file (open_layer);
+only the animal branch decodes the polygons, for the point-in-county checks. Branch
+outputs are attribute tables; the polygons are joined back only when the clean tables are written.
+
+    out = run_pipeline(fp, url)                ## branches in parallel
+    out = run_pipeline(fp, url, workers = 1)   ## same steps in this process
+"""
+
+import os
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from streaming_ingest import data_path, read_mapping, clean_human, clean_animal
+from stage_timing import RunLog
+from lazy_joins import outer_join, katharine_table, check_backend
+from place_names import human_places, animal_places, ses_provinces
+from crosswalk import read_crosswalk
+from validation import check, human_rules, animal_rules, layer_rules, numeric, not_negative, unique, matched, ValidationError
+
+
+LAYER_FILE = 'county_layer.arrow'
+
+## Branches that need the county polygons (the others get the attributes only)
+GEOMETRY_BRANCHES = {'animal'}
+
+
+######### Functions #############
+def default_sources(fp, url):
+    """
+    Raw input paths for each branch: the registers come from url, the rest from the local repository.
+    """
+    return {'human': data_path(url, 'Data', 'Human_Brucellosis_2015-2018_V2.csv'),
+            'animal': data_path(url, 'Data', 'animal_vac_data.csv'),
+            'ses': os.path.join(fp, 'Data', 'ses_data.csv'),
+            'census': os.path.join(fp, 'Data', 'pop_by_county.csv'),
+            'codes': os.path.join(fp, 'Job_Interaction_Code.txt'),
+            'pop_map': os.path.join(fp, 'pop_data_mappings.csv'),
+            'crosswalk': os.path.join(fp, 'county_crosswalk.csv')}
+
+
+def share_layer(iran_data, folder):
+    """
+    Writes the county layer once as an uncompressed Arrow file (polygons as WKB) for the workers to memory-map,
+    in a single record batch so every numeric column maps to one contiguous array.
+    """
+    df = pd.DataFrame(iran_data).copy()
+    if 'geometry' in df:
+        df['geometry'] = iran_data.geometry.to_wkb().values
+    path = os.path.join(folder, LAYER_FILE)
+    feather.write_feather(pa.Table.from_pandas(df, preserve_index = False), path, compression = 'uncompressed',
+                          chunksize = max(len(df), 1))
+    return path
+
+
+def _view(col):
+    """
+    One Arrow column as a pandas array over the same buffers: a numpy view for fixed-width columns
+    without nulls, an Arrow-backed array otherwise.
+    """
+    if col.num_chunks == 1 and col.null_count == 0 and (pa.types.is_integer(col.type) or pa.types.is_floating(col.type)):
+        return col.chunk(0).to_numpy(zero_copy_only = True)
+    if pa.types.is_string(col.type) or pa.types.is_large_string(col.type):
+        return pd.array(col, dtype = pd.StringDtype('pyarrow', na_value = np.nan))
+    return pd.array(col, dtype = pd.ArrowDtype(col.type))
+
+
+def open_layer(path, geometry = False):
+    """
+    The shared county layer, memory-mapped. The attribute columns are read-only views of the mapped
+    file, not copies; geometry = True also decodes the WKB polygons into a GeoDataFrame.
+    """
+    table = feather.read_table(path, memory_map = True)
+    attrs = table.drop_columns([c for c in ['geometry'] if c in table.column_names])
+    df = pd.DataFrame({name: _view(col) for name, col in zip(attrs.column_names, attrs.columns)}, copy = False)
+    if not geometry:
+        return df
+    import geopandas as gpd
+    return gpd.GeoDataFrame(df, geometry = gpd.GeoSeries.from_wkb(table.column('geometry').to_numpy(zero_copy_only = False)),
+                            crs = 'EPSG:4326')
+
+
+def _attributes(iran_data):
+    """
+    The layer attributes without the polygons, which are only joined back when the tables are written.
+    """
+    return pd.DataFrame(iran_data.drop(columns = 'geometry', errors = 'ignore'))
+
+
+def human_branch(iran_data, sources, backend = 'pandas', fail_fast = False, out_dir = None, log = None):
+    """
+    Human register: columns, codes, province names and linked counties, joined to the layer attributes.
+    """
+    from risk_codes import apply_codes, read_code_tables
+
+    iran_data = _attributes(iran_data)
+    human_data = clean_human(pd.read_csv(sources['human']), {})
+    code_tables = read_code_tables(sources['codes'])
+    report = check(human_data, human_rules(code_tables), 'human', fail_fast, out_dir)
+    human_data = apply_codes(human_data, code_tables)
+
+    original = human_data['County']
+    human_data, links, conflicts = human_places(human_data, iran_data, xwalk = read_crosswalk(sources['crosswalk']), log = log)
+    linked = pd.DataFrame({'County': original.values, 'county_en': human_data['County'].values})
+    report = pd.concat([report, check(linked, [matched('county_en', iran_data['county_en'], source_col = 'County')], 'human_links',
+                                      fail_fast, out_dir)])
+
+    human_sp_data = outer_join(human_data, iran_data, 'County', 'county_en', backend = backend)
+    records = human_data[['County', 'Outbreak_yr', 'Outbreak_mth', 'Livestock_vac_hist']]
+    return {'human': human_sp_data, 'human_county_conflicts': conflicts, 'human_records': records, 'validation_human': report}
+
+
+def animal_branch(iran_data, sources, backend = 'pandas', fail_fast = False, out_dir = None, log = None):
+    """
+    Animal tests: province names, counties linked with the test locations (when iran_data has its
+    polygons), county-month totals.
+    """
+    from animal_aggregation import aggregate_animal, check_totals
+
+    animal_data = clean_animal(pd.read_csv(sources['animal']), {})
+    report = check(animal_data, animal_rules(), 'animal', fail_fast, out_dir)
+    original = animal_data['county']
+    animal_data, links, conflicts = animal_places(animal_data, iran_data, xwalk = read_crosswalk(sources['crosswalk']), log = log)
+    linked = pd.DataFrame({'county': original.values, 'county_en': animal_data['county'].values})
+    report = pd.concat([report, check(linked, [matched('county_en', iran_data['county_en'], source_col = 'county')], 'animal_links',
+                                      fail_fast, out_dir)])
+
+    ani_cm_data = aggregate_animal(animal_data)
+    check_totals(animal_data, ani_cm_data)
+
+    ani_sp_data = outer_join(animal_data, _attributes(iran_data), 'county', 'county_en', backend = backend)
+    ani_sp_data['animal_inf_rate'] = ani_sp_data['n_infected']/ani_sp_data['n_sample']
+    return {'animal': ani_sp_data, 'animal_county_month': ani_cm_data,
+            'animal_county_month_type': aggregate_animal(animal_data, by_type = True),
+            'animal_county_conflicts': conflicts, 'validation_animal': report,
+            'animal_records': animal_data[['county', 'year', 'month', 'livestock_type', 'n_sample', 'n_infected']]}
+
+
+def ses_branch(iran_data, sources, backend = 'pandas', fail_fast = False, out_dir = None, log = None):
+    """
+    Province SES table matched to the shapefile province names.
+    """
+    iran_data = _attributes(iran_data)
+    ses_data = pd.read_csv(sources['ses'])
+    ses_data.columns = ['province', 'pop', 'hshld_size', 'ses']
+    ses_data = ses_provinces(ses_data, iran_data)
+    report = check(ses_data, [numeric('ses'), unique('province'), matched('province', iran_data['province_en'])], 'ses', fail_fast, out_dir)
+    return {'ses': outer_join(ses_data, iran_data, 'province', 'province_en', backend = backend), 'validation_ses': report}
+
+
+def pop_branch(iran_data, sources, backend = 'pandas', fail_fast = False, out_dir = None, log = None):
+    """
+    Census county populations linked to the layer by county ID.
+    """
+    from population import parse_census, county_populations
+
+    iran_data = _attributes(iran_data)
+    census = parse_census(sources['census'])
+    pop_cty, conflicts = county_populations(census, iran_data, read_mapping(sources['pop_map']))
+    pop_data_cts_only = pop_cty[['county_en', 'population']].rename(columns = {'county_en':'Mapped', 'population':'Population'})
+    report = check(pop_data_cts_only, [not_negative(['Population']), unique('Mapped'), matched('Mapped', iran_data['county_en'])],
+                   'pop', fail_fast, out_dir)
+    return {'pop': outer_join(pop_data_cts_only, iran_data, 'Mapped', 'county_en', backend = backend),
+            'pop_conflicts': conflicts, 'validation_pop': report}
+
+
+BRANCHES = {'human': human_branch, 'animal': animal_branch, 'ses': ses_branch, 'pop': pop_branch}
+
+
+def _run_branch(name, layer_path, sources, profile = None, backend = 'pandas', fail_fast = False, out_dir = None):
+    """
+    Runs one branch on the memory-mapped layer with its own stage record and its name matching's
+    (returned with the outputs, since the worker's log isn't shared). Its validation reports are written to out_dir as they are
+    made, so they are kept when a check raises.
+    """
+    run = RunLog(name, profile = profile)
+    with run.stage(name, pid = os.getpid()) as st:
+        iran_data = open_layer(layer_path, geometry = name in GEOMETRY_BRANCHES)
+        out = BRANCHES[name](iran_data, sources, backend, fail_fast, out_dir, log = run)
+        st.rows_out(next(iter(out.values())))
+    return name, out, run.stages
+
+
+def county_month_rates(human_data, ani_cm_data, iran_data, fp):
+    """
+    Human incidence per 100,000 per county-month over each month's population (the census projected
+    to every month, population.load_denominators) and the animal infection rate per tested animal,
+    each with its global and local empirical Bayes and spatially smoothed versions (<rate>_ebg,
+    <rate>_ebl, <rate>_sm; see rate_smoothing.py), since the raw rates of small counties are mostly noise.
+    human_data needs gregorian year and month columns; iran_data needs its polygons for the weights.
+    Returns the human county-month table and the animal one with the smoothed columns added.
+    """
+    from population import load_denominators
+    from county_month import county_month_array, array_to_long
+    from spatial_weights import queen_sparse
+    from rate_smoothing import smooth_rates, add_smoothed_rates
+
+    W = queen_sparse(iran_data)
+    counties = pd.Index(iran_data['county_en'])
+
+    ## Counties without a census population get 0 and so a NaN rate
+    cases, _, months = county_month_array(human_data, county_col = 'County', counties = counties)
+    pop = np.nan_to_num(load_denominators(fp).array(counties, months))
+    hum_cm_data = array_to_long(cases, counties, months, 'cases')
+    hum_cm_data['population'] = pop.ravel()
+    hum_cm_data['Incidence'] = 100000*hum_cm_data['cases']/hum_cm_data['population'].where(hum_cm_data['population'] > 0)
+    hum_cm_data = add_smoothed_rates(hum_cm_data, smooth_rates(cases, pop, W, 100000), counties, months, 'Incidence')
+
+    infected, _, months = county_month_array(ani_cm_data, 'n_infected', county_col = 'county', counties = counties)
+    sampled, _, _ = county_month_array(ani_cm_data, 'n_sample', county_col = 'county', counties = counties, months = months)
+    ani_cm_data = add_smoothed_rates(ani_cm_data, smooth_rates(infected, sampled, W), counties, months, 'animal_inf_rate',
+                                     county_col = 'county')
+    return hum_cm_data, ani_cm_data
+
+
+def national_rates(iran_data, fp):
+    """
+    The 2009-2011 national human cases moved onto today's counties through the area crosswalk between
+    the 2011 and current boundaries (national_0911.load_national_0911), with each month's population
+    and incidence per 100,000.
+    """
+    from national_0911 import load_national_0911
+    from population import load_denominators
+
+    nat = load_national_0911(fp, iran_data)
+    nat['population'] = load_denominators(fp).lookup(nat['county_en'], nat['year'], nat['month'])
+    nat['Incidence'] = 100000*nat['cases']/nat['population'].where(nat['population'] > 0)
+    return nat
+
+
+def combine(outputs, iran_data, fp, backend = 'pandas'):
+    """
+    The cross-branch steps: vaccination coverage on the animal county-month table, the human and
+    animal county-month rates (county_month_rates), the 2009-2011 national county-month cases
+    (national_rates) and the Katharine table from the risk factor cube.
+    The record tables the branches pass along (human_records, animal_records) are used up here.
+    """
+    from vaccination import coverage_layer, add_coverage
+    from national_0911 import jalali_to_gregorian
+
+    human_data = outputs.pop('human_records').copy()
+    animal_data = outputs.pop('animal_records')
+    human_data['year'], human_data['month'] = jalali_to_gregorian(human_data['Outbreak_yr'], human_data['Outbreak_mth'])
+    outputs['vaccination_county_month'] = coverage_layer(animal_data, human_data, human_args = {'county_col': 'County'})
+    outputs['animal_county_month'] = add_coverage(outputs['animal_county_month'], outputs['vaccination_county_month'], county_col = 'county')
+
+    outputs['human_county_month'], outputs['animal_county_month'] = county_month_rates(human_data, outputs['animal_county_month'],
+                                                                                       iran_data, fp)
+    outputs['national_county_month'] = national_rates(iran_data, fp)
+
+    outputs['dataForKatharine'] = katharine_table(outputs['human'], outputs['pop'], outputs['ses'],
+                                                  ['county_en', 'province_en', 'Livestock_int_hist', 'Livestock_vac_hist', 'Pop_setting'],
+                                                  backend = backend)
+    return outputs
+
+
+def scan_clusters(hum_cm_data, iran_data, replicates = 999, workers = None, **kwargs):
+    """
+    Space-time clusters of human cases: space_time_scan over the county-month cases and each month's
+    population, with the county names and months filled in. Counties without a census population are
+    left out (they have no expected cases). The member counties are joined into one '; '-separated string.
+    iran_data needs its polygons for the centroids; other arguments go to space_time_scan.
+    """
+    from county_month import county_month_array
+    from spatial_weights import centroids
+    from space_time_scan import space_time_scan, label_clusters
+
+    counties = pd.Index(iran_data['county_en'])
+    cases, _, months = county_month_array(hum_cm_data, 'cases', counties = counties)
+    pop, _, _ = county_month_array(hum_cm_data, 'population', counties = counties, months = months)
+    keep = pop.min(1) > 0
+
+    clusters = space_time_scan(cases[keep], pop[keep], centroids(iran_data)[keep], replicates = replicates,
+                               workers = workers, **kwargs)
+    clusters = label_clusters(clusters, counties[keep], months)
+    clusters['counties'] = clusters['counties'].str.join('; ')
+    return clusters
+
+
+def lag_correlations(hum_cm_data, ani_cm_data, iran_data, max_lag = 24, permutations = 999):
+    """
+    Correlation between the animal infection rate and human incidence months later (lag_correlation.py),
+    on the county-month tables. Returns the pooled correlation and distributed lag coefficient per lag
+    with their permutation p-values, and the correlation per county and lag (county_en, lag, r, n_pairs, p_sim).
+    """
+    from lag_correlation import county_month_rates, lagged_xcorr, distributed_lag
+
+    animal, human, counties, _ = county_month_rates(hum_cm_data, ani_cm_data, pd.Index(iran_data['county_en']))
+    r, n, pooled, p = lagged_xcorr(animal, human, max_lag, permutations)
+    coef = distributed_lag(animal, human, max_lag, permutations)
+
+    pooled = pooled.merge(coef.rename(columns = {'p_sim': 'coefficient_p_sim'}), on = 'lag', how = 'left')
+    by_county = pd.DataFrame({'county_en': np.repeat(np.asarray(counties), r.shape[1]),
+                              'lag': np.tile(np.arange(r.shape[1]), len(counties)),
+                              'r': r.ravel(), 'n_pairs': n.ravel().astype(int)})
+    if p is not None:
+        by_county['p_sim'] = p.ravel()
+    return pooled, by_county.dropna(subset = ['r'])
+
+
+def analyse(outputs, iran_data, replicates = 999, workers = None):
+    """
+    The analysis steps on the combined tables: space-time clusters of human cases (human_clusters,
+    see scan_clusters) and the lagged animal-human correlations (lag_correlation and lag_correlation_county,
+    see lag_correlations). replicates are the Monte Carlo replicates of the scan and the permutations of the correlations.
+    """
+    outputs['human_clusters'] = scan_clusters(outputs['human_county_month'], iran_data, replicates, workers)
+    outputs['lag_correlation'], outputs['lag_correlation_county'] = lag_correlations(outputs['human_county_month'],
+                                                                                     outputs['animal_county_month'], iran_data,
+                                                                                     permutations = replicates)
+    return outputs
+
+
+def validation_report(reports, out_dir = None):
+    """
+    All validation reports in one frame, written to out_dir as validation.csv.
+    """
+    report = pd.concat(reports, ignore_index = True)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok = True)
+        report.to_csv(os.path.join(out_dir, 'validation.csv'), index = False)
+    return report
+
+
+def write_outputs(outputs, iran_data, fp, folder):
+    """
+    Writes the conflict reports to Data/<name>.csv, every other table as a clean table in folder
+    (polygons stored once, see clean_outputs.py), and the Katharine table to Data/dataForKatharine.csv,
+    which the notebooks still read.
+    """
+    from clean_outputs import write_clean_tables
+
+    conflicts = [k for k in outputs if k.endswith('conflicts')]
+    for name in conflicts:
+        outputs[name].to_csv(os.path.join(fp, 'Data', name + '.csv'), index = False)
+    write_clean_tables(iran_data, {k: v for k, v in outputs.items() if k not in conflicts and k != 'validation'}, folder = folder)
+    outputs['dataForKatharine'].to_csv(os.path.join(fp, 'Data', 'dataForKatharine.csv'))
+
+
+def run_pipeline(fp, url = None, iran_data = None, sources = None, workers = None, out_dir = None, log = None, backend = 'pandas',
+                 fail_fast = False, replicates = 999):
+    """
+    Runs the four cleaning branches (in parallel unless workers = 1; by default one worker per
+    branch up to the number of CPUs), then the combined steps. iran_data needs its polygons. backend = 'polars' runs the joins
+    lazily in Polars (see lazy_joins.py).
+    Every input is validated first (see validation.py) and the reports are written to the run
+    folder as validation.csv, and per table as each check runs; with fail_fast = True the run stops
+    at the first table breaking an error-level rule, and branches that haven't started are cancelled.
+    The analysis steps (analyse) run last, with `replicates` Monte Carlo replicates or permutations for their p-values.
+    Returns a dict of output tables; with out_dir they are also written as clean tables (write_outputs),
+    the same set data_merge2.py writes.
+    """
+    from layer_cache import read_iran
+
+    check_backend(backend)
+    sources = sources or default_sources(fp, url)
+    iran_data = read_iran(fp) if iran_data is None else iran_data
+    log = log or RunLog('clean_pipeline', out_dir = os.path.join(fp, 'Data', 'runs'))
+    workers = min(len(BRANCHES), os.cpu_count() or 1) if workers is None else workers
+
+    reports = [check(iran_data, layer_rules(), 'layer', fail_fast, log.out_dir)]
+    outputs = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        layer_path = share_layer(iran_data, tmp)
+        args = (layer_path, sources, log.profile, backend, fail_fast, log.out_dir)
+        with log.stage('branches', workers = workers):
+            if workers == 1:
+                results = [_run_branch(name, *args) for name in BRANCHES]
+            else:
+                pool = ProcessPoolExecutor(min(workers, len(BRANCHES)))
+                try:
+                    futures = [pool.submit(_run_branch, name, *args) for name in BRANCHES]
+                    results = [f.result() for f in as_completed(futures)]
+                except BaseException:
+                    ## Don't start the remaining branches or wait for the running ones
+                    pool.shutdown(wait = False, cancel_futures = True)
+                    raise
+                pool.shutdown()
+                results.sort(key = lambda res: list(BRANCHES).index(res[0]))
+        for name, out, stages in results:
+            reports.append(out.pop('validation_' + name))
+            outputs.update(out)
+            log.stages.extend(stages)
+
+    outputs['validation'] = validation_report(reports, log.out_dir)
+
+    with log.stage('combine'):
+        outputs = combine(outputs, iran_data, fp, backend)
+
+    with log.stage('analyse'):
+        outputs = analyse(outputs, iran_data, replicates, workers)
+
+    if out_dir is not None:
+        with log.stage('write_outputs'):
+            write_outputs(outputs, iran_data, fp, out_dir)
+    return outputs
+
+
+#%%
+if __name__ == '__main__':
+
+    import geopandas as gpd
+    from shapely.geometry import box
+    import synthetic_data as syn
+    from layer_cache import read_iran
+
+    ## Synthetic registers on the real county names and IDs, with square stand-in polygons
+    iran_data = read_iran(columns = ['ADM2_PCODE', 'ADM2_EN', 'ADM2_FA', 'ADM1_EN'], geometry = False)
+    side = int(np.ceil(np.sqrt(len(iran_data))))
+    iran_data = gpd.GeoDataFrame(iran_data, geometry = [box(44 + (i % side)*0.5, 25 + (i//side)*0.5, 44.5 + (i % side)*0.5,
+                                                            25.5 + (i//side)*0.5) for i in range(len(iran_data))], crs = 'EPSG:4326')
+
+    tmp = tempfile.mkdtemp()
+    sources = default_sources(os.getcwd(), tmp)
+    sources['human'], sources['animal'] = os.path.join(tmp, 'human.csv'), os.path.join(tmp, 'animal.csv')
+    syn.human_register(200000, iran_data, share_misspelled = 0.1).to_csv(sources['human'], index = False)
+    syn.animal_tests(300000, iran_data, share_misspelled = 0.1).to_csv(sources['animal'], index = False)
+
+    for workers in [1, 4]:
+        log = RunLog('clean_pipeline')
+        t0 = time.perf_counter()
+        out = run_pipeline(os.getcwd(), iran_data = iran_data, sources = sources, workers = workers, log = log, replicates = 19)
+        print('workers = {}: {:.1f}s'.format(workers, time.perf_counter() - t0))
+        print(log.summary()[['seconds', 'rows_out']])
+
+    print(out['human_clusters'].head(3).to_string())
+    print(out['validation'].loc[out['validation']['n_bad'] > 0, ['table', 'check', 'column', 'severity', 'n_bad']].to_string())
+    try:
+        run_pipeline(os.getcwd(), iran_data = iran_data, sources = sources, workers = 4, log = RunLog('clean_pipeline'), fail_fast = True,
+                     replicates = 0)
+    except ValidationError as e:
+        print(e)
+    else:
+        print('No error-level rule broken')
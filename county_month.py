@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+County-month arrays
+
+Helpers for moving between the record-level tables (human_sp_data, ani_sp_data)
+and dense county x month numpy arrays, which is the layout used by the
+time-series stages (lagged correlation, scan statistics, smoothing).
+"""
+
+import numpy as np
+import pandas as pd
+
+
+######### Functions #############
+def month_key(year, month):
+    """
+    Converts year and month columns to a single integer month key (year*12 + month-1).
+    Accepts strings or numbers. Two digit years (as written by addGregorian) are read as 20YY.
+    Anything non-numeric (e.g. 'Null') becomes NaN.
+    """
+    year = pd.to_numeric(pd.Series(year), errors = 'coerce')
+    month = pd.to_numeric(pd.Series(month), errors = 'coerce')
+
+    ## addGregorian writes '%y' so 2016 comes through as '16'
+    year = year.where(year >= 100, year + 2000)
+
+    return (year*12 + month - 1).values
+
+
+def key_to_period(keys):
+    """
+    Converts integer month keys back to a monthly pandas PeriodIndex.
+    """
+    keys = np.asarray(keys, dtype = int)
+    return pd.PeriodIndex.from_fields(year = keys//12, month = keys%12 + 1, freq = 'M')
+
+
+def county_month_array(data, value = None, county_col = 'county_en', year_col = 'year', month_col = 'month',
+                       counties = None, months = None, fill = 0.0):
+    """
+    Pivots a record-level dataframe into a (county, month) array.
+    If value is None the records are counted, otherwise the value column is summed.
+    counties and months (integer month keys) fix the axes so several arrays line up;
+    by default they are taken from the data. Missing cells get the fill value.
+    Returns the array, the county index and the month keys.
+    """
+    keys = month_key(data[year_col], data[month_col])
+    keep = ~np.isnan(keys) & data[county_col].notna().values
+
+    if counties is None:
+        counties = pd.Index(np.sort(data.loc[keep, county_col].unique()))
+    else:
+        counties = pd.Index(counties)
+
+    if months is None:
+        months = np.arange(np.nanmin(keys), np.nanmax(keys) + 1, dtype = int)
+    months = np.asarray(months, dtype = int)
+
+    ## Integer row/column positions for each record; records outside the axes are dropped
+    rows = counties.get_indexer(data[county_col])
+    cols = np.searchsorted(months, np.where(keep, keys, -1))
+    cols = np.clip(cols, 0, len(months) - 1)
+    keep &= (rows >= 0) & (months[cols] == keys)
+
+    vals = np.ones(keep.sum()) if value is None else pd.to_numeric(data.loc[keep, value], errors = 'coerce').fillna(0).values
+
+    ## Sum everything that lands in the same cell in one pass
+    arr = np.zeros(len(counties)*len(months))
+    np.add.at(arr, rows[keep]*len(months) + cols[keep], vals)
+    arr = arr.reshape(len(counties), len(months))
+
+    if fill != 0.0:
+        seen = np.zeros(arr.size, dtype = bool)
+        seen[rows[keep]*len(months) + cols[keep]] = True
+        arr[~seen.reshape(arr.shape)] = fill
+
+    return arr, counties, months
+
+
+def array_to_long(arr, counties, months, name):
+    """
+    Flattens a (county, month) array back into a long dataframe with county_en, year, month columns.
+    """
+    months = np.asarray(months, dtype = int)
+    return pd.DataFrame({'county_en': np.repeat(np.asarray(counties), len(months)),
+                         'year': np.tile(months//12, len(counties)),
+                         'month': np.tile(months%12 + 1, len(counties)),
+                         name: np.asarray(arr).ravel()})
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Boundary crosswalks
+
+The cleaning scripts fold historical and sub-county names onto today's polygons with
+dictionary edits ('Sarchahan':'Hajiabad', 'Zarghan':'Shiraz', 'kish':'Bandar-Lengeh' ...),
+and the population figures come from a different census vintage than the shapefile.
+A crosswalk states those relationships once as a table
+
+    source   target   weight
+
+where each source unit's weights add up to 1 (all of Sarchahan goes to Hajiabad; a split
+county goes to its successors by area or population share). The table becomes a sparse
+(target x source) matrix, and a whole county-month array from county_month_array is moved
+onto the target vintage with one sparse product, keeping the totals.
+
+county_crosswalk.csv holds the names the registers use for units that are now part of a
+shapefile county. Its whole-unit rows are used as manual mappings when the registers are
+linked (place_names.py); split units can't be given to one polygon per record, so they are
+moved on the county-month tables with reallocate / reallocate_table:
+
+    xwalk = read_crosswalk(os.path.join(fp, 'county_crosswalk.csv'))
+    human_data, links, conflicts = human_places(human_data, iran_data, xwalk = xwalk)
+
+The 2009-2011 national layer is on the 2011 boundaries (386 counties against 429 today); its
+county-month cube is moved onto today's counties with an area crosswalk (national_0911.py):
+
+    xwalk = area_crosswalk(national, iran_data, 'ID', 'county_en')
+    cube, counties, dropped = reallocate(cube, ids, xwalk)
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+######### Functions #############
+def crosswalk_from_mapping(mapping, identity = None):
+    """
+    Crosswalk for many-to-one renames like match_dict_man (weight 1 each).
+    identity adds unchanged units (e.g. iran_data['county_en']) mapping onto themselves.
+    """
+    xwalk = pd.DataFrame({'source': list(mapping.keys()), 'target': list(mapping.values()), 'weight': 1.0})
+    if identity is not None:
+        same = pd.Index(identity).difference(xwalk['source'])
+        xwalk = pd.concat([xwalk, pd.DataFrame({'source': same, 'target': same, 'weight': 1.0})], ignore_index = True)
+    return xwalk
+
+
+def area_crosswalk(source_gdf, target_gdf, source_col, target_col, crs = 'EPSG:32639', min_share = 1e-4):
+    """
+    Crosswalk between two boundary vintages weighted by the share of each source unit's area
+    falling in each target unit (projected to UTM 39N for areas). Slivers under min_share are
+    dropped and the rest rescaled to sum to 1.
+    """
+    import geopandas as gpd
+
+    src = source_gdf[[source_col, 'geometry']].to_crs(crs)
+    tgt = target_gdf[[target_col, 'geometry']].to_crs(crs)
+    src = src.rename(columns = {source_col: 'source'})
+    tgt = tgt.rename(columns = {target_col: 'target'})
+
+    pieces = gpd.overlay(src, tgt, how = 'intersection', keep_geom_type = True)
+    pieces['weight'] = pieces.geometry.area
+    xwalk = pd.DataFrame(pieces[['source', 'target', 'weight']])
+    return normalize(xwalk, min_share)
+
+
+def population_crosswalk(pieces, source_col = 'source', target_col = 'target', pop_col = 'population', min_share = 0.0):
+    """
+    Crosswalk weighted by population, from a table of (source, target, population) pieces,
+    e.g. the settlements of an old census county and the current county each lies in.
+    """
+    xwalk = pieces.rename(columns = {source_col: 'source', target_col: 'target', pop_col: 'weight'})
+    return normalize(xwalk[['source', 'target', 'weight']], min_share)
+
+
+def _shares(xwalk):
+    """
+    Weights divided by their source's total; NaN where the total isn't positive.
+    """
+    totals = xwalk.groupby('source')['weight'].transform('sum')
+    return xwalk['weight']/totals.where(totals > 0)
+
+
+def normalize(xwalk, min_share = 0.0):
+    """
+    Adds up duplicate (source, target) rows, drops shares under min_share and rescales so each source's weights sum to 1.
+    Sources whose weights add up to 0 (e.g. no population in any piece) have no shares and are
+    dropped, so their counts show up in the 'dropped' total of reallocate.
+    """
+    xwalk = xwalk.groupby(['source', 'target'], as_index = False, sort = False)['weight'].sum()
+    xwalk['weight'] = _shares(xwalk)
+    xwalk = xwalk[xwalk['weight'] >= min_share].copy()
+    xwalk['weight'] = _shares(xwalk)
+    return xwalk.reset_index(drop = True)
+
+
+def check(xwalk, tol = 1e-9):
+    """
+    Sources whose weights don't sum to 1 (an empty Series means counts will be conserved).
+    """
+    totals = xwalk.groupby('source')['weight'].sum()
+    return totals[(totals - 1).abs() > tol]
+
+
+def read_crosswalk(path):
+    """
+    Reads a source, target, weight crosswalk csv. Raises ValueError if a source's weights don't sum to 1.
+    """
+    xwalk = pd.read_csv(path, dtype = {'source': str, 'target': str, 'weight': float})
+    bad = check(xwalk)
+    if len(bad):
+        raise ValueError('Crosswalk weights not summing to 1 in {}: {}'.format(path, ', '.join(bad.index)))
+    return xwalk
+
+
+def rename_map(xwalk):
+    """
+    The sources moved whole onto one target, as a {source: target} dict for the linking step.
+    """
+    whole = xwalk[xwalk.groupby('source')['target'].transform('size').eq(1) & xwalk['weight'].eq(1)]
+    return dict(zip(whole['source'], whole['target']))
+
+
+def crosswalk_matrix(xwalk, sources, targets = None):
+    """
+    Sparse (target x source) matrix for reallocating arrays whose rows follow sources.
+    Sources missing from the crosswalk get an all-zero column, so they show up in the 'dropped' total of reallocate.
+    Returns the matrix and the target index.
+    """
+    sources = pd.Index(sources)
+    targets = pd.Index(pd.unique(xwalk['target'])) if targets is None else pd.Index(targets)
+
+    cols = sources.get_indexer(xwalk['source'])
+    rows = targets.get_indexer(xwalk['target'])
+    ok = (cols >= 0) & (rows >= 0)
+
+    M = sparse.csr_matrix((xwalk['weight'].values[ok], (rows[ok], cols[ok])), shape = (len(targets), len(sources)))
+    return M, targets
+
+
+def reallocate(arr, sources, xwalk, targets = None):
+    """
+    Moves a (source unit, ...) array, e.g. a county-month count array, onto the target units in one
+    sparse product. Returns the new array, the target index and the total that had no crosswalk entry.
+    """
+    M, targets = crosswalk_matrix(xwalk, sources, targets)
+    arr = np.asarray(arr, dtype = float)
+    out = M @ arr.reshape(len(sources), -1)
+
+    dropped = arr.sum() - out.sum()
+    return out.reshape((len(targets),) + arr.shape[1:]), targets, dropped
+
+
+def reallocate_table(df, xwalk, unit_col, value_cols, by = ()):
+    """
+    Same reallocation for a long table: each row is spread over its unit's targets and the values
+    are added up per target (and per the by columns, e.g. year and month).
+    """
+    merged = df.merge(xwalk, how = 'inner', left_on = unit_col, right_on = 'source')
+    merged[value_cols] = merged[value_cols].mul(merged['weight'], axis = 0)
+    return merged.groupby(['target'] + list(by), as_index = False)[value_cols].sum().rename(columns = {'target': unit_col})
+
+
+#%%
+if __name__ == '__main__':
+
+    from county_month import county_month_array
+
+    ## The historical and sub-county names of the registers
+    xwalk = read_crosswalk('county_crosswalk.csv')
+    print(xwalk.head())
+    print('{} sources, {} moved whole onto a county'.format(xwalk['source'].nunique(), len(rename_map(xwalk))))
+
+    ## A source with no population in any piece has no shares: it is dropped rather than giving NaN weights
+    print(population_crosswalk(pd.DataFrame({'source': ['a', 'a', 'b'], 'target': ['x', 'y', 'x'], 'population': [0, 0, 10]})))
+
+    rng = np.random.default_rng(0)
+    units = list(xwalk['source'].unique()) + ['Hajiabad', 'Shiraz', 'Unknown']
+    records = pd.DataFrame({'county': rng.choice(units, 1000), 'year': 2016, 'month': rng.integers(1, 13, 1000)})
+
+    arr, counties, months = county_month_array(records, county_col = 'county')
+    identity = crosswalk_from_mapping({}, identity = ['Hajiabad', 'Shiraz'])
+    new, targets, dropped = reallocate(arr, counties, pd.concat([xwalk, identity], ignore_index = True))
+    print(pd.Series(new.sum(1), index = targets).head())
+    print('Total before/after:', arr.sum(), new.sum(), 'dropped:', dropped)
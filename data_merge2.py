@@ -10,7 +10,14 @@ import os
 import pandas as pd
 import geopandas as gpd
 import numpy as np
-import Levenshtein as leven
+
+from layer_cache import read_iran
+from stage_timing import RunLog
+from validation import check, layer_rules
+from clean_pipeline import default_sources, human_branch, animal_branch, ses_branch, pop_branch, combine, analyse, validation_report, write_outputs
+
+## The cleaning steps for each dataset and the steps that combine them are in clean_pipeline.py, which
+## runs them in parallel; this script runs the same functions one after another, so both write the same tables
 
 #%%
 
@@ -23,260 +30,47 @@ fp = '/Users/finnroberts/Minnesota/2020_Spring/GEOG5541/Group/Project-Repo'
 ## Path to data on github
 url = 'https://raw.githubusercontent.com/GEOCOMP-Brucellosis-Project/Project-Repo/master/'
 
-## Read animal data and update columns
-animal_data = pd.read_csv(os.path.join(url, 'Data', 'animal_vac_data.csv'))
-animal_data.columns = [
-        'id', 'unitCode', 'unitType', 'province',
-        'county', 'livestock_type', 'time_j', 'time_g',
-        'lat' , 'long', 'n_sample', 'n_checked', 'n_infected', 
-        'n_rejected', 'n_suspicious'
-                      ]
+## Join backend: 'pandas', or 'polars' to run the joins lazily (see lazy_joins.py)
+backend = 'pandas'
+
+## Per-stage timings and memory, written to Data/runs at the end
+run = RunLog('data_merge2', out_dir = os.path.join(fp, 'Data', 'runs'))
+run.start('read_inputs')
 
-## Create new columns storing month and year of animal testing
-animal_data[['month', 'year']] = animal_data['time_g'].str.split('/', expand = True)[[0,2]]
+## Raw inputs: the registers from github, everything else from the local repository
+## (including Job_Interaction_Code.txt, county_crosswalk.csv and the census table)
+sources = default_sources(fp, url)
 
 ## Read in Iran data
 ## This is what doesn't work from github...
-#iran_data = gpd.read_file(os.path.join(url, 'Iran_shp', 'iran_admin.shp'))
-iran_data = gpd.read_file(fp + '/Iran_shp/iran_admin.shp')
-
-## Subset to relevant columns and update names
-iran_data = iran_data[['ADM2_EN','ADM2_FA','ADM1_EN','ADM1_FA','Shape_Leng','Shape_Area','geometry']]
-iran_data.columns = ['county_en', 'county_fa', 'province_en', 'province_fa', 'shape_len', 'shape_area', 'geometry']
-
-## This accidental escape sequence is problematic later, so deal with manually here
-iran_data.loc[iran_data['county_en'] == 'Yasooj\r', 'county_en'] = 'Yasooj'
-
-## Read in human data
-human_data = pd.read_csv(os.path.join(url, 'Data', 'Human_Brucellosis_2015-2018_V2.csv')).drop(['Unnamed: 18', 'Unnamed: 19'], axis = 1)
-
-human_data = human_data.rename(columns = {'Urban/Rural/Itinerant/Nomadic':'Pop_setting',
-                                          'Prepnancy':'Pregnancy',
-                                          'Occuptio':'Occupation',
-                                          'Livestock interaction history':'Livestock_int_hist',
-                                          'Livestock interaction type':'Livestock_int_type',
-                                          'Unpasteurized dairy consumption ':'Unpast_dairy',
-                                          'Other family members infection':'Fam_members_inf',
-                                          'Outbreak Year':'Outbreak_yr',
-                                          'Outbreak Month':'Outbreak_mth',
-                                          'Diagnosis Year':'Diagnosis_yr',
-                                          'Diagnosis Month':'Diagnosis_mth',
-                                          'Livestock vaccination history':'Livestock_vac_hist'})
-
-
-## Fix duplicate provinces
-human_data.loc[human_data['Province'] == 'Khorasan jonobi', 'Province'] = 'Khorasan Jonobi'
-human_data.loc[human_data['Province'] == 'Khorasan shomali', 'Province'] = 'Khorasan Shomali'
+#iran_data = gpd.read_file(data_path(url, 'Iran_shp', 'iran_admin.shp'))
+## Read through the columnar layer cache: only the columns we use, and the shapefile
+## is only decoded again when it changes. Also renames columns and fixes 'Yasooj\r'
+iran_data = read_iran(fp)
+
+## Every input is checked before it's cleaned; reports go to Data/runs/validation_<table>.csv.
+## With fail_fast = True the script stops at the first table breaking an error-level rule
+fail_fast = False
+reports = [check(iran_data, layer_rules(), 'layer', fail_fast, run.out_dir)]
+outputs = {}
+run.stop(iran_data)
 
 #%%
 
-##########################################
-## Identifying Spelling Inconsistencies ##
-
-## Function to match potential misspelled strings
-## Takes two pandas series, calculates Levenshtein distance to identify potential matches
-## Used in the likely_matches function
-def match_names(s1, s2, as_df = True, caps = True, unique = True):
-    
-    s1 = pd.Series(s1)
-    s2 = pd.Series(s2)
-    
-    ## Unique values in each series
-    vals1 = s1.unique()
-    vals2 = s2.unique()
-    
-    ## If unique argument is set to true, only match names that don't already have perfect match
-    if unique == True:
-        
-        ## Unique values in series 1 that aren't in series 2
-        vals1 = pd.Series(np.setdiff1d(vals1, vals2))
-    
-        ## Unique values in series 2 that aren't in series 1
-        vals2 = pd.Series(np.setdiff1d(vals2, vals1))
-        
-    if caps == True:
-        
-        ## Capitalize before matching
-        vals1 = vals1.str.capitalize()
-        vals2 = vals2.str.capitalize()
-        
-    ## Calculate Levenshtein distance and ratio
-    dists = np.array([leven.distance(name1, name2) for name1 in vals1 for name2 in vals2])
-    ratios = np.array([leven.ratio(name1, name2) for name1 in vals1 for name2 in vals2])
-        
-    ## Reshape and convert to df so we can identify which values are for which name combo
-    dists_df = pd.DataFrame(data = dists.reshape(len(vals1), len(vals2)), index = vals1, columns = vals2)
-    ratios_df = pd.DataFrame(data = ratios.reshape(len(vals1), len(vals2)), index = vals1, columns = vals2)
-    
-    if as_df == True:
-        
-        ## Get column names where min distance and max ratio occurs
-        matches = pd.DataFrame({'name_dist': dists_df.idxmin(axis = 1), 
-                                'name_ratio': ratios_df.idxmax(axis = 1), 
-                                'dist': dists_df.min(axis = 1), 
-                                'ratio': ratios_df.max(axis = 1)})
-    
-        return(matches)
-        
-    ## If user wants more detail, we can create a dictionary for each name that contains more graunlar info
-    ## This section creates a dictionary with names as keys and dataframes as values
-    ## Each dataframe contains all the possible name pairings (as opposed to above, which only supplies best possible values)
-    else:
-        
-        ratios_dict = {name1: ratios_df.loc[name1].sort_values(ascending = False) for name1 in vals1}
-        dists_dict = {name1: dists_df.loc[name1].sort_values() for name1 in vals1}
-        
-        comb_dict = {name1: pd.merge(dists_dict[name1], ratios_dict[name1], left_index = True, right_index = True, suffixes=('_dist', '_ratio')) for name1 in vals1}
-        
-        return(comb_dict)
-
-## Function to return highly probable string matches - the rest will have to be done manually
-## Depends on match_names function
-## The index of the resulting df contains values from the *first* series passed to the function
-def likely_matches(s1, s2, cutoff = 0.75, as_df = True, caps = True, unique = True):
-    
-    ## Create dataframe recording potential name matches
-    matched = match_names(s1, s2, as_df = as_df, caps = caps, unique = unique)
-    
-    ## Add column recording whether distance and ratio identify the same match
-    matched['name_match'] = (matched['name_dist'] == matched['name_ratio'])
-    
-    ## Can be highly confident when nameMatch = True, ratio >= .75 - this matches 145 of the 192 that need matches
-    matched['matched'] = np.where((matched['name_match'] == True) & (matched['ratio'] >= cutoff), matched['name_dist'], 'NULL')
-           
-    return(matched)
-    
-## Little helper function that creates a dictionary mapping capitalized values
-## to original values (so we can go back and forth more easily)
-def map_caps(s1):
-    
-    s1 = pd.Series(s1)
-    
-    ## Capitalize series values
-    s1_caps = s1.str.capitalize().unique()
-    
-    ## Map original values to capitalized values
-    caps_mappings = {name1:name2 for name1, name2 in zip(s1_caps, s1.unique())}
-    
-    return(caps_mappings)
-        
-#%%
-
 #########################
 ## Human Data Cleaning ##
 
-## Province Matching
-    
-provs1 = human_data.loc[human_data['Province'] != 'Null']['Province']
-provs2 = iran_data['province_en']
-
-likely_matches(provs1, provs2, caps = False)
-test = match_names(provs1, provs2, as_df = False, caps = False, unique = True)
-
-## Province matchings - this accounts for all discrepancies
-match_dict_prov = {
-    'West Azerbaijan':'Azarbaijan Gharbi',
-    'East Azerbaijan':'Azarbaijan Sharghi',
-    'Chaharmahal and Bakhtiari':'Chaharmahal & bakhtiari',
-    'Isfahan':'Esfahan',
-    'South Khorasan':'Khorasan Jonobi',
-    'North Khorasan':'Khorasan Shomali',
-    'Razavi Khorasan':'Khorasan Razavi',
-    'Kohgiluyeh and Boyer-Ahmad':'Kohgiluyeh & Boyerahmad',
-    'Kurdistan':'Kordestan',
-    'Sistan and Baluchestan':'Sistan & Bluchestan'
-              }
-
-## Invert dictionary
-match_dict_prov = {v: k for k, v in match_dict_prov.items()}
-
-## Update province names in human data with dictionary mappings
-human_data['Province'] = human_data['Province'].map(match_dict_prov).fillna(human_data['Province'])
-
-## County Matching
-
-## Remove null values for matching
-counties1 = human_data.loc[human_data['County'] != 'Null']['County']
-counties2 = iran_data['county_en']
-
-## Create mapping of likely pairs
-matched_df = likely_matches(counties1, counties2)
-#match_names(counties1, counties2, as_df = False)
-
-#matched_df[matched_df['matched'] == 'NULL']
-automatched = matched_df[matched_df['matched'] != 'NULL']
-
-## Revert automatched names back to original form data files and zip matched pairs into dictionary
-caps_mappings1 = map_caps(counties1)
-caps_mappings2 = map_caps(counties2)
-
-match_dict_cty = dict(zip(automatched.index.map(caps_mappings1), automatched['matched'].map(caps_mappings2)))
-
-## Manual matching
-match_dict_man = {
-    'Ali Abad Katul':'Aliabad', 
-    'Bafgh':'Bafq', 
-    'Bandar Qaz':'Bandar-e-Gaz', 
-    'Dailam':'Deylam',
-    'Gonbad  kavoos':'Gonbad-e-Kavus', 
-    'Ijroud':'Eejrud', 
-    'Jovein':'Jowayin',
-    'Kalale':'Kolaleh',
-    'Mahvalat':'Mahvelat', 
-    'Menojan':'Manujan', ## auto-matched incorrectly
-    'Neyshabur':'Nishapur',  
-    'Orzoieyeh':'Arzuiyeh', 
-    'Ray':'Rey', 
-    'Tehran Jonub':'Tehran', 
-    'Tehran Shomal':'Tehran', 
-    'Tiran o Karvan':'Tiran-o-Korun',
-    'Abadeh Tashk':'Abadeh',
-    'Agh Ghala':'Aqqala',
-    'Ahvaz e gharb':'Ahvaz',
-    'Ahvaz e Shargh':'Ahvaz',
-    'Gilan Qarb':'Gilan-e-Gharb',
-    'Kharame':'Kherameh',
-    'Maraqe':'Maragheh',
-    'Tehran Gharb':'Tehran',
-    'Tehran Shargh':'Tehran',
-    'Tehran Shomal Qarb':'Tehran',
-    'Zaveh':'Zave',
-    'Bandar Mahshahr':'Mahshahr',
-    'Qale ganj':'Ghaleye-Ganj',
-    'Sarchahan':'Hajiabad',
-    'Kamfirouz':'Marvdasht',
-    'Zarghan': 'Shiraz',
-    'Beyza':'Sepidan',
-    'Dore Chagni':'Doureh',
-    'Sepid Dasht':'Khorramabad',
-    'Nour Abad':'Mamasani',
-    'Aleshtar':'Selseleh',
-    'Boyerahmad':'Yasooj',
-    'Saduq':'Yazd',
-    'Mashhad Morghab':'Khorrambid',
-    'Dehdez':'Izeh',
-    'zaboli':'Mehrestan',
-    'Qaemiyeh':'Kazerun',
-    'Samen ol Aemmeh':'Mashhad',
-    'kish':'Bandar-Lengeh'
-              }
-
-match_dict_cty.update(match_dict_man) ## This now has all automatched names and manually matched names
-
-## Add all the perfect matches to this dictionary
-## Mapping dictionary now should include all matches
-perf_matches = np.intersect1d(iran_data['county_en'].str.capitalize(), human_data['County'].str.capitalize())
-
-match_dict_cty.update(dict(zip(perf_matches, perf_matches)))
-
-## Map names in dataframe based on dictionary
-human_data['County'] = human_data['County'].map(match_dict_cty).fillna(human_data['County'])
-
-## Joining ##
-human_sp_data = pd.merge(human_data, iran_data, how = 'outer', left_on = 'County', right_on = 'county_en')
-
-## Write mapping dictionary to csv for ease of QA
-# pd.DataFrame.from_dict(data=match_dict_cty, orient='index').to_csv(fp + '/human_data_mappings.csv', index_label = ['human_county'], header=['shp_county'])
+run.start('human_cleaning')
+
+## Column names, occupation and interaction type codes decoded as categoricals (Job_Interaction_Code.txt),
+## province names, then (province, county) pairs linked to the shapefile counties (place_names.py).
+## Only the manual spellings (HUMAN_MANUAL) and the crosswalk override the name matching, and are checked
+## against the record's province; other names are matched within their own province. Pairs that can't be
+## linked get no county (so they don't join to any polygon) and are written to a conflict report
+outputs.update(human_branch(iran_data, sources, backend, fail_fast, run.out_dir, log = run))
+reports.append(outputs.pop('validation_human'))
+human_sp_data = outputs['human']
+run.stop(human_sp_data)
 
 ## QUALITY ASSURANCE NOTES ##
 
@@ -287,275 +81,84 @@ human_sp_data = pd.merge(human_data, iran_data, how = 'outer', left_on = 'County
 ##########################
 ## Animal Data Cleaning ##
 
-#provs1 = animal_data['province']
-#provs2 = iran_data['province_en']
-
-#likely_matches(provs1, provs2, caps = False)
-#match_names(provs1, provs2, as_df = True, caps = False, unique = True)
-
-## Province matchings - this accounts for all discrepancies
-match_dict_prov = {
-    'West Azerbaijan':'West Azarbayjan',
-    'East Azerbaijan':'East Azarbayjan',
-    'Chaharmahal and Bakhtiari':'Chaharmahal & bakhtiari',
-    'Isfahan':'Esfahan',
-    'South Khorasan':'Khorasan Jonobi',
-    'North Khorasan':'Khorasan Shomali',
-    'Razavi Khorasan':'Khorasan Razavi',
-    'Sistan and Baluchestan':'Sistan & Bluchestan',
-    'Hamadan':'Hamedan',
-    'Kermanshan':'Kermanshah',
-    'Kohgiluyeh and Boyer-Ahmad':'Kohgiluyeh and BoyerAhmad',
-    'Kurdistan':'Kordestan',
-    'Kerman':'South Kerman'
-              }
-
-## Invert dictionary
-match_dict_prov = {v: k for k, v in match_dict_prov.items()}
-
-## Update province names in human data with dictionary mappings
-animal_data['province'] = animal_data['province'].map(match_dict_prov).fillna(animal_data['province'])
-
-
-#######################################
-## Cleaning animal data county names ##
-
-ani_cnties = animal_data['county']
-
-matched_df = likely_matches(ani_cnties, iran_data['county_en'])
-#match_names(ani_cnties, counties2, as_df = False)
-
-ani_caps_mappings = map_caps(ani_cnties)
-
-automatched = matched_df[matched_df['matched'] != 'NULL']
-#unmatched = matched_df[matched_df['matched'] == 'NULL']
-
-## Start mapping dictionary with the automatched names
-match_dict_ani = dict(zip(automatched.index.map(ani_caps_mappings), automatched['matched'].map(caps_mappings2)))
+run.start('animal_cleaning')
 
-## Manually updated name mappings
-match_dict_man_ani = {
-    'Aran and Bidgol':'Aran-o-Bidgol',
-    'Buin and Miandasht':'Booeino Miyandasht',
-    'Deyr':'Dayyer',
-    'Haftkel':'Haftgol',
-    'Ijrud':'Eejrud',
-    'Maneh asd Samalgan':'Maneh-o-Samalqan',
-    'Orzueeyeh':'Arzuiyeh',
-    'Qaleh Ganj':'Ghaleye-Ganj',
-    'Qir and Karzin':'Qir-o-Karzin',
-    'Raz and Jargalan':'Razo Jalgelan',
-    'Sib and Suran':'Sibo Soran',
-    'Tiran and Karvan':'Tiran-o-Korun',
-    'Torqebeh and Shandiz(Binalud)':'Torghabe-o-Shandiz',
-    'Zaveh':'Zave',
-    'Chardavol':'Shirvan-o-Chardavol',
-    'Torkaman':'Bandar-e-Torkaman',
-    'mahshahr':'Mahshahr',
-    'Jafarieh':'Torbat-e-Jam',
-    'Kahak':'Sabzevar',
-    'Kohgiluyeh and BoyerAhmad':'Kohgeluyeh',
-    'BoyerAhmad':'Yasooj'
-              }
-
-match_dict_ani.update(match_dict_man_ani)
-
-#unmatched2 = [name for name in unmatched.index.map(ani_caps_mappings) if not name in match_dict_ani.keys()]
-
-## Add identical matches to the dictionary
-perf_matches = np.intersect1d(iran_data['county_en'], animal_data['county'])
-match_dict_ani.update(dict(zip(perf_matches, perf_matches)))
-
-## Update county names in animal data and do the join
-animal_data['county'] = animal_data['county'].map(match_dict_ani).fillna(animal_data['county'])
-
-ani_sp_data = pd.merge(animal_data, iran_data, how = 'outer', left_on = 'county', right_on = 'county_en')
-
-
-## Sum infection data grouped by county, year, and month and remerge on animal data
-ani_sp_data_grp = ani_sp_data.groupby(['county', 'year', 'month'], as_index = False)[ani_sp_data.columns[10:15]].sum()
-ani_sp_data = pd.merge(ani_sp_data, ani_sp_data_grp, how = 'left')
-
-## Calculate infection rate
-ani_sp_data['animal_inf_rate'] = ani_sp_data['n_infected']/ani_sp_data['n_sample']
-
-
-## Write mapping dictionary to csv for ease of QA
-# pd.DataFrame.from_dict(data=match_dict_ani, orient='index').to_csv(fp + '/animal_data_mappings.csv', index_label = ['animal_county'], header = ['shp_county'])
+## Province names and county links as for the human data (ANIMAL_MANUAL and the crosswalk), also
+## using whether the test locations fall inside the county. Test counts are summed by county and month
+## (and livestock type) with infection and rejection rates, one row per group
+outputs.update(animal_branch(iran_data, sources, backend, fail_fast, run.out_dir, log = run))
+reports.append(outputs.pop('validation_animal'))
+ani_sp_data = outputs['animal']
+run.stop(ani_sp_data)
 
 #%%
 
 #######################
 ## SES Data Cleaning ##
 
-## Read in SES data and rename columns
-ses_data = pd.read_csv(os.path.join(fp, 'Data', 'ses_data.csv'))
-ses_data.columns = ['province', 'pop', 'hshld_size', 'ses']
-
-## Get province names
-ses_provs = ses_data['province'].unique()
-
-## Automatch ses names to spatial data province names
-ses_matches = likely_matches(ses_provs, iran_data['province_en'].unique())
-
-## Maps from matched names back to uncapitalized names
-ses_caps_map = map_caps(ses_provs)
-iran_prov_map = map_caps(iran_data['province_en'].unique())
-
-## Determine names that were successfully matched
-automatched = ses_matches[ses_matches['matched'] != 'NULL']
-
-## Create dictionary mapping ses names to spatial data names and update ses_data
-match_dict_ses = dict(zip(automatched.index.map(ses_caps_map), automatched['matched'].map(iran_prov_map)))
-ses_data['province'] = ses_data['province'].map(match_dict_ses).fillna(ses_data['province'])
-
-## Join data
-ses_sp_data = pd.merge(ses_data, iran_data, how = 'outer', left_on = 'province', right_on = 'province_en')
+run.start('ses_cleaning')
 
+## Automatch ses names to spatial data province names and join
+outputs.update(ses_branch(iran_data, sources, backend, fail_fast, run.out_dir, log = run))
+reports.append(outputs.pop('validation_ses'))
+ses_sp_data = outputs['ses']
+run.stop(ses_sp_data)
 
 #%%
 
 ## Joining county population data
 
-## Read in population data and clean strings
-pop_data = pd.read_csv(os.path.join(fp, 'Data', 'pop_by_county.csv'), skiprows = [1, 2, 3, 4], usecols = [0, 1])
-
-pop_data = pop_data.drop(pop_data[pop_data['Description'].str.contains("Setteled", case = False)].index)
-pop_data = pop_data.drop(pop_data[pop_data['Description'].str.contains("Settled", case = False)].index)
-
-pop_data['Description'] = pop_data['Description'].str.strip()
-pop_data['Population'] = pop_data['Population'].str.replace(',', '').astype(int)
-
-## Need to append provinces and counties from iran_data because the pop data is not separated by prov/county
-provs = iran_data['province_en']
-cts = iran_data['county_en']
-
-all_names = provs.append(cts)
-
-## Auto-match names
-matched_df = likely_matches(pop_data['Description'], all_names)
-
-## Map original data names to capitalized names
-pop_caps_mappings = map_caps(pop_data['Description'])
-iran_caps_mappings = map_caps(all_names)
-
-## Identify automatched and unmatched names
-automatched = matched_df[matched_df['matched'] != 'NULL']
-unmatched = matched_df[matched_df['matched'] == 'NULL']
-
-## Start match dictionary with automatched names
-match_dict_pop = dict(zip(automatched.index.map(pop_caps_mappings), automatched['matched'].map(iran_caps_mappings)))
-
-## Manually updated name mappings
-match_dict_man_pop = {
-    'Arzooeyeh':'Arzuiyeh',
-    'Bafgh':'Bafq',
-    'Boyerahmad':'Yasooj',
-    'Firooze':'Firuzeh',
-    'Ijerud':'Eejrud',
-    'Ivan':'Eyvan',
-    'Jovin':'Jowayin',
-    'Mayamee':'Meyami',
-    'Naeen':'Nain',
-    'Neemrooz':'Nimrouz',
-    'Neyshabur':'Nishapur',
-    'Torkaman':'Bandar-e-Torkaman',
-    'Zaveh':'Zave',
-    'Khorasan-e-Razavi':'Razavi Khorasan',
-    'Qaleh-Ganj':'Ghaleye-Ganj',
-    'Qaser-e Qand':'Ghasre Ghand',
-    'Raz & Jargalan':'Razo Jalgelan',
-    'Reegan':'Rigan',
-    'Savadkuh-e Shomali':'Northern Savadkooh',
-    'Sireek':'Sirik',
-    'Sumaehsara':'Some\'e-Sara',
-    'Tiran & Karvan':'Tiran-o-Korun',
-    'Zeerkooh':'Zirkouh',
-    'Bandar-e-Mahshahr':'Mahshahr',
-    'Bon':'Ben',
-    'Chardavel':'Shirvan-o-Chardavol',
-    'Fonuch':'Fanouj',
-    'Keyar':'Kiaar',
-    'Qayenat':'Qaen',
-    'Qods':'Shahr-e Qods',
-    'Sibsavaran':'Sibo Soran',
-    'Kordestan':'Kurdistan',
-    'Binalood':'Torghabe-o-Shandiz',
-    'Nayer':'Nir'
-              }
-
-## Update dictionary with manual matches
-match_dict_pop.update(match_dict_man_pop)
-
-## Still unmatched:
-#unmatched2 = [name for name in unmatched.index.map(pop_caps_mappings) if not name in match_dict_pop.keys()]
-
-## Add identical matches to dictionary
-perf_matches = np.intersect1d(all_names, pop_data['Description'])
-match_dict_pop.update(dict(zip(perf_matches, perf_matches)))
-
-pop_data['Mapped'] = pop_data['Description'].map(match_dict_pop)
-
-## Write mappings to file for reference
-#pd.DataFrame.from_dict(data=match_dict_pop, orient='index').to_csv(fp + '/pop_data_mappings.csv', index_label = ['pop_county'], header = ['shp_county'])
-
-## Disentangling instances where provinces and county names match:
-
-## Identify duplicate names
-dup_names = pop_data[pd.DataFrame.duplicated(pop_data, 'Description')][['Description','Mapped']]
-
-## Sort by population. We know that the first entry for each name will be the province pop
-## and the second entry will be the county prop since prov pop >= county pop
-dup_vals = pop_data[pop_data['Description'].isin(dup_names['Description'])].sort_values(by = ['Description','Population'], ascending=[True, False])
-dup_vals['Geog_region'] = np.resize(['Province','County'], len(dup_vals))
-
-## Tagging each name as either province or county
-dup_pop_data_provs = dup_vals[dup_vals['Geog_region'] == 'Province']
-nondup_pop_data_provs = pop_data[pop_data['Mapped'].isin(provs.sort_values().unique()) & (~pop_data['Description'].isin(dup_pop_data_provs['Description']))]
-nondup_pop_data_provs['Geog_region'] = 'Province'
-
-## Merge back on population data - now everything is tagged to indicate province or county
-merge1 = pd.merge(nondup_pop_data_provs, dup_vals, how='outer')
-merge2 = pd.merge(merge1, pop_data, how='outer')
-
-## Drop provinces - we only want counties
-pop_data_cts_only = merge2[merge2['Geog_region']!='Province'][['Mapped','Population']]
-
-## Add independently gathered data for counties not present in the population data 
-missing_vals = pd.DataFrame([['Urumia', 736224], ['Khusf', 24922]], columns = list(['Mapped', 'Population']))
-pop_data_cts_only = pop_data_cts_only.append(missing_vals).reset_index(drop = True)
-
-## Merge with spatial data on county name
-pop_sp_data = pd.merge(pop_data_cts_only, iran_data, how = 'outer', left_on = 'Mapped', right_on = 'county_en')
-
-## Drop erroneous row - results from original pop_data file having this entry listed twice.
-pop_sp_data = pop_sp_data[pop_sp_data['Mapped']!='Razavi Khorasan']
+run.start('pop_cleaning')
 
+## Parse the census hierarchy (provinces are found by their counties adding up to them, not by name)
+## and link counties to the shapefile within their province, keyed by county ID
+## Urumia and Khusf no longer need adding by hand: they were mapped to the wrong counties before
+outputs.update(pop_branch(iran_data, sources, backend, fail_fast, run.out_dir, log = run))
+reports.append(outputs.pop('validation_pop'))
+pop_sp_data = outputs['pop']
+run.stop(pop_sp_data)
 
-#%%
+outputs['validation'] = validation_report(reports, run.out_dir)
 
-'''
-## Write files
-human_sp_data = gpd.GeoDataFrame(human_sp_data, crs = 'EPSG:4326', geometry = 'geometry')
-human_sp_data.to_file(os.path.join(fp, 'human_shp', 'human_data_clean.shp'))
+#%%
 
-ani_sp_data = gpd.GeoDataFrame(ani_sp_data, crs = 'EPSG:4326', geometry = 'geometry')
-ani_sp_data.to_file(os.path.join(fp, 'animal_shp', 'animal_data_clean.shp'))
+## Vaccination coverage per county-month (animal_vac_data.csv has no vaccinated count, so only the
+## tested/infected animals by livestock type and the share of human cases reporting vaccinated livestock),
+## human incidence per 100,000 over each month's population and the animal infection rate, with their
+## empirical Bayes and spatially smoothed versions (<rate>_ebg, <rate>_ebl, <rate>_sm), the 2009-2011
+## national cases moved onto today's counties through the area crosswalk between the 2011 and current
+## boundaries (national_0911.py), and the Data for Katharine table from the risk factor cube (see clean_pipeline.combine)
+
+run.start('combine')
+outputs = combine(outputs, iran_data, fp, backend)
+hum_cm_data = outputs['human_county_month']
+ani_cm_data = outputs['animal_county_month']
+nat_cm_data = outputs['national_county_month']
+toWrite = outputs['dataForKatharine']
+run.stop(hum_cm_data)
 
-ses_sp_data = gpd.GeoDataFrame(ses_sp_data, crs = 'EPSG:4326', geometry = 'geometry')
-ses_sp_data.to_file(os.path.join(fp, 'ses_shp', 'ses_data_clean.shp'))
-'''
+#%%
 
-## Data for Katharine
-counts_by_group = human_sp_data.groupby(['county_en','province_en', 'Livestock_int_hist','Livestock_vac_hist','Pop_setting']).size().reset_index(name='count') 
-county_obs = human_sp_data.groupby(['county_en']).size().reset_index(name='county_count')
+## Space-time clusters of human cases (space_time_scan.py): circles of nearby counties holding up to 10% of
+## the population over windows of up to 12 months, with Monte Carlo p-values from 999 replicates (a few minutes).
+## Correlation between the animal infection rate and human incidence 0-24 months later, pooled over counties
+## and per county, with distributed lag coefficients (lag_correlation.py) and p-values from 999 permutations
 
-count_df = pd.merge(counts_by_group, county_obs)
+run.start('analyse')
+outputs = analyse(outputs, iran_data, replicates = 999)
+clusters = outputs['human_clusters']
+lag_data = outputs['lag_correlation']
+run.stop(clusters)
 
-count_df = pd.merge(count_df, pop_sp_data[['county_en','Population']], how='outer', on ='county_en')
+#%%
 
-count_df['inf_rate'] = count_df['count']/count_df['Population']
+## Write files
+## Typed tables with the county polygons stored once (see clean_outputs.py), the conflict reports
+## and dataForKatharine.csv, which is still read by the notebooks
 
-toWrite = pd.merge(count_df, ses_sp_data[['county_en','ses']], how='outer', on='county_en')
+run.start('write_outputs')
+write_outputs(outputs, iran_data, fp, os.path.join(fp, 'Data', 'clean'))
+run.stop(toWrite)
 
-toWrite.to_csv(os.path.join(fp, 'Data', 'dataForKatharine.csv'))
+print(run.summary())
+run.write()
@@ -12,6 +12,10 @@ import geopandas as gpd
 import numpy as np
 import Levenshtein as leven
 
+from layer_cache import read_iran
+from lazy_joins import outer_join
+from animal_aggregation import aggregate_animal, check_totals
+
 #%%
 
 #####################
@@ -25,6 +29,9 @@ fp = os.getcwd() #'/Users/finnroberts/Minnesota/2020_Spring/GEOG5541/Group/Proje
 ## Path to data on github
 #url = 'https://raw.githubusercontent.com/GEOCOMP-Brucellosis-Project/Project-Repo/master/'
 
+## Join backend: 'pandas', or 'polars' to run the joins lazily (see lazy_joins.py)
+backend = 'pandas'
+
 ## Read animal data and update columns
 animal_data = pd.read_csv(os.path.join(fp, 'Data', 'animal_vac_data.csv'))
 animal_data.columns = [
@@ -37,23 +44,12 @@ animal_data.columns = [
 ## Create new columns storing month and year of animal testing
 animal_data[['month', 'year']] = animal_data['time_g'].str.split('/', expand = True)[[0,2]]
 
-## Sum infection data grouped by county, year, and month
-animal_data_grp = animal_data.groupby(['county', 'year', 'month'], as_index = False)[animal_data.columns[10:15]].sum().merge(animal_data)
-
-## Calculate infection rate
-animal_data_grp['animal_inf_rate'] = animal_data_grp['n_infected']/animal_data['n_sample']
-
 ## Read in Iran data
 ## This is what doesn't work from github...
 #iran_data = gpd.read_file(os.path.join(url, 'Iran_shp', 'iran_admin.shp'))
-iran_data = gpd.read_file(fp + '/Iran_shp/iran_admin.shp')
-
-## Subset to relevant columns and update names
-iran_data = iran_data[['ADM2_EN','ADM2_FA','ADM1_EN','ADM1_FA','Shape_Leng','Shape_Area','geometry']]
-iran_data.columns = ['county_en', 'county_fa', 'province_en', 'province_fa', 'shape_len', 'shape_area', 'geometry']
-
-## This accidental escape sequence is problematic later, so deal with manually here
-iran_data.loc[iran_data['county_en'] == 'Yasooj\r', 'county_en'] = 'Yasooj'
+## Read through the columnar layer cache: only the columns we use, and the shapefile
+## is only decoded again when it changes. Also renames columns and fixes 'Yasooj\r'
+iran_data = read_iran(fp)
 
 ## Read in human data
 human_data = pd.read_csv(os.path.join(fp, 'Data', 'Human_Brucellosis_2015-2018_V3.csv'))
@@ -281,7 +277,7 @@ match_dict_cty.update(dict(zip(perf_matches, perf_matches)))
 human_data['County'] = human_data['County'].map(match_dict_cty).fillna(human_data['County'])
 
 ## Joining ##
-human_sp_data = pd.merge(human_data, iran_data, how = 'outer', left_on = 'County', right_on = 'county_en')
+human_sp_data = outer_join(human_data, iran_data, 'County', 'county_en', backend = backend)
 
 ## Write mapping dictionary to csv for ease of QA
 # pd.DataFrame.from_dict(data=match_dict_cty, orient='index').to_csv(fp + '/human_data_mappings.csv', index_label = ['human_county'], header=['shp_county'])
@@ -374,9 +370,14 @@ match_dict_ani.update(match_dict_man_ani)
 perf_matches = np.intersect1d(iran_data['county_en'], animal_data['county'])
 match_dict_ani.update(dict(zip(perf_matches, perf_matches)))
 
-## Update county names in animal data and do the join
+## Update county names in animal data
 animal_data['county'] = animal_data['county'].map(match_dict_ani).fillna(animal_data['county'])
-ani_sp_data = pd.merge(animal_data, iran_data, how = 'outer', left_on = 'county', right_on = 'county_en')
+
+## County-month test totals with infection and rejection rates, computed on the matched county names
+## (one named-column groupby, no merge back onto the records). The environmental data is added to
+## these and they are joined to the counties in the env section below
+animal_data_grp = aggregate_animal(animal_data)
+check_totals(animal_data, animal_data_grp)
 
 ## Write mapping dictionary to csv for ease of QA
 # pd.DataFrame.from_dict(data=match_dict_ani, orient='index').to_csv(fp + '/animal_data_mappings.csv', index_label = ['animal_county'], header = ['shp_county'])
@@ -408,7 +409,7 @@ match_dict_ses = dict(zip(automatched.index.map(ses_caps_map), automatched['matc
 ses_data['province'] = ses_data['province'].map(match_dict_ses).fillna(ses_data['province'])
 
 ## Join data
-ses_sp_data = pd.merge(ses_data, iran_data, how = 'outer', left_on = 'province', right_on = 'province_en')
+ses_sp_data = outer_join(ses_data, iran_data, 'province', 'province_en', backend = backend)
 
 #%%
 
@@ -454,12 +455,17 @@ envData = pd.read_csv(envFP, index_col='ADM2_EN')
 human_sp_data.loc[pd.isna(human_sp_data['Outbreak_yr']), 'Outbreak_yr']='Null'
 addGregorian(human_sp_data, 'Outbreak_yr', 'Outbreak_mth')
 
-## Clean up animal data
-ani_sp_data.rename(columns={"county": "County"}, inplace=True)
+## Clean up animal data: the county-month totals, with two digit years and months as strings for addEnvData
+animal_data_grp = animal_data_grp.rename(columns={"county": "County"})
+animal_data_grp['year'] = (animal_data_grp['year'] % 100).astype(str).str.zfill(2)
+animal_data_grp['month'] = animal_data_grp['month'].astype(str)
 
 #addEnvData(human_sp_data, envData, 'year', 'month')
 addEnvData(human_sp_data, envData, 'year', 'month')
-addEnvData(ani_sp_data, envData, 'year', 'month')
+addEnvData(animal_data_grp, envData, 'year', 'month')
+
+## Join the county-month totals and their environmental data to the counties
+ani_sp_data = outer_join(animal_data_grp, iran_data, 'County', 'county_en', backend = backend)
 
 #%%
 
@@ -568,7 +574,7 @@ merge2 = pd.merge(merge1, pop_data, how='outer')
 pop_data_cts_only = merge2[merge2['Geog_region']!='Province'][['Mapped','Population']]
 
 ## Merge with spatial data on county name
-pop_sp_data = pd.merge(pop_data_cts_only, iran_data, how = 'outer', left_on = 'Mapped', right_on = 'county_en')
+pop_sp_data = outer_join(pop_data_cts_only, iran_data, 'Mapped', 'county_en', backend = backend)
 
 ## Drop erroneous row - results from original pop_data file having this entry listed twice.
 pop_sp_data = pop_sp_data[pop_sp_data['Mapped']!='Razavi Khorasan']
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Local cache of Earth Engine regional reductions
+
+getYearlyParams rebuilds the filtered collection and sends a reduceRegions/getInfo round trip
+for every month on every run, and asks again when the same month is needed for another
+region set. Each reduction is stored here as a small parquet file named by the hash of what
+determines its result:
+
+    collection ID, date, composite/reducer, scale, bands, geometry-set hash
+
+so a repeat extraction is read from disk and never reaches the EE service:
+
+    cache = ReductionCache()
+    key = reduction_key('ECMWF/ERA5/MONTHLY', '2008-01', 'first/mean', 'native',
+                        ['mean_2m_air_temperature'], geometry_hash(iran))
+    params = cache.get_or_compute(key, lambda: imageParams(image, iran))
+
+Entries older than max_age_days are dropped (assets can be reprocessed upstream) and the
+least recently used ones go once the cache is over max_mb. Nothing here needs the ee package;
+ee objects are only hashed through their serialize() expression.
+"""
+
+import os
+import json
+import time
+import hashlib
+import pandas as pd
+
+
+## Default cache folder (Data/cache is already git-ignored), relative to the working directory when the cache is made
+CACHE_DIR = os.path.join('Data', 'cache', 'ee')
+
+
+######### Functions #############
+def _sha1(text):
+    return hashlib.sha1(text.encode('utf-8') if isinstance(text, str) else text).hexdigest()
+
+
+def geometry_hash(regions):
+    """
+    Hash of a region set: an ee.FeatureCollection (its serialized expression, i.e. asset ID and
+    selections), a GeoDataFrame / GeoSeries (its geometries as WKB) or a plain string ID.
+    """
+    if isinstance(regions, str):
+        return _sha1(regions)
+    if hasattr(regions, 'serialize'):
+        return _sha1(regions.serialize())
+    geoms = regions.geometry if hasattr(regions, 'geometry') else regions
+    h = hashlib.sha1()
+    for wkb in geoms.to_wkb():
+        h.update(wkb)
+    return h.hexdigest()
+
+
+def reduction_key(collection, date, reducer, scale, bands, geometry):
+    """
+    Content address of one regional reduction. collection is an asset ID (or an ee object,
+    hashed by its expression), date a 'YYYY-MM' string (None for a single image), geometry a
+    geometry_hash.
+    """
+    if not isinstance(collection, str):
+        collection = geometry_hash(collection)
+    fields = {'collection': collection, 'date': date, 'reducer': str(reducer), 'scale': str(scale),
+              'bands': sorted(bands) if bands else None, 'geometry': geometry}
+    return _sha1(json.dumps(fields, sort_keys = True))
+
+
+class ReductionCache:
+    """
+    Reductions stored as <cache_dir>/<key[:2]>/<key>.parquet, evicted by age and total size.
+    """
+    def __init__(self, cache_dir = CACHE_DIR, max_mb = 500, max_age_days = 90):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_mb*2**20
+        self.max_age = max_age_days*86400
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.parquet')
+
+    def get(self, key):
+        """
+        The cached frame, or None if absent or expired.
+        """
+        path = self._path(key)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if time.time() - st.st_mtime > self.max_age:
+            os.remove(path)
+            return None
+        ## Access time marks recent use for eviction (set explicitly, since mounts are often noatime)
+        os.utime(path, (time.time(), st.st_mtime))
+        return pd.read_parquet(path)
+
+    def put(self, key, df):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        tmp = path + '.tmp'
+        df.to_parquet(tmp, index = False)
+        os.replace(tmp, path)
+        self.evict()
+
+    def get_or_compute(self, key, compute):
+        """
+        Cached result for key, or compute() stored under key.
+        """
+        df = self.get(key)
+        if df is not None:
+            self.hits += 1
+            return df
+        self.misses += 1
+        df = compute()
+        self.put(key, df)
+        return df
+
+    def entries(self):
+        """
+        One row per cached file: key, bytes, last used and written times.
+        """
+        rows = []
+        if os.path.isdir(self.cache_dir):
+            for sub in os.scandir(self.cache_dir):
+                if sub.is_dir():
+                    for f in os.scandir(sub.path):
+                        if f.name.endswith('.parquet'):
+                            st = f.stat()
+                            rows.append({'key': f.name[:-8], 'path': f.path, 'bytes': st.st_size,
+                                         'used': st.st_atime, 'written': st.st_mtime})
+        return pd.DataFrame(rows, columns = ['key', 'path', 'bytes', 'used', 'written'])
+
+    def evict(self):
+        """
+        Removes expired entries, then the least recently used until the cache fits max_mb. Returns the number removed.
+        """
+        ent = self.entries()
+        old = ent['written'] < time.time() - self.max_age
+        ent = ent.sort_values('used', ascending = False)
+        over = ent.loc[~old, 'bytes'].cumsum() > self.max_bytes
+        drop = ent.loc[old].index.union(over[over].index)
+        for path in ent.loc[drop, 'path']:
+            os.remove(path)
+        return len(drop)
+
+    def clear(self):
+        for path in self.entries()['path']:
+            os.remove(path)
+
+
+#%%
+if __name__ == '__main__':
+
+    import tempfile
+    import numpy as np
+
+    counties = 'users/tannerjohnson56/iran_admin'
+    buffers = 'animal_test_points_5km'
+
+    def fake_reduce(n):
+        ## Stands in for imageParams: ~0.2s per EE round trip
+        time.sleep(0.2)
+        return pd.DataFrame({'ADM2_EN': ['c{}'.format(i) for i in range(n)], 'NDVI': np.random.default_rng(0).random(n)})
+
+    cache = ReductionCache(tempfile.mkdtemp(), max_mb = 0.2)
+    for run in range(2):
+        t0 = time.perf_counter()
+        for regions in [counties, buffers]:
+            for month in range(1, 13):
+                key = reduction_key('NOAA/CDR/AVHRR/NDVI/V5', '2008-{:02d}'.format(month), 'mean/mean', 'native', ['NDVI'], geometry_hash(regions))
+                cache.get_or_compute(key, lambda: fake_reduce(429))
+        print('run {}: {:.2f}s  hits {}  misses {}'.format(run, time.perf_counter() - t0, cache.hits, cache.misses))
+
+    ent = cache.entries()
+    print('{} entries, {:.0f} kB'.format(len(ent), ent['bytes'].sum()/1024))
+
+    cache.max_bytes = 100*1024
+    print('shrunk to 100 kB: {} evicted, {} left'.format(cache.evict(), len(cache.entries())))
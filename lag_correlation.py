@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Human-animal lagged correlation
+
+Relates county animal infection rates to human incidence for lags of 0-24 months.
+Everything is computed on (county, month) arrays: the lagged sums for every county
+and every lag come out of one FFT cross-correlation, so there are no loops over
+counties or lags. Significance comes from permuting which county's animal series
+is paired with which county's human series.
+"""
+
+import numpy as np
+import pandas as pd
+
+from county_month import county_month_array, month_key
+
+
+######### Functions #############
+def animal_human_arrays(human_sp_data, ani_sp_data, pop_sp_data, counties = None, months = None):
+    """
+    Builds aligned (county, month) arrays of human incidence per 100,000 and animal infection rate.
+    human_sp_data needs gregorian 'year'/'month' columns (see addGregorian).
+    Animal cells with no samples are NaN rather than 0, so they drop out of the correlations.
+    Returns animal rate, human incidence, county index and month keys.
+    """
+    cases, counties, months = county_month_array(human_sp_data, counties = counties, months = months)
+    infected, _, _ = county_month_array(ani_sp_data, 'n_infected', counties = counties, months = months)
+    sampled, _, _ = county_month_array(ani_sp_data, 'n_sample', counties = counties, months = months)
+
+    pop = pop_sp_data.drop_duplicates('county_en').set_index('county_en')['Population'].reindex(counties).values.astype(float)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        animal = np.where(sampled > 0, infected/sampled, np.nan)
+        human = 100000*cases/pop[:, None]
+
+    return animal, human, counties, months
+
+
+def county_month_rates(hum_cm_data, ani_cm_data, counties = None):
+    """
+    Aligned (county, month) arrays of human incidence per 100,000 and animal infection rate from the
+    county-month tables (human_county_month: county_en, cases, population; animal_county_month: county,
+    n_infected, n_sample), over the months of both. Cells without a population or without samples are NaN.
+    Returns animal rate, human incidence, county index and month keys.
+    """
+    keys = np.concatenate([month_key(hum_cm_data['year'], hum_cm_data['month']),
+                           month_key(ani_cm_data['year'], ani_cm_data['month'])])
+    months = np.arange(np.nanmin(keys), np.nanmax(keys) + 1, dtype = int)
+
+    cases, counties, months = county_month_array(hum_cm_data, 'cases', counties = counties, months = months)
+    pop, _, _ = county_month_array(hum_cm_data, 'population', counties = counties, months = months)
+    infected, _, _ = county_month_array(ani_cm_data, 'n_infected', county_col = 'county', counties = counties, months = months)
+    sampled, _, _ = county_month_array(ani_cm_data, 'n_sample', county_col = 'county', counties = counties, months = months)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        animal = np.where(sampled > 0, infected/sampled, np.nan)
+        human = np.where(pop > 0, 100000*cases/pop, np.nan)
+
+    return animal, human, counties, months
+
+
+def _xcorr(F, G, nfft, max_lag):
+    """
+    Lagged cross sums from precomputed rffts: out[..., k] = sum_t f[t]*g[t+k] for k = 0..max_lag.
+    """
+    return np.fft.irfft(np.conj(F)*G, nfft)[..., :max_lag + 1]
+
+
+def _spectra(x, nfft):
+    """
+    rffts of the mask, values and squared values of an array with NaNs for missing cells.
+    """
+    m = np.isfinite(x)
+    x = np.where(m, x, 0.0)
+    return np.stack([np.fft.rfft(m.astype(float), nfft), np.fft.rfft(x, nfft), np.fft.rfft(x*x, nfft)])
+
+
+def _moments(A, H, nfft, max_lag):
+    """
+    Pair counts and centred (co)variance sums per county and lag from the animal and human spectra.
+    """
+    n = np.round(_xcorr(A[0], H[0], nfft, max_lag))
+    sx = _xcorr(A[1], H[0], nfft, max_lag)
+    sy = _xcorr(A[0], H[1], nfft, max_lag)
+    sxx = _xcorr(A[2], H[0], nfft, max_lag)
+    syy = _xcorr(A[0], H[2], nfft, max_lag)
+    sxy = _xcorr(A[1], H[1], nfft, max_lag)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        cov = np.where(n > 0, sxy - sx*sy/n, 0.0)
+        vx = np.where(n > 0, sxx - sx*sx/n, 0.0)
+        vy = np.where(n > 0, syy - sy*sy/n, 0.0)
+
+    return n, cov, vx, vy
+
+
+def _corr(cov, vx, vy):
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        r = cov/np.sqrt(vx*vy)
+    return np.where(np.isfinite(r), r, np.nan)
+
+
+def lagged_xcorr(animal, human, max_lag = 24, permutations = 999, seed = 0, batch = 20):
+    """
+    Correlation between animal rate at month t and human incidence at month t+lag, lag = 0..max_lag.
+    animal and human are (county, month) arrays on the same axes; NaN cells are skipped.
+
+    Returns two arrays of shape (county, lag) - correlation and pair count - and a dataframe
+    with the pooled within-county correlation for each lag and its permutation p-value.
+    When permutations > 0 a per-county permutation p-value array is returned as well (otherwise None).
+    """
+    animal = np.asarray(animal, dtype = float)
+    human = np.asarray(human, dtype = float)
+    n_cty, n_mth = animal.shape
+    max_lag = min(max_lag, n_mth - 1)
+
+    ## Zero pad to at least 2T so the circular FFT correlation doesn't wrap around
+    nfft = 1 << int(np.ceil(np.log2(2*n_mth)))
+    A = _spectra(animal, nfft)
+    H = _spectra(human, nfft)
+
+    n, cov, vx, vy = _moments(A, H, nfft, max_lag)
+    r = _corr(cov, vx, vy)
+    pooled = _corr(cov.sum(0), vx.sum(0), vy.sum(0))
+
+    summary = pd.DataFrame({'lag': np.arange(max_lag + 1), 'r': pooled, 'n_pairs': n.sum(0).astype(int)})
+
+    if permutations <= 0:
+        return r, n, summary, None
+
+    ## Null: shuffle which county's animal series goes with each human series
+    ## The animal spectra are computed once and just reindexed per permutation
+    rng = np.random.default_rng(seed)
+    exceed_pooled = np.zeros(max_lag + 1)
+    exceed_cty = np.zeros((n_cty, max_lag + 1))
+
+    for start in range(0, permutations, batch):
+        size = min(batch, permutations - start)
+        perms = np.argsort(rng.random((size, n_cty)), axis = 1)
+
+        _, cov_p, vx_p, vy_p = _moments(A[:, perms], H[:, None], nfft, max_lag)
+        r_p = _corr(cov_p, vx_p, vy_p)
+        pooled_p = _corr(cov_p.sum(1), vx_p.sum(1), vy_p.sum(1))
+
+        exceed_pooled += (np.abs(pooled_p) >= np.abs(pooled)).sum(0)
+        exceed_cty += (np.abs(r_p) >= np.abs(r)).sum(0)
+
+    summary['p_sim'] = (exceed_pooled + 1)/(permutations + 1)
+    p_cty = np.where(np.isnan(r), np.nan, (exceed_cty + 1)/(permutations + 1))
+
+    return r, n, summary, p_cty
+
+
+def _lag_design(animal, human, max_lag):
+    """
+    Stacks every county's lagged animal values into one design matrix, demeaned within county.
+    Row (c, t) holds animal[c, t], animal[c, t-1], ..., animal[c, t-max_lag] for human[c, t].
+    """
+    n_cty = animal.shape[0]
+
+    ## window[c, t, j] = animal[c, t+j]; reversing j gives lag order
+    X = np.lib.stride_tricks.sliding_window_view(animal, max_lag + 1, axis = 1)[:, :, ::-1]
+    y = human[:, max_lag:]
+
+    ok = np.isfinite(X).all(2) & np.isfinite(y)
+    cty = np.broadcast_to(np.arange(n_cty)[:, None], ok.shape)[ok]
+    X = X[ok]
+    y = y[ok]
+
+    ## County fixed effects by subtracting county means
+    cnt = np.bincount(cty, minlength = n_cty)
+    cnt = np.where(cnt == 0, 1, cnt)
+    sums = np.zeros((n_cty, X.shape[1]))
+    np.add.at(sums, cty, X)
+    X = X - (sums/cnt[:, None])[cty]
+    y = y - (np.bincount(cty, y, n_cty)/cnt)[cty]
+
+    return X, y
+
+
+def distributed_lag(animal, human, max_lag = 24, permutations = 999, seed = 0):
+    """
+    Fits human[c, t] = a_c + sum_k b_k*animal[c, t-k] over all counties at once (k = 0..max_lag),
+    with county fixed effects. Returns a dataframe of lag coefficients with permutation p-values,
+    using the same county-shuffling null as lagged_xcorr (NaN when no county-month has every lag).
+    """
+    animal = np.asarray(animal, dtype = float)
+    human = np.asarray(human, dtype = float)
+    max_lag = min(max_lag, animal.shape[1] - 1)
+
+    X, y = _lag_design(animal, human, max_lag)
+    coef = np.linalg.lstsq(X, y, rcond = None)[0] if len(y) else np.full(max_lag + 1, np.nan)
+
+    out = pd.DataFrame({'lag': np.arange(max_lag + 1), 'coefficient': coef})
+    out.attrs['n_obs'] = len(y)
+
+    ## No county has max_lag + 1 sampled months in a row
+    if not len(y):
+        out['p_sim'] = np.nan
+        return out
+    if permutations <= 0:
+        return out
+
+    rng = np.random.default_rng(seed)
+    exceed = np.zeros(max_lag + 1)
+    for i in range(permutations):
+        Xp, yp = _lag_design(animal[rng.permutation(animal.shape[0])], human, max_lag)
+        exceed += np.abs(np.linalg.lstsq(Xp, yp, rcond = None)[0]) >= np.abs(coef)
+
+    out['p_sim'] = (exceed + 1)/(permutations + 1)
+
+    return out
+
+
+#%%
+if __name__ == '__main__':
+
+    ## Small synthetic check: human cases follow animal infection with a 3 month delay
+    rng = np.random.default_rng(1)
+    animal = rng.gamma(2, 0.05, (429, 108))
+    human = np.roll(animal, 3, axis = 1)*50 + rng.normal(0, 1, animal.shape)
+    animal[rng.random(animal.shape) < 0.2] = np.nan
+
+    r, n, summary, p = lagged_xcorr(animal, human, permutations = 99)
+    print(summary.head(6))
+    print(distributed_lag(animal, human, max_lag = 6, permutations = 19))
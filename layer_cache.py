@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Cached, column-projected reads of the shapefile layers
+
+The scripts reopen Iran_shp/iran_admin.shp with gpd.read_file every run, decoding every
+column and polygon. read_layer converts a layer to GeoParquet the first time it is asked
+for (via pyogrio), then serves later reads from that file, reading only the requested
+columns. Attribute-only reads skip geometry decoding entirely. The cache is rebuilt when
+the source files change (size and mtime, or a content hash).
+
+Also reads standalone .dbf tables such as the 2009-11 national brucellosis layer,
+which has no .shp in the repository.
+"""
+
+import os
+import json
+import glob
+import hashlib
+import pandas as pd
+import geopandas as gpd
+import pyogrio
+import pyarrow.parquet as pq
+
+
+## Layers in the repository
+IRAN_LAYER = os.path.join('Iran_shp', 'iran_admin.shp')
+NATIONAL_LAYER = os.path.join('Data', 'National-Brucellosis 2009-11', 'Brucellosis.dbf')
+
+## The national layer's DBF is Windows Arabic; pyogrio would otherwise read it as UTF-8
+ENCODINGS = {'Brucellosis.dbf': 'cp1256', 'Brucellosis.shp': 'cp1256'}
+
+## Default cache folder, next to the data (relative to the working directory when a read is made)
+CACHE_DIR = os.path.join('Data', 'cache')
+
+
+######### Functions #############
+def _sources(path):
+    """
+    All files that make up a layer (.shp, .dbf, .shx, .prj, .cpg ...) sharing its stem.
+    """
+    stem = os.path.splitext(path)[0]
+    return sorted(f for f in glob.glob(glob.escape(stem) + '.*') if not f.endswith('.xml'))
+
+
+def source_signature(path, check = 'mtime'):
+    """
+    Fingerprint of a layer's files: size and modification time, or a sha1 of their contents with check = 'hash'.
+    """
+    sig = {}
+    for f in _sources(path):
+        if check == 'hash':
+            h = hashlib.sha1()
+            with open(f, 'rb') as fh:
+                for block in iter(lambda: fh.read(1 << 20), b''):
+                    h.update(block)
+            sig[os.path.basename(f)] = h.hexdigest()
+        else:
+            st = os.stat(f)
+            sig[os.path.basename(f)] = [st.st_size, st.st_mtime_ns]
+    return sig
+
+
+def _cache_files(path, cache_dir):
+    ## Keyed by file name with its extension: iran_admin.shp and iran_admin.dbf are different layers
+    ## (the .dbf alone has no geometry)
+    name = os.path.basename(path).replace('.', '_')
+    return os.path.join(cache_dir, name + '.parquet'), os.path.join(cache_dir, name + '.json')
+
+
+def build_cache(path, cache_dir = None, encoding = None, check = 'mtime'):
+    """
+    Reads the whole layer once and writes it as (Geo)Parquet along with the source signature.
+    """
+    cache_dir = os.path.abspath(cache_dir or CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok = True)
+    data_file, sig_file = _cache_files(path, cache_dir)
+    encoding = encoding or ENCODINGS.get(os.path.basename(path))
+
+    has_geom = pyogrio.read_info(path, encoding = encoding)['geometry_type'] is not None
+    data = pyogrio.read_dataframe(path, encoding = encoding, read_geometry = has_geom)
+
+    if has_geom:
+        data.to_parquet(data_file)
+    else:
+        pd.DataFrame(data).to_parquet(data_file)
+
+    with open(sig_file, 'w') as fh:
+        json.dump({'source': os.path.abspath(path), 'check': check, 'geometry': has_geom,
+                   'signature': source_signature(path, check)}, fh)
+
+
+def _is_fresh(path, cache_dir, check):
+    data_file, sig_file = _cache_files(path, cache_dir)
+    if not (os.path.exists(data_file) and os.path.exists(sig_file)):
+        return False
+    with open(sig_file) as fh:
+        meta = json.load(fh)
+    return meta['check'] == check and meta['signature'] == source_signature(path, check)
+
+
+def read_layer(path, columns = None, geometry = True, cache_dir = None, encoding = None, check = 'mtime'):
+    """
+    Reads a shapefile or DBF layer from the columnar cache, building it first if it's missing or stale.
+
+    columns:  attribute columns to read (all if None)
+    geometry: False reads attributes only and returns a plain DataFrame without touching the geometry column
+    check:    'mtime' compares file sizes and modification times, 'hash' compares file contents
+
+    Raises ValueError if geometry is asked for from a layer without any (e.g. a bare .dbf).
+    """
+    cache_dir = os.path.abspath(cache_dir or CACHE_DIR)
+    if not _is_fresh(path, cache_dir, check):
+        build_cache(path, cache_dir, encoding, check)
+
+    data_file, sig_file = _cache_files(path, cache_dir)
+    with open(sig_file) as fh:
+        has_geom = json.load(fh)['geometry']
+
+    if geometry and not has_geom:
+        raise ValueError('{} has no geometry; read it with geometry = False'.format(path))
+    if geometry:
+        cols = None if columns is None else list(columns) + ['geometry']
+        return gpd.read_parquet(data_file, columns = cols)
+
+    ## Plain parquet read: the geometry column is never loaded, let alone decoded
+    if columns is None:
+        columns = [c for c in pq.read_schema(data_file).names if c != 'geometry']
+    return pd.read_parquet(data_file, columns = list(columns))
+
+
+def read_iran(fp = None, columns = None, geometry = True):
+    """
+    The Iran county layer, with the same column subset and names the cleaning scripts use,
+    plus the county ID (ADM2_PCODE).
+    """
+    fp = os.getcwd() if fp is None else fp
+    cols = ['ADM2_PCODE', 'ADM2_EN', 'ADM2_FA', 'ADM1_EN', 'ADM1_FA', 'Shape_Leng', 'Shape_Area'] if columns is None else columns
+
+    ## Attribute-only reads can come straight from the .dbf if the .shp isn't there
+    path = os.path.join(fp, IRAN_LAYER)
+    if not geometry and not os.path.exists(path):
+        path = os.path.splitext(path)[0] + '.dbf'
+
+    iran_data = read_layer(path, cols, geometry, cache_dir = os.path.join(fp, 'Data', 'cache'))
+
+    iran_data = iran_data.rename(columns = {'ADM2_EN':'county_en', 'ADM2_FA':'county_fa', 'ADM1_EN':'province_en',
+                                            'ADM1_FA':'province_fa', 'Shape_Leng':'shape_len', 'Shape_Area':'shape_area'})
+
+    ## This accidental escape sequence is problematic later, so deal with manually here
+    if 'county_en' in iran_data:
+        iran_data.loc[iran_data['county_en'] == 'Yasooj\r', 'county_en'] = 'Yasooj'
+
+    return iran_data
+
+
+def read_national(fp = None, columns = None, geometry = False):
+    """
+    The 2009-11 national brucellosis layer: the attribute table, or with geometry = True the layer
+    with its 2011 county polygons (which needs the .shp next to the .dbf).
+    """
+    fp = os.getcwd() if fp is None else fp
+    path = os.path.join(fp, NATIONAL_LAYER)
+    if geometry:
+        path = os.path.splitext(path)[0] + '.shp'
+    return read_layer(path, columns, geometry, cache_dir = os.path.join(fp, 'Data', 'cache'))
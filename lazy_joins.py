@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+Optional Polars backend for the joins
+
+The cleaning scripts join every table to the county layer with pd.merge(how = 'outer')
+and build the Katharine table with a chain of merges, each materializing a full frame.
+With backend = 'polars' the same joins are planned as one lazy query: only the columns
+used are carried through (projection pushdown), filters run before the joins, the joins
+run multi-threaded and a single frame is collected at the end.
+
+Inputs can be DataFrames or paths to the clean Feather/Parquet tables (clean_outputs.py).
+Paths are scanned with pl.scan_ipc / pl.scan_parquet, so only the projected columns are
+read (the pandas path reads the same columns with read_feather). pandas frames are copied
+into Arrow first, geometry as WKB. On 1M synthetic records read from disk (the demo below)
+the polars layer join is about 30% faster, the Katharine table is slower, and peak memory is
+about the same, since the result is converted back to pandas either way.
+
+The pandas path stays the default and the reference: same_result checks the two agree
+(up to row order, which pandas sorts by key in outer merges and Polars doesn't).
+
+    human_sp_data = outer_join(human_data, iran_data, 'County', 'county_en', backend = 'polars')
+    kat = katharine_table('Data/clean/human.feather', 'Data/clean/pop.feather', 'Data/clean/ses.feather',
+                          dims, backend = 'polars')
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+try:
+    import polars as pl
+    HAS_POLARS = True
+except ImportError:
+    HAS_POLARS = False
+
+
+BACKENDS = ('pandas', 'polars')
+
+## Polars names of the pandas merge types
+HOW = {'outer': 'full', 'inner': 'inner', 'left': 'left', 'right': 'right'}
+
+
+######### Functions #############
+def check_backend(backend):
+    """
+    Validates the backend name; 'polars' needs the polars package.
+    """
+    if backend not in BACKENDS:
+        raise ValueError('backend must be one of {}'.format(BACKENDS))
+    if backend == 'polars' and not HAS_POLARS:
+        raise ImportError('backend = "polars" needs the polars package')
+    return backend
+
+
+def _is_path(src):
+    return isinstance(src, (str, os.PathLike))
+
+
+def read_frame(src, columns = None):
+    """
+    pandas frame of a DataFrame or a Feather/Parquet path, reading only columns (all if None).
+    """
+    if not _is_path(src):
+        return src if columns is None else src[list(columns)]
+    columns = None if columns is None else list(columns)
+    if str(src).endswith('.parquet'):
+        return pd.read_parquet(src, columns = columns)
+    return pd.read_feather(src, columns = columns)
+
+
+def scan(path, columns = None):
+    """
+    Lazy scan of a clean Feather (IPC) or Parquet table; only columns are read when collected.
+    Categorical columns are cast to strings so they join with plain text keys.
+    """
+    lf = pl.scan_parquet(path) if str(path).endswith('.parquet') else pl.scan_ipc(path)
+    if columns is not None:
+        lf = lf.select(list(columns))
+    return lf.with_columns(pl.col(pl.Categorical).cast(pl.String))
+
+
+def to_lazy(df, columns = None):
+    """
+    Polars LazyFrame of a pandas frame or a table path (only columns, if given). Text columns
+    of pandas frames that mix in numbers (years next to 'Null') are stored as strings, as in
+    the clean tables.
+    """
+    if isinstance(df, pl.LazyFrame):
+        return df if columns is None else df.select(list(columns))
+    if _is_path(df):
+        return scan(df, columns)
+    df = pd.DataFrame(df)
+    if columns is not None:
+        df = df[list(columns)]
+    fixed = {}
+    if 'geometry' in df.columns:
+        ## Geometry travels through the join as WKB and is decoded again by to_pandas
+        import shapely
+        fixed['geometry'] = shapely.to_wkb(np.asarray(df['geometry'], dtype = object))
+    for col in df.columns:
+        s = df[col]
+        if s.dtype == object and col != 'geometry':
+            fixed[col] = s.where(s.isna(), s.astype(str))
+    if fixed:
+        df = df.assign(**fixed)
+    return pl.from_pandas(df, include_index = False).lazy()
+
+
+def to_pandas(frame):
+    """
+    Collects a Polars frame into pandas, with nulls as NaN like the pandas path, and WKB
+    geometry decoded back into a geometry column.
+    """
+    if isinstance(frame, pl.LazyFrame):
+        frame = frame.collect()
+    df = frame.to_pandas()
+    if 'geometry' in df.columns and frame.schema['geometry'] == pl.Binary:
+        import geopandas as gpd
+        df['geometry'] = gpd.GeoSeries.from_wkb(df['geometry'].values)
+    return df
+
+
+def _columns(src):
+    if isinstance(src, pl.LazyFrame):
+        return src.collect_schema().names()
+    if _is_path(src):
+        return scan(src).collect_schema().names()
+    return list(src.columns)
+
+
+def plan_join(left, right, left_on, right_on = None, how = 'outer', left_columns = None, right_columns = None):
+    """
+    Lazy join keeping both key columns when they differ, with pandas' _x/_y suffixes on other
+    shared column names.
+    """
+    right_on = left_on if right_on is None else right_on
+    lcols = _columns(left) if left_columns is None else list(left_columns)
+    rcols = _columns(right) if right_columns is None else list(right_columns)
+    shared = (set(lcols) & set(rcols)) - {left_on} - {right_on} - {'geometry'}
+
+    lf = to_lazy(left, lcols).rename({c: c + '_x' for c in shared})
+    rf = to_lazy(right, rcols).rename({c: c + '_y' for c in shared})
+    if left_on == right_on:
+        return lf.join(rf, on = left_on, how = HOW[how], coalesce = True, nulls_equal = how == 'outer')
+    return lf.join(rf, left_on = left_on, right_on = right_on, how = HOW[how], coalesce = False)
+
+
+def join(left, right, left_on, right_on = None, how = 'outer', backend = 'pandas', left_columns = None, right_columns = None):
+    """
+    pd.merge(left, right, how, left_on, right_on) on either backend; left and right are frames
+    or clean table paths. left_columns / right_columns limit the columns read and carried into
+    the join (all by default).
+    """
+    right_on = left_on if right_on is None else right_on
+    if check_backend(backend) == 'pandas':
+        left, right = read_frame(left, left_columns), read_frame(right, right_columns)
+        if left_on == right_on:
+            return pd.merge(left, right, how = how, on = left_on)
+        return pd.merge(left, right, how = how, left_on = left_on, right_on = right_on)
+    return to_pandas(plan_join(left, right, left_on, right_on, how, left_columns, right_columns))
+
+
+def outer_join(left, right, left_on, right_on = None, backend = 'pandas', left_columns = None, right_columns = None):
+    """
+    pd.merge(left, right, how = 'outer', left_on, right_on) on either backend (see join).
+    """
+    return join(left, right, left_on, right_on, 'outer', backend, left_columns, right_columns)
+
+
+def katharine_table(human_sp_data, pop_sp_data, ses_sp_data, dims, backend = 'pandas'):
+    """
+    Cases per (dims) group with county totals, population, inf_rate and SES, counties without
+    cases kept: the 'Data for Katharine' table. dims must include county_en. The tables can be
+    frames or clean table paths; only the columns used are read.
+    """
+    if check_backend(backend) == 'pandas':
+        from risk_cube import RiskCube
+        human_sp_data = read_frame(human_sp_data, ['ID'] + list(dims))
+        pop_sp_data = read_frame(pop_sp_data, ['county_en', 'Population'])
+        ses_sp_data = read_frame(ses_sp_data, ['county_en', 'ses'])
+        cube = RiskCube(human_sp_data[human_sp_data['ID'].notna()], dims = dims)
+        count_df = cube.rates(dims, pop_sp_data.dropna(subset = ['county_en']).set_index('county_en')['Population'])
+        count_df = pd.merge(count_df, pop_sp_data[['county_en', 'Population']], how = 'outer', on = ['county_en', 'Population'])
+        return pd.merge(count_df, ses_sp_data[['county_en', 'ses']], how = 'outer', on = 'county_en')
+
+    ## Only the case rows and the dims are read from the human table
+    cases = to_lazy(human_sp_data, ['ID'] + list(dims)).filter(pl.col('ID').is_not_null()).drop('ID')
+    pop = to_lazy(pop_sp_data, ['county_en', 'Population'])
+
+    counts = cases.drop_nulls(dims).group_by(dims).agg(pl.len().cast(pl.Int64).alias('count'))
+    county = cases.drop_nulls('county_en').group_by('county_en').agg(pl.len().cast(pl.Int64).alias('county_count'))
+    lookup = pop.drop_nulls('county_en').unique('county_en', keep = 'first')
+
+    table = (counts.join(county, on = 'county_en', how = 'left')
+                   .join(lookup, on = 'county_en', how = 'left')
+                   .with_columns((pl.col('count')/pl.col('Population')).alias('inf_rate'))
+                   .join(pop, on = ['county_en', 'Population'], how = 'full', coalesce = True, nulls_equal = True)
+                   .join(to_lazy(ses_sp_data, ['county_en', 'ses']), on = 'county_en', how = 'full', coalesce = True, nulls_equal = True))
+    return to_pandas(table)
+
+
+def same_result(a, b, keys = None, rtol = 1e-9):
+    """
+    True if two frames hold the same rows and columns, ignoring row order and dtype
+    differences (e.g. categorical vs string); raises with the first difference otherwise.
+    """
+    cols = sorted(a.columns)
+    if sorted(b.columns) != cols:
+        raise AssertionError('Columns differ: {}'.format(set(a.columns) ^ set(b.columns)))
+    keys = cols if keys is None else list(keys)
+
+    def norm(df):
+        df = df[cols].copy()
+        for c in cols:
+            if not pd.api.types.is_numeric_dtype(df[c]) or isinstance(df[c].dtype, pd.CategoricalDtype):
+                df[c] = df[c].astype(object).where(df[c].notna(), None).astype(str)
+            else:
+                df[c] = df[c].astype(float)
+        return df.sort_values(keys, kind = 'stable').reset_index(drop = True)
+
+    pd.testing.assert_frame_equal(norm(a), norm(b), check_dtype = False, rtol = rtol)
+    return True
+
+
+def _write_inputs(folder, n, dims):
+    ## Synthetic clean tables on disk (in a child process, so the parent's memory stays small)
+    import synthetic_data as syn
+    from streaming_ingest import clean_human
+    from clean_outputs import write_table
+
+    gaz = syn.gazetteer(429)
+    iran_data = gaz.assign(ADM2_PCODE = ['IR{:04d}'.format(i) for i in range(len(gaz))])
+    human_data = clean_human(syn.human_register(n, gaz, share_misspelled = 0.05), {})
+    pop_sp_data = pd.merge(pd.DataFrame({'Mapped': gaz['county_en'], 'Population': np.random.default_rng(0).integers(1e4, 1e6, len(gaz))}),
+                           iran_data, how = 'outer', left_on = 'Mapped', right_on = 'county_en')
+    ses_sp_data = pd.merge(pd.DataFrame({'province': gaz['province_en'].unique(), 'ses': 1}), iran_data, how = 'outer',
+                           left_on = 'province', right_on = 'province_en')
+
+    ## In-memory frames: both backends give the same tables
+    sp = {b: outer_join(human_data, iran_data, 'County', 'county_en', backend = b) for b in BACKENDS}
+    same_result(sp['pandas'], sp['polars'], keys = ['ID', 'county_en'])
+    same_result(katharine_table(sp['pandas'], pop_sp_data, ses_sp_data, dims),
+                katharine_table(sp['polars'], pop_sp_data, ses_sp_data, dims, backend = 'polars'), keys = dims)
+
+    for name, df in {'human': human_data, 'layer': iran_data, 'human_sp': sp['pandas'], 'pop': pop_sp_data, 'ses': ses_sp_data}.items():
+        write_table(df, name, folder)
+
+
+def _timed_run(backend, folder, dims):
+    ## One backend in a fresh process, so the peak RSS is its own
+    import time
+    from stage_timing import peak_rss_mb
+    base = peak_rss_mb()
+    path = lambda name: os.path.join(folder, name + '.feather')
+    t0 = time.perf_counter()
+    sp = join(path('human'), path('layer'), 'County', 'county_en', backend = backend,
+              left_columns = ['ID', 'County', 'Outbreak_yr', 'Outbreak_mth'], right_columns = ['county_en', 'province_en'])
+    t1 = time.perf_counter()
+    kat = katharine_table(path('human_sp'), path('pop'), path('ses'), dims, backend = backend)
+    t2 = time.perf_counter()
+    peak = peak_rss_mb() - base
+    sp.to_pickle(os.path.join(folder, 'result_{}.pkl'.format(backend)))
+    return t1 - t0, t2 - t1, peak, kat
+
+
+#%%
+if __name__ == '__main__':
+
+    import tempfile
+    import multiprocessing as mp
+    from concurrent.futures import ProcessPoolExecutor
+
+    dims = ['county_en', 'province_en', 'Livestock_int_hist', 'Livestock_vac_hist', 'Pop_setting']
+    folder = tempfile.mkdtemp()
+    ctx = mp.get_context('spawn')
+    with ProcessPoolExecutor(1, mp_context = ctx) as pool:
+        pool.submit(_write_inputs, folder, 1000000, dims).result()
+
+    ## From the clean tables on disk, each backend in its own process
+    kats = {}
+    for backend in BACKENDS:
+        with ProcessPoolExecutor(1, mp_context = ctx) as pool:
+            t_join, t_kat, peak, kats[backend] = pool.submit(_timed_run, backend, folder, dims).result()
+        print('{:7s} join {:.2f}s  Katharine {:.2f}s  peak RSS +{:.0f} MB'.format(backend, t_join, t_kat, peak))
+
+    same_result(*[pd.read_pickle(os.path.join(folder, 'result_{}.pkl'.format(b))) for b in BACKENDS], keys = ['ID', 'county_en'])
+    same_result(kats['pandas'], kats['polars'], keys = dims)
+    print('Backends agree')
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Batch map rendering
+
+Local_morans_I and Global_morans_I draw each figure interactively with splot, over the
+full-resolution polygons. For the monthly maps of every variable this stage:
+
+- projects and simplifies the county polygons once and keeps them as matplotlib Paths
+  (cached on disk next to the layer cache),
+- builds one figure with one PathCollection per worker process and only changes the
+  face colours, title and legend between maps,
+- renders a list of map jobs (choropleths and LISA cluster maps) to PNG or SVG in a
+  process pool, headless (Agg, no pyplot).
+
+    paths = county_paths(iran_data)
+    jobs = monthly_jobs(arr, counties, months, 'incidence', 'Data/maps')
+    jobs += lisa_jobs(moran_local(arr, W), counties, months, 'incidence', 'Data/maps')
+    render_batch(jobs, paths)
+"""
+
+import os
+import pickle
+import hashlib
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from county_month import key_to_period
+
+
+## Projected, simplified paths are cached here (relative to the working directory when they are drawn)
+PATH_CACHE = os.path.join('Data', 'cache')
+
+## LISA cluster colours in esda's q order (1 HH, 2 LH, 3 LL, 4 HL), then not significant and no data
+LISA_COLORS = {1: '#d7191c', 2: '#abd9e9', 3: '#2c7bb6', 4: '#fdae61', 0: '#d3d3d3', -1: '#ffffff'}
+LISA_LABELS = {1: 'High-High', 2: 'Low-High', 3: 'Low-Low', 4: 'High-Low', 0: 'Not significant'}
+
+
+######### Functions #############
+def lisa_class(q, p, alpha = 0.05):
+    """
+    LISA class per county: the quadrant (1-4) where p < alpha, 0 where not significant, -1 where there is no value.
+    """
+    q = np.asarray(q)
+    p = np.asarray(p, dtype = float)
+    return np.where(np.isnan(p), -1, np.where(p < alpha, q, 0)).astype(np.int8)
+
+
+def _geom_path(geom):
+    """
+    One compound matplotlib Path for a (multi)polygon, holes included.
+    """
+    from matplotlib.path import Path
+
+    polys = getattr(geom, 'geoms', [geom])
+    verts, codes = [], []
+    for poly in polys:
+        for ring in [poly.exterior] + list(poly.interiors):
+            xy = np.asarray(ring.coords)[:, :2]
+            verts.append(xy)
+            codes.append(np.r_[Path.MOVETO, np.full(len(xy) - 2, Path.LINETO), Path.CLOSEPOLY].astype(np.uint8))
+    if not verts:
+        return Path(np.empty((0, 2)))
+    return Path(np.concatenate(verts), np.concatenate(codes))
+
+
+def county_paths(gdf, key_col = 'county_en', crs = 'EPSG:32639', tolerance = 1000, cache_dir = PATH_CACHE):
+    """
+    County keys and simplified outline Paths in a projected CRS (UTM 39N, metres), with the
+    extent. tolerance is the simplification distance. Cached by the geometry, so later runs
+    skip projection and simplification.
+    """
+    keys = pd.Index(gdf[key_col].astype(str))
+    sig = hashlib.sha1(b''.join(gdf.geometry.to_wkb().values) + '|'.join(keys).encode() +
+                       '{}{}'.format(crs, tolerance).encode()).hexdigest()[:16]
+    cache_file = os.path.join(cache_dir, 'map_paths_{}.pkl'.format(sig)) if cache_dir else None
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+
+    geoms = gdf.geometry
+    if gdf.crs is not None and crs is not None:
+        geoms = geoms.to_crs(crs)
+    geoms = geoms.simplify(tolerance, preserve_topology = True)
+
+    out = {'keys': keys, 'paths': [_geom_path(g) for g in geoms], 'extent': tuple(geoms.total_bounds)}
+    if cache_file:
+        os.makedirs(cache_dir, exist_ok = True)
+        with open(cache_file, 'wb') as f:
+            pickle.dump(out, f)
+    return out
+
+
+class MapTemplate:
+    """
+    One reusable figure: the county outlines as a single PathCollection plus a colour bar
+    and legend that are switched on per map.
+    """
+    def __init__(self, paths, figsize = (8, 7), dpi = 150):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.collections import PathCollection
+
+        self.keys = paths['keys']
+        self.fig = Figure(figsize = figsize, dpi = dpi)
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_axes([0.02, 0.02, 0.8, 0.9])
+        self.cax = self.fig.add_axes([0.85, 0.15, 0.03, 0.65])
+        self.coll = PathCollection(paths['paths'], edgecolor = '#555555', linewidth = 0.2)
+        self.ax.add_collection(self.coll)
+
+        x0, y0, x1, y1 = paths['extent']
+        self.ax.set_xlim(x0, x1)
+        self.ax.set_ylim(y0, y1)
+        self.ax.set_aspect('equal')
+        self.ax.set_axis_off()
+        self.legend = None
+
+    def _reset(self):
+        self.cax.clear()
+        self.cax.set_visible(False)
+        if self.legend is not None:
+            self.legend.remove()
+            self.legend = None
+
+    def choropleth(self, values, title = '', cmap = 'viridis', vmin = None, vmax = None):
+        """
+        Colours the counties by values (aligned with the keys); NaN counties are white.
+        """
+        from matplotlib import colormaps, colors
+        from matplotlib.cm import ScalarMappable
+
+        self._reset()
+        values = np.asarray(values, dtype = float)
+        ok = np.isfinite(values)
+        vmin = np.nanmin(values) if vmin is None and ok.any() else (0 if vmin is None else vmin)
+        vmax = np.nanmax(values) if vmax is None and ok.any() else (1 if vmax is None else vmax)
+        norm = colors.Normalize(vmin, vmax if vmax > vmin else vmin + 1)
+
+        face = np.ones((len(values), 4))
+        face[ok] = colormaps[cmap](norm(values[ok]))
+        self.coll.set_facecolor(face)
+        self.cax.set_visible(True)
+        self.fig.colorbar(ScalarMappable(norm, colormaps[cmap]), cax = self.cax)
+        self.ax.set_title(title)
+
+    def lisa(self, q, p, title = '', alpha = 0.05):
+        """
+        LISA cluster map: quadrant colours where p < alpha, grey otherwise, white where there is no value.
+        """
+        from matplotlib.patches import Patch
+
+        self._reset()
+        cls = lisa_class(q, p, alpha)
+        self.coll.set_facecolor([LISA_COLORS[c] for c in cls])
+        self.legend = self.ax.legend(handles = [Patch(facecolor = LISA_COLORS[c], edgecolor = '#555555', label = LISA_LABELS[c])
+                                                for c in [1, 2, 3, 4, 0]], loc = 'lower left', fontsize = 8, frameon = False)
+        self.ax.set_title(title)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+        self.fig.savefig(path)
+
+
+def monthly_jobs(arr, counties, months, name, out_dir, fmt = 'png', cmap = 'viridis', common_scale = True):
+    """
+    One choropleth job per month of a (county, month) array from county_month_array.
+    common_scale uses the same colour range for every month so maps can be compared.
+    """
+    arr = np.asarray(arr, dtype = float)
+    vmin, vmax = (np.nanmin(arr), np.nanmax(arr)) if common_scale else (None, None)
+    jobs = []
+    for t, per in enumerate(key_to_period(months)):
+        y, m = per.year, per.month
+        jobs.append({'kind': 'choropleth', 'counties': list(counties), 'values': arr[:, t],
+                     'title': '{} {}-{:02d}'.format(name, y, m), 'cmap': cmap, 'vmin': vmin, 'vmax': vmax,
+                     'path': os.path.join(out_dir, name, '{}_{}_{:02d}.{}'.format(name, y, m, fmt))})
+    return jobs
+
+
+def lisa_jobs(lisa, counties, months, name, out_dir, fmt = 'png', alpha = 0.05):
+    """
+    One LISA cluster map job per month from moran_permutation.moran_local output.
+    """
+    jobs = []
+    for t, per in enumerate(key_to_period(months)):
+        y, m = per.year, per.month
+        jobs.append({'kind': 'lisa', 'counties': list(counties), 'q': lisa['q'][:, t], 'p': lisa['p_sim'][:, t],
+                     'title': '{} LISA {}-{:02d}'.format(name, y, m), 'alpha': alpha,
+                     'path': os.path.join(out_dir, name + '_lisa', '{}_lisa_{}_{:02d}.{}'.format(name, y, m, fmt))})
+    return jobs
+
+
+## Worker state for the process pool, set once per process by _init_worker
+_shared = {}
+
+def _init_worker(paths, figsize, dpi):
+    import matplotlib
+    matplotlib.use('Agg')
+    _shared['template'] = MapTemplate(paths, figsize, dpi)
+
+
+def _render(job):
+    """
+    Draws one job on the worker's template. Values are matched to the template's counties by name.
+    """
+    tpl = _shared['template']
+    pos = pd.Index(job['counties']).get_indexer(tpl.keys)
+    take = lambda v, fill: np.where(pos >= 0, np.asarray(v)[np.maximum(pos, 0)], fill)
+
+    if job['kind'] == 'lisa':
+        tpl.lisa(take(job['q'], 0), take(job['p'], np.nan), job['title'], job.get('alpha', 0.05))
+    else:
+        tpl.choropleth(take(job['values'], np.nan), job['title'], job.get('cmap', 'viridis'), job.get('vmin'), job.get('vmax'))
+    tpl.save(job['path'])
+    return job['path']
+
+
+def render_batch(jobs, paths, workers = None, figsize = (8, 7), dpi = 150, chunksize = 8):
+    """
+    Renders every job to its path, in worker processes that each build the figure once.
+    Returns the written paths.
+    """
+    workers = workers or os.cpu_count()
+    if workers == 1 or len(jobs) <= 1:
+        _init_worker(paths, figsize, dpi)
+        return [_render(job) for job in jobs]
+
+    with ProcessPoolExecutor(workers, initializer = _init_worker, initargs = (paths, figsize, dpi)) as pool:
+        return list(pool.map(_render, jobs, chunksize = chunksize))
+
+
+#%%
+if __name__ == '__main__':
+
+    import time
+    import tempfile
+    import geopandas as gpd
+    from shapely.geometry import box
+    from synthetic_data import grid_counties
+    from moran_permutation import moran_local
+
+    ## 20 x 20 lattice of square counties (same ordering as grid_counties) and 24 months of rates
+    side, n_months = 20, 24
+    counties = ['c{:03d}'.format(i) for i in range(side*side)]
+    gdf = gpd.GeoDataFrame({'county_en': counties},
+                           geometry = [box(44 + c*0.5, 39 - r*0.5, 44.5 + c*0.5, 39.5 - r*0.5) for r in range(side) for c in range(side)],
+                           crs = 'EPSG:4326')
+    rng = np.random.default_rng(0)
+    arr = rng.gamma(2, size = (side*side, n_months)) + np.repeat(np.arange(side), side)[:, None]/5
+    months = np.arange(2016*12, 2016*12 + n_months)
+
+    out_dir = tempfile.mkdtemp()
+    paths = county_paths(gdf, cache_dir = out_dir)
+    lisa = moran_local(arr, grid_counties(side*side), permutations = 199, workers = 1)
+    jobs = monthly_jobs(arr, counties, months, 'incidence', out_dir) + lisa_jobs(lisa, counties, months, 'incidence', out_dir)
+
+    t0 = time.perf_counter()
+    written = render_batch(jobs, paths)
+    print('{} maps in {:.1f}s -> {}'.format(len(written), time.perf_counter() - t0, out_dir))
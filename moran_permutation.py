@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Permutation inference for Moran's I
+
+Replacement for the permutation loops inside esda's Moran / Moran_Local, for when we want
+9999+ permutations and want to run every month. The random draws are generated once per
+block of permutations and shared by every county and every month:
+
+- Global I: one shuffle of the counties per permutation, applied to all months.
+- Local I (conditional permutation): one random ordering of the "other" counties per
+  permutation; a county with k neighbours uses the first k entries. Counties are grouped
+  by neighbour count, so each group is a single vectorized gather.
+
+Blocks of permutations run in a process pool, each with its own child of one seeded
+SeedSequence, so results are reproducible for a given seed and number of workers.
+p-values use esda's conventions (folded pseudo p-values), so they agree with esda
+within Monte Carlo error.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from concurrent.futures import ProcessPoolExecutor
+
+from spatial_weights import row_standardize
+
+
+######### Functions #############
+def _standardize(y):
+    """
+    Centres each column of a (county, month) array and returns it with the sum of squares per column.
+    """
+    y = np.asarray(y, dtype = float)
+    if y.ndim == 1:
+        y = y[:, None]
+    z = y - y.mean(0)
+    return z, (z*z).sum(0)
+
+
+def cardinality_groups(W):
+    """
+    Groups counties by number of neighbours. Returns a list of (k, counties, neighbour ids, weights)
+    with the neighbour ids and weights as (group size, k) arrays, read straight from the CSR structure.
+    """
+    W = sparse.csr_matrix(W)
+    W.sort_indices()
+    card = np.diff(W.indptr)
+
+    groups = []
+    for k in np.unique(card[card > 0]):
+        members = np.flatnonzero(card == k)
+        pos = W.indptr[members][:, None] + np.arange(k)
+        groups.append((k, members, W.indices[pos], W.data[pos]))
+    return groups
+
+
+def _folded_p(larger, permutations):
+    """
+    esda's pseudo p-value: counts at least as extreme, folded onto the closer tail.
+    """
+    larger = np.where(permutations - larger < larger, permutations - larger, larger)
+    return (larger + 1.0)/(permutations + 1.0)
+
+
+## Worker state for the process pool, set once per process by _init_worker
+_shared = {}
+
+def _init_worker(z, W, groups, block):
+    _shared.update(z = z, W = W, groups = groups, block = block)
+
+
+def _global_block(seed_seq, n_perm):
+    """
+    Simulated global I values (permutation, month) for n_perm full shuffles of the counties.
+    """
+    rng = np.random.default_rng(seed_seq)
+    z, W = _shared['z'], _shared['W']
+    n = len(z)
+    S0 = W.sum()
+    den = (z*z).sum(0)
+
+    out = []
+    for start in range(0, n_perm, _shared['block']):
+        size = min(_shared['block'], n_perm - start)
+        perm = np.argsort(rng.random((size, n)), axis = 1)
+
+        ## (perm, county, month) -> spatial lags for every permutation and month in one sparse product
+        zp = z[perm]
+        lag = (W @ zp.transpose(1, 0, 2).reshape(n, -1)).reshape(n, size, -1).transpose(1, 0, 2)
+        out.append((n/S0)*(zp*lag).sum(1)/den)
+    return np.concatenate(out)
+
+
+def _local_block(seed_seq, n_perm):
+    """
+    For n_perm conditional permutations: how often each county's simulated local I is >= the observed one
+    (county, month), plus running sums for the mean and variance of the simulated values.
+    """
+    rng = np.random.default_rng(seed_seq)
+    z, groups = _shared['z'], _shared['groups']
+    n, T = z.shape
+    scale = (n - 1)/(z*z).sum(0)
+    k_max = max(g[0] for g in groups)
+
+    obs = np.zeros_like(z)
+    for k, members, nbrs, wts in groups:
+        obs[members] = scale*z[members]*np.einsum('gk,gkt->gt', wts, z[nbrs])
+
+    larger = np.zeros((n, T))
+    s1 = np.zeros((n, T))
+    s2 = np.zeros((n, T))
+
+    for start in range(0, n_perm, _shared['block']):
+        size = min(_shared['block'], n_perm - start)
+
+        ## One random ordering of n-1 "other" positions per permutation, shared by all counties
+        rid = np.argsort(rng.random((size, n - 1)), axis = 1)[:, :k_max]
+
+        for k, members, nbrs, wts in groups:
+            ## Shift positions at or past the county itself so it is never drawn as its own neighbour
+            ids = rid[None, :, :k] + (rid[None, :, :k] >= members[:, None, None])
+            lag = np.einsum('gk,gpkt->gpt', wts, z[ids])
+            sim = scale*z[members][:, None, :]*lag
+
+            larger[members] += (sim >= obs[members][:, None, :]).sum(1)
+            s1[members] += sim.sum(1)
+            s2[members] += (sim*sim).sum(1)
+
+    return larger, s1, s2
+
+
+def _run(func, permutations, seed, workers, initargs):
+    """
+    Splits the permutations into one chunk per worker, each with an independent child seed.
+    """
+    workers = workers or os.cpu_count()
+    seeds = np.random.SeedSequence(seed).spawn(workers)
+    counts = np.diff(np.linspace(0, permutations, workers + 1).astype(int))
+
+    if workers == 1:
+        _init_worker(*initargs)
+        return [func(seeds[0], counts[0])]
+
+    with ProcessPoolExecutor(workers, initializer = _init_worker, initargs = initargs) as pool:
+        return list(pool.map(func, seeds, counts))
+
+
+def moran_global(y, W, permutations = 9999, seed = 0, workers = None, block = 100):
+    """
+    Global Moran's I with permutation inference for one variable or a (county, month) array.
+    W is a sparse weights matrix (e.g. spatial_weights.queen_sparse); it is row standardized
+    as in esda's default. Returns a dataframe with I, EI, p_sim, EI_sim, seI_sim and z_sim per column.
+    """
+    z, den = _standardize(y)
+    n = len(z)
+    W = sparse.csr_matrix(row_standardize(W))
+
+    I = (n/W.sum())*(z*(W @ z)).sum(0)/den
+
+    sims = np.concatenate(_run(_global_block, permutations, seed, workers, (z, W, None, block)))
+    larger = (sims >= I).sum(0)
+
+    return pd.DataFrame({'I': I, 'EI': -1.0/(n - 1), 'p_sim': _folded_p(larger, permutations),
+                         'EI_sim': sims.mean(0), 'seI_sim': sims.std(0),
+                         'z_sim': (I - sims.mean(0))/sims.std(0)})
+
+
+def moran_local(y, W, permutations = 9999, seed = 0, workers = None, block = None):
+    """
+    Local Moran's I (LISA) with conditional permutation inference, for one variable or a
+    (county, month) array. W is row standardized as in esda's default.
+
+    Returns a dict of (county, month) arrays: Is, p_sim, q (1 HH, 2 LH, 3 LL, 4 HL as in esda),
+    EI_sim, seI_sim and z_sim. Counties with no neighbours get I = 0 and p_sim = NaN.
+    block is the number of permutations drawn at a time (defaults to keep each gather around 50 MB).
+    """
+    z, den = _standardize(y)
+    n, T = z.shape
+    W = sparse.csr_matrix(row_standardize(W))
+    groups = cardinality_groups(W)
+
+    lag = W @ z
+    Is = (n - 1)*z*lag/den
+
+    if block is None:
+        k_max = max(g[0] for g in groups)
+        block = int(np.clip(5e6/(n*k_max*T), 1, 1000))
+
+    parts = _run(_local_block, permutations, seed, workers, (z, W, groups, block))
+    larger, s1, s2 = [sum(p) for p in zip(*parts)]
+
+    mean = s1/permutations
+    sd = np.sqrt(np.maximum(s2/permutations - mean**2, 0))
+    islands = np.diff(W.indptr) == 0
+
+    q = np.select([(z > 0) & (lag > 0), (z < 0) & (lag > 0), (z < 0) & (lag < 0), (z > 0) & (lag < 0)],
+                  [1, 2, 3, 4], 0)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return {'Is': Is, 'p_sim': np.where(islands[:, None], np.nan, _folded_p(larger, permutations)),
+                'q': q, 'EI_sim': mean, 'seI_sim': sd, 'z_sim': (Is - mean)/sd}
+
+
+#%%
+if __name__ == '__main__':
+
+    ## Compare against esda on a regular lattice
+    import libpysal
+    from esda.moran import Moran, Moran_Local
+
+    w = libpysal.weights.lat2W(20, 20, rook = False)
+    rng = np.random.default_rng(4)
+    y = rng.normal(size = 400) + np.repeat(np.arange(20), 20)/10
+
+    g = moran_global(y, w.sparse, permutations = 9999, workers = 2)
+    m = Moran(y, w, permutations = 9999)
+    print(g.round(4))
+    print(m.I, m.p_sim)
+
+    l = moran_local(y, w.sparse, permutations = 9999, workers = 2)
+    ml = Moran_Local(y, w, permutations = 9999)
+    print(np.abs(l['Is'][:, 0] - ml.Is).max(), (l['q'][:, 0] == ml.q).mean())
+    print(np.abs(l['p_sim'][:, 0] - ml.p_sim).max())
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Ranked name-match candidates
+
+match_names(..., as_df = False) used to build two sorted Series and a merged DataFrame for
+every source name up front. RankedCandidates keeps the same information as a few arrays
+built from the distance/ratio matrices match_names already computes:
+
+    idx    (n_names, k) positions of each name's best k targets, closest first
+    dist   (n_names, k) Levenshtein distances of those targets
+    ratio  (n_names, k) Levenshtein ratios of those targets
+
+It behaves like the old dictionary (name -> DataFrame), but each DataFrame is only made when
+that name is looked at, so reviewing thousands of names costs one sort for all of them.
+"""
+
+from collections.abc import Mapping
+import numpy as np
+import pandas as pd
+
+
+class RankedCandidates(Mapping):
+    """
+    Top-k matches for each source name, ranked by distance (then by ratio, higher first).
+    cands[name] gives a DataFrame indexed by target name with '<name>_dist' and '<name>_ratio'
+    columns, like the old comb_dict values.
+    """
+    def __init__(self, names, targets, dists, ratios, top = None):
+        self.names = pd.Index(names)
+        self.targets = np.asarray(targets, dtype = object)
+        dists = np.asarray(dists)
+        ratios = np.asarray(ratios)
+
+        n, m = dists.shape
+        k = m if top is None else min(top, m)
+
+        ## Rank on one key: distance first, ratio breaks ties
+        key = dists - ratios/2.0
+        if k < m:
+            part = np.argpartition(key, k - 1, axis = 1)[:, :k]
+            order = np.take_along_axis(part, np.argsort(np.take_along_axis(key, part, axis = 1), axis = 1, kind = 'stable'), axis = 1)
+        else:
+            order = np.argsort(key, axis = 1, kind = 'stable')
+
+        self.idx = np.ascontiguousarray(order, dtype = np.int32)
+        self.dist = np.ascontiguousarray(np.take_along_axis(dists, order, axis = 1), dtype = np.int32)
+        self.ratio = np.ascontiguousarray(np.take_along_axis(ratios, order, axis = 1), dtype = np.float32)
+
+        ## Row of each name (names that collapse to the same spelling keep their first row)
+        self._row = {}
+        for i, name in enumerate(self.names):
+            self._row.setdefault(name, i)
+
+    def __getitem__(self, name):
+        i = self._row[name]
+        return pd.DataFrame({str(name) + '_dist': self.dist[i], str(name) + '_ratio': self.ratio[i]},
+                            index = pd.Index(self.targets[self.idx[i]]))
+
+    def __iter__(self):
+        return iter(self._row)
+
+    def __len__(self):
+        return len(self._row)
+
+    def best(self, n = 1):
+        """
+        The n best targets for every name in one frame: name, rank, target, dist, ratio.
+        """
+        n = min(n, self.idx.shape[1])
+        rows = np.fromiter(self._row.values(), dtype = np.int64)
+        return pd.DataFrame({'name': np.repeat(self.names[rows], n),
+                             'rank': np.tile(np.arange(1, n + 1), len(rows)),
+                             'target': self.targets[self.idx[rows, :n]].ravel(),
+                             'dist': self.dist[rows, :n].ravel(),
+                             'ratio': self.ratio[rows, :n].ravel()})
+
+    def __repr__(self):
+        return '<RankedCandidates: {} names x top {} of {} targets>'.format(len(self), self.idx.shape[1], len(self.targets))
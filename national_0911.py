@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+2009-2011 national human brucellosis data
+
+Data/Human_Brucellosis_09_11.csv (and the National-Brucellosis 2009-11 layer it came from)
+stores monthly county counts as ~40 wide columns. The column labels look gregorian but the
+values are jalali months: Apr_2011 is month 1 of 1390 (mah1_90 in the DBF) and March_2012
+is month 12 of 1390 (mah12_90).
+
+This reshapes them into the same county-month layout as the 2015-2018 register with one
+melt, re-bases the 2011 counties onto today's shapefile counties and stacks the two periods
+into a single 2009-2018 series.
+
+The national layer has 386 counties and iran_admin 429: counties split since 2011 would get
+none of their parent's cases if the old IDs were only matched to one county by name. The
+(ID, month) cube is moved onto today's counties through an area crosswalk instead (each old
+county's cases shared by the share of its area in each new county, see crosswalk.py), in one
+sparse product. Without the national layer's polygons it falls back to the name keys.
+"""
+
+import os
+import re
+import numpy as np
+import pandas as pd
+import jdatetime
+
+from layer_cache import read_national, read_iran, NATIONAL_LAYER
+from county_month import county_month_array, array_to_long
+from crosswalk import area_crosswalk, crosswalk_from_mapping, reallocate
+
+
+## Gregorian month labels used in the wide columns
+MONTH_LABELS = {'Jan':1, 'Feb':2, 'Mar':3, 'March':3, 'Apr':4, 'May':5, 'Jun':6,
+                'Jul':7, 'Aug':8, 'Sep':9, 'Oct':10, 'Nov':11, 'Dec':12}
+
+MONTH_COLUMN = re.compile(r'^(' + '|'.join(MONTH_LABELS) + r')_(\d{4})$')
+
+## Counties in the national layer whose Persian names don't line up with iran_admin after normalizing,
+## keyed by the layer's ID
+MANUAL_IDS = {
+    187:'Shirvan-o-Chardavol',
+    151:'Meshginshahr',
+    97:'Talesh',
+    90:'Bandar-e-Torkaman',
+    84:'Aliabad',
+    57:'Jask',
+    56:'Khamir',
+    370:'Anbarabad',
+    5:'Bahmai',
+    225:'Qaen',
+    255:'Firuzeh',     ## Takht-e Jolgeh
+    289:'Haftgol',
+    12:'Delfan',       ## Nurabad
+    17:'Doureh',
+    15:'Selseleh',     ## Aleshtar
+    80:'Ashkezar',     ## Saduq
+    315:'Mehrestan'    ## Zaboli
+              }
+
+
+######### Functions #############
+def normalize_fa(s):
+    """
+    Normalizes Persian names for matching: drops the 'شهرستان' prefix, unifies Arabic and Persian
+    forms of yeh/kaf/alef and removes spaces, joiners and direction marks.
+    """
+    s = pd.Series(s).fillna('').str.replace('شهرستان', '', regex = False)
+    for a, b in [('ي', 'ی'), ('ك', 'ک'), ('ئ', 'ی'), ('آ', 'ا'), ('أ', 'ا'), ('ة', 'ه')]:
+        s = s.str.replace(a, b, regex = False)
+    return s.str.replace('[\\s\u200c\u200d\u200e\u200f\u0651]', '', regex = True)
+
+
+def jalali_columns(columns):
+    """
+    Jalali year and month for each wide month column label (Apr_2011 -> 1390, 1).
+    """
+    out = {}
+    for col in columns:
+        m = MONTH_COLUMN.match(col)
+        if m:
+            g_mth, g_yr = MONTH_LABELS[m.group(1)], int(m.group(2))
+            out[col] = (g_yr - 621 if g_mth >= 4 else g_yr - 622, (g_mth - 4) % 12 + 1)
+    return out
+
+
+def jalali_to_gregorian(j_year, j_month):
+    """
+    Gregorian year and month of the first day of each jalali month, like addGregorian but
+    computed once per distinct (year, month) pair and then mapped. Non-numeric values give NaN.
+    """
+    yr = pd.to_numeric(pd.Series(j_year), errors = 'coerce')
+    mth = pd.to_numeric(pd.Series(j_month), errors = 'coerce')
+    pairs = pd.DataFrame({'y': yr.values, 'm': mth.values}).dropna().drop_duplicates()
+
+    dates = [jdatetime.date(int(y), int(m), 1).togregorian() for y, m in zip(pairs['y'], pairs['m'])]
+    lookup = pd.DataFrame({'y': pairs['y'].values, 'm': pairs['m'].values,
+                           'year': [d.year for d in dates], 'month': [d.month for d in dates]})
+
+    out = pd.DataFrame({'y': yr.values, 'm': mth.values}).merge(lookup, how = 'left', on = ['y', 'm'])
+    return out['year'].values, out['month'].values
+
+
+def melt_monthly(wide, id_cols = ('OBJECTID', 'ID')):
+    """
+    Reshapes the wide monthly columns into one row per (ID, month) in a single melt.
+    Returns id columns plus jalali Outbreak_yr/Outbreak_mth, gregorian year/month and cases.
+    """
+    labels = jalali_columns(wide.columns)
+
+    long = wide.melt(id_vars = list(id_cols), value_vars = list(labels), var_name = 'label', value_name = 'cases')
+
+    ## The date parts are worked out per column label, then mapped onto the rows
+    label_tbl = pd.DataFrame.from_dict(labels, orient = 'index', columns = ['Outbreak_yr', 'Outbreak_mth'])
+    long = long.join(label_tbl, on = 'label').drop(columns = 'label')
+    long['year'], long['month'] = jalali_to_gregorian(long['Outbreak_yr'], long['Outbreak_mth'])
+
+    return long
+
+
+def county_keys(national, iran_data):
+    """
+    Maps the national layer's ID onto shapefile county names (county_en) by normalized Persian
+    county name, with MANUAL_IDS for the ones that differ. Returns a Series indexed by ID.
+    """
+    fa_to_en = dict(zip(normalize_fa(iran_data['county_fa']), iran_data['county_en']))
+    keys = pd.Series(normalize_fa(national['SHAHRESTAN']).map(fa_to_en).values, index = national['ID'].values)
+    manual = pd.Series(MANUAL_IDS)
+    keys.update(manual[manual.index.isin(keys.index)])
+    return keys
+
+
+def national_crosswalk(fp, iran_data):
+    """
+    Crosswalk from the national layer's counties (source = ID) to today's counties (target = county_en),
+    weighted by area (crosswalk.area_crosswalk). Needs both layers' polygons; if either is missing the
+    crosswalk is the one-to-one name keys (county_keys) with weight 1.
+    """
+    shp = os.path.splitext(os.path.join(fp, NATIONAL_LAYER))[0] + '.shp'
+    if 'geometry' in iran_data and os.path.exists(shp):
+        national = read_national(fp, ['ID'], geometry = True)
+        return area_crosswalk(national, iran_data, 'ID', 'county_en')
+
+    national = read_national(fp, ['ID', 'SHAHRESTAN', 'OSTAN'])
+    return crosswalk_from_mapping(county_keys(national, iran_data).dropna().to_dict())
+
+
+def load_national_0911(fp = None, iran_data = None, xwalk = None):
+    """
+    Human cases 2009-2011 as a long county-month table on today's counties: county_en, Outbreak_yr,
+    Outbreak_mth (jalali), year, month (gregorian) and cases. The (ID, month) cube is reallocated
+    through xwalk (national_crosswalk by default), so counts are shared between the counties an
+    old county was split into.
+    """
+    fp = os.getcwd() if fp is None else fp
+    wide = pd.read_csv(os.path.join(fp, 'Data', 'Human_Brucellosis_09_11.csv'))
+    if iran_data is None:
+        iran_data = read_iran(fp, ['ADM2_EN', 'ADM2_FA'], geometry = False)
+    if xwalk is None:
+        xwalk = national_crosswalk(fp, iran_data)
+
+    long = melt_monthly(wide)
+
+    ## The melted counts must add back up to each row's 'total' column
+    assert np.isclose(long['cases'].sum(), wide['total'].sum())
+
+    cube, ids, months = county_month_array(long, 'cases', county_col = 'ID')
+    cube, counties, dropped = reallocate(cube, ids, xwalk.astype({'source': ids.dtype}))
+    if dropped:
+        print('National cases with no county in the crosswalk:', dropped)
+
+    out = array_to_long(cube, counties, months, 'cases')
+    dates = long[['year', 'month', 'Outbreak_yr', 'Outbreak_mth']].drop_duplicates()
+    out = out.merge(dates, how = 'inner', on = ['year', 'month'])
+    return out[['county_en', 'Outbreak_yr', 'Outbreak_mth', 'year', 'month', 'cases']].sort_values(['county_en', 'year', 'month'],
+                                                                                                    ignore_index = True)
+
+
+def combine_series(old, new, county_col = 'County', yr_col = 'Outbreak_yr', mth_col = 'Outbreak_mth'):
+    """
+    Stacks the 2009-2011 counts with 2015-2018 county-month counts into one long table.
+    new is either the register-level county counts from streaming_ingest.stream_human_counts
+    (indexed by County, Outbreak_yr, Outbreak_mth) or any frame with those columns and a 'cases' column.
+    """
+    new = new.reset_index() if county_col not in new.columns else new.copy()
+    new = new.rename(columns = {county_col: 'county_en'})
+    new['Outbreak_yr'] = pd.to_numeric(new[yr_col], errors = 'coerce')
+    new['Outbreak_mth'] = pd.to_numeric(new[mth_col], errors = 'coerce')
+    new = new.dropna(subset = ['county_en', 'Outbreak_yr', 'Outbreak_mth'])
+    new['year'], new['month'] = jalali_to_gregorian(new['Outbreak_yr'], new['Outbreak_mth'])
+
+    cols = ['county_en', 'Outbreak_yr', 'Outbreak_mth', 'year', 'month', 'cases']
+    both = pd.concat([old[cols], new[cols]], ignore_index = True)
+    both[['Outbreak_yr', 'Outbreak_mth', 'year', 'month']] = both[['Outbreak_yr', 'Outbreak_mth', 'year', 'month']].astype(int)
+
+    return both.groupby(cols[:-1], as_index = False)['cases'].sum()
+
+
+#%%
+if __name__ == '__main__':
+
+    old = load_national_0911()
+    print(old.head())
+    print(old.groupby('Outbreak_yr')['cases'].sum())
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+Province and county name matching for the registers
+
+The name matching helpers (match_names, likely_matches, map_caps), the province name and
+manual county dictionaries, and the cleaning steps that use them. data_merge2.py and the
+branches of clean_pipeline.py both call these, so the two entry points link names the same way:
+
+    xwalk = read_crosswalk('county_crosswalk.csv')
+    human_data, links, conflicts = human_places(human_data, iran_data, xwalk = xwalk)
+    animal_data, links, conflicts = animal_places(animal_data, iran_data, xwalk = xwalk)
+    ses_data = ses_provinces(ses_data, iran_data)
+"""
+
+import contextlib
+import numpy as np
+import pandas as pd
+import Levenshtein as leven
+
+from name_candidates import RankedCandidates
+from record_linkage import link_counties, apply_links
+from crosswalk import rename_map
+from streaming_ingest import HUMAN_PROVINCES
+
+
+## Register province names -> shapefile province names (the Kermanshah pair of the animal
+## dictionary was inverted twice in data_merge2, so it mapped Kermanshah to the misspelling)
+HUMAN_PROVINCE_NAMES = {'Azarbaijan Gharbi':'West Azerbaijan', 'Azarbaijan Sharghi':'East Azerbaijan',
+                        'Chaharmahal & bakhtiari':'Chaharmahal and Bakhtiari', 'Esfahan':'Isfahan',
+                        'Khorasan Jonobi':'South Khorasan', 'Khorasan Shomali':'North Khorasan',
+                        'Khorasan Razavi':'Razavi Khorasan', 'Kohgiluyeh & Boyerahmad':'Kohgiluyeh and Boyer-Ahmad',
+                        'Kordestan':'Kurdistan', 'Sistan & Bluchestan':'Sistan and Baluchestan'}
+
+ANIMAL_PROVINCE_NAMES = {'West Azarbayjan':'West Azerbaijan', 'East Azarbayjan':'East Azerbaijan',
+                         'Chaharmahal & bakhtiari':'Chaharmahal and Bakhtiari', 'Esfahan':'Isfahan',
+                         'Khorasan Jonobi':'South Khorasan', 'Khorasan Shomali':'North Khorasan',
+                         'Khorasan Razavi':'Razavi Khorasan', 'Sistan & Bluchestan':'Sistan and Baluchestan',
+                         'Hamedan':'Hamadan', 'Kermanshan':'Kermanshah',
+                         'Kohgiluyeh and BoyerAhmad':'Kohgiluyeh and Boyer-Ahmad', 'Kordestan':'Kurdistan',
+                         'South Kerman':'Kerman'}
+
+## Manual county matching (human register -> shapefile): spellings only. Historical and sub-county
+## names folded onto today's counties are in county_crosswalk.csv (crosswalk.py)
+HUMAN_MANUAL = {
+    'Ali Abad Katul':'Aliabad',
+    'Bafgh':'Bafq',
+    'Bandar Qaz':'Bandar-e-Gaz',
+    'Dailam':'Deylam',
+    'Gonbad  kavoos':'Gonbad-e-Kavus',
+    'Ijroud':'Eejrud',
+    'Jovein':'Jowayin',
+    'Kalale':'Kolaleh',
+    'Mahvalat':'Mahvelat',
+    'Menojan':'Manujan', ## auto-matched incorrectly
+    'Neyshabur':'Nishapur',
+    'Orzoieyeh':'Arzuiyeh',
+    'Ray':'Rey',
+    'Tiran o Karvan':'Tiran-o-Korun',
+    'Agh Ghala':'Aqqala',
+    'Gilan Qarb':'Gilan-e-Gharb',
+    'Kharame':'Kherameh',
+    'Maraqe':'Maragheh',
+    'Zaveh':'Zave',
+    'Bandar Mahshahr':'Mahshahr',
+    'Qale ganj':'Ghaleye-Ganj'
+              }
+
+## Manual county matching (animal tests -> shapefile)
+ANIMAL_MANUAL = {
+    'Aran and Bidgol':'Aran-o-Bidgol',
+    'Buin and Miandasht':'Booeino Miyandasht',
+    'Deyr':'Dayyer',
+    'Haftkel':'Haftgol',
+    'Ijrud':'Eejrud',
+    'Maneh asd Samalgan':'Maneh-o-Samalqan',
+    'Orzueeyeh':'Arzuiyeh',
+    'Qaleh Ganj':'Ghaleye-Ganj',
+    'Qir and Karzin':'Qir-o-Karzin',
+    'Raz and Jargalan':'Razo Jalgelan',
+    'Sib and Suran':'Sibo Soran',
+    'Tiran and Karvan':'Tiran-o-Korun',
+    'Torqebeh and Shandiz(Binalud)':'Torghabe-o-Shandiz',
+    'Zaveh':'Zave',
+    'Chardavol':'Shirvan-o-Chardavol',
+    'Torkaman':'Bandar-e-Torkaman',
+    'mahshahr':'Mahshahr',
+    'Kohgiluyeh and BoyerAhmad':'Kohgeluyeh'
+              }
+
+
+######### Functions #############
+
+## Function to match potential misspelled strings
+## Takes two pandas series, calculates Levenshtein distance to identify potential matches
+## Used in the likely_matches function
+## With as_df = False, top limits each name's candidates to the best top targets (all if None)
+def match_names(s1, s2, as_df = True, caps = True, unique = True, top = None):
+
+    s1 = pd.Series(s1)
+    s2 = pd.Series(s2)
+
+    ## Unique values in each series
+    vals1 = s1.unique()
+    vals2 = s2.unique()
+
+    ## If unique argument is set to true, only match names that don't already have perfect match
+    if unique == True:
+
+        ## Unique values in series 1 that aren't in series 2
+        vals1 = pd.Series(np.setdiff1d(vals1, vals2))
+
+        ## Unique values in series 2 that aren't in series 1
+        vals2 = pd.Series(np.setdiff1d(vals2, vals1))
+
+    if caps == True:
+
+        ## Capitalize before matching
+        vals1 = vals1.str.capitalize()
+        vals2 = vals2.str.capitalize()
+
+    ## Calculate Levenshtein distance and ratio
+    dists = np.array([leven.distance(name1, name2) for name1 in vals1 for name2 in vals2])
+    ratios = np.array([leven.ratio(name1, name2) for name1 in vals1 for name2 in vals2])
+
+    ## Reshape and convert to df so we can identify which values are for which name combo
+    dists_df = pd.DataFrame(data = dists.reshape(len(vals1), len(vals2)), index = vals1, columns = vals2)
+    ratios_df = pd.DataFrame(data = ratios.reshape(len(vals1), len(vals2)), index = vals1, columns = vals2)
+
+    if as_df == True:
+
+        ## Get column names where min distance and max ratio occurs
+        matches = pd.DataFrame({'name_dist': dists_df.idxmin(axis = 1),
+                                'name_ratio': ratios_df.idxmax(axis = 1),
+                                'dist': dists_df.min(axis = 1),
+                                'ratio': ratios_df.max(axis = 1)})
+
+        return(matches)
+
+    ## If user wants more detail, we can return the ranked candidates for each name
+    ## This works like a dictionary with names as keys and dataframes as values
+    ## Each dataframe contains the possible name pairings sorted by distance (as opposed to above, which only supplies best possible values)
+    ## The rankings for all names are computed at once from the same matrices; each dataframe is only built when it's looked up
+    else:
+
+        comb_dict = RankedCandidates(vals1, vals2, dists_df.values, ratios_df.values, top = top)
+
+        return(comb_dict)
+
+## Function to return highly probable string matches - the rest will have to be done manually
+## Depends on match_names function
+## The index of the resulting df contains values from the *first* series passed to the function
+def likely_matches(s1, s2, cutoff = 0.75, as_df = True, caps = True, unique = True):
+
+    ## Create dataframe recording potential name matches
+    matched = match_names(s1, s2, as_df = as_df, caps = caps, unique = unique)
+
+    ## Add column recording whether distance and ratio identify the same match
+    matched['name_match'] = (matched['name_dist'] == matched['name_ratio'])
+
+    ## Can be highly confident when nameMatch = True, ratio >= .75 - this matches 145 of the 192 that need matches
+    matched['matched'] = np.where((matched['name_match'] == True) & (matched['ratio'] >= cutoff), matched['name_dist'], 'NULL')
+
+    return(matched)
+
+## Little helper function that creates a dictionary mapping capitalized values
+## to original values (so we can go back and forth more easily)
+def map_caps(s1):
+
+    s1 = pd.Series(s1)
+
+    ## Capitalize series values
+    s1_caps = s1.str.capitalize().unique()
+
+    ## Map original values to capitalized values
+    caps_mappings = {name1:name2 for name1, name2 in zip(s1_caps, s1.unique())}
+
+    return(caps_mappings)
+
+
+def automatch(names, targets, cutoff = 0.75):
+    """
+    The likely_matches pairs as a dict from the original names to the original target spellings.
+    """
+    names = pd.Series(names).dropna()
+    targets = pd.Series(targets).dropna()
+    matched = likely_matches(names.unique(), targets.unique(), cutoff = cutoff)
+    matched = matched[matched['matched'] != 'NULL']
+    return dict(zip(matched.index.map(map_caps(names)), matched['matched'].map(map_caps(targets))))
+
+
+def _with_crosswalk(manual, xwalk):
+    """
+    The manual dict plus the whole-unit renames of a crosswalk (see crosswalk.rename_map).
+    """
+    if xwalk is None:
+        return manual
+    return {**manual, **rename_map(xwalk)}
+
+
+def human_province_names(provinces):
+    """
+    Shapefile province names for the human register's provinces (duplicate spellings fixed first).
+    """
+    return provinces.replace(HUMAN_PROVINCES).replace(HUMAN_PROVINCE_NAMES)
+
+
+def _matching_stage(log, name, data):
+    """
+    A stage of log (stage_timing.RunLog) around the name matching, or nothing without a log.
+    """
+    return log.stage(name, data) if log is not None else contextlib.nullcontext()
+
+
+def human_places(human_data, iran_data, manual = HUMAN_MANUAL, xwalk = None, log = None):
+    """
+    Shapefile province names for the human register, then (province, county) pairs linked to the
+    shapefile counties. Only the manual dict and the crosswalk (read_crosswalk) override the name
+    matching. Records from conflicting or unmatched pairs get no county, so they don't join to a
+    polygon. With a RunLog the matching is recorded as its own stage (human_name_matching).
+    Returns the records, the links and the conflict report.
+    """
+    manual = _with_crosswalk(manual, xwalk)
+    human_data = human_data.copy()
+    human_data['Province'] = human_province_names(human_data['Province'])
+    with _matching_stage(log, 'human_name_matching', human_data):
+        links, conflicts = link_counties(human_data, iran_data, 'Province', 'County', manual = manual)
+        human_data['County'] = apply_links(human_data, links, 'Province', 'County')['county_en'].values
+    return human_data, links, conflicts
+
+
+def animal_places(animal_data, iran_data, manual = ANIMAL_MANUAL, xwalk = None, log = None):
+    """
+    As human_places for the animal tests (stage animal_name_matching), also using whether the test
+    locations fall inside the county (when iran_data has its polygons).
+    """
+    manual = _with_crosswalk(manual, xwalk)
+    animal_data = animal_data.copy()
+    animal_data['province'] = animal_data['province'].replace(ANIMAL_PROVINCE_NAMES)
+    with _matching_stage(log, 'animal_name_matching', animal_data):
+        links, conflicts = link_counties(animal_data, iran_data, 'province', 'county', lat_col = 'lat', lon_col = 'long', manual = manual)
+        animal_data['county'] = apply_links(animal_data, links, 'province', 'county')['county_en'].values
+    return animal_data, links, conflicts
+
+
+def ses_provinces(ses_data, iran_data):
+    """
+    Automatches the SES province names to the shapefile province names.
+    """
+    ses_data = ses_data.copy()
+    ses_data['province'] = ses_data['province'].map(automatch(ses_data['province'], iran_data['province_en'])).fillna(ses_data['province'])
+    return ses_data
+
+
+#%%
+if __name__ == '__main__':
+
+    import synthetic_data as syn
+    from streaming_ingest import clean_human
+    from crosswalk import read_crosswalk
+
+    gaz = syn.gazetteer(429)
+    human_data = clean_human(syn.human_register(20000, gaz, share_misspelled = 0.1), {})
+    linked, links, conflicts = human_places(human_data, gaz, xwalk = read_crosswalk('county_crosswalk.csv'))
+
+    print(links['status'].value_counts())
+    print('{:.1%} of records on a shapefile county'.format(linked['County'].isin(gaz['county_en']).mean()))
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+County population denominators
+
+Data/pop_by_county.csv is the 2016 (1395) census table: a country row, then each province
+row followed by its counties, and under every one of those the 'Setteled in urban areas',
+'Settled in rural areas' and 'Unsettled ' breakdown rows. Only some province rows are
+indented and one province is mislabelled (South Khorasan appears as a second
+'Khorasan-e-Razavi'), so provinces are found by the hierarchy itself: a province's
+population is exactly the sum of the counties that follow it.
+
+Counties are then linked to the shapefile within their province and keyed by ADM2_PCODE.
+Denominators projects those populations to every month (log-linear between censuses,
+national growth outside them) once, so lookups for a county-month table or array are
+plain array indexing.
+
+    den = load_denominators(fp)
+    pop = den.lookup(human['county_en'], human['year'], human['month'])
+    rate = cases_arr/den.array(counties, months)
+"""
+
+import os
+import functools
+import numpy as np
+import pandas as pd
+
+from county_month import month_key
+from streaming_ingest import read_mapping
+from layer_cache import read_iran
+from record_linkage import link_counties, _ratio_matrix
+
+
+## Breakdown rows under every unit, after stripping
+SUB_ROWS = {'Setteled in urban areas': 'urban', 'Settled in rural areas': 'rural', 'Unsettled': 'unsettled'}
+
+NUMBER_COLUMNS = ['Population', 'Male', 'Female', 'Household']
+
+## Census reference month (Mehr of the census year) as a month key
+CENSUS_MONTH = {2011: month_key(2011, 10)[0], 2016: month_key(2016, 10)[0]}
+
+## National totals, for growth outside the county census years
+NATIONAL_TOTALS = {2011: 75149669, 2016: 79926270}
+
+## Corrections and additions to pop_data_mappings.csv: Orumiyeh and Khosaf were mapped to counties in other
+## provinces (which is why data_merge2 added Urumia and Khusf by hand), Keyar to a misspelling, and the rest
+## were only in data_merge2's manual dict
+CENSUS_NAMES = {'Orumiyeh': 'Urumia',
+                'Khosaf': 'Khusf',
+                'Keyar': 'Kiaar',
+                'Nayer': 'Nir',
+                'Binalood': 'Torghabe-o-Shandiz',
+                'Savadkuh-e Shomali': 'Northern Savadkooh'}
+
+## Default month range of the denominator grid
+START, END = (2008, 1), (2020, 12)
+
+
+######### Functions #############
+def parse_census(path):
+    """
+    Reads the census table into one row per unit (country, province, county) with
+    population, male, female, household and the urban/rural/unsettled populations.
+    """
+    raw = pd.read_csv(path, dtype = str)
+    raw['indented'] = raw['Description'].str.match(r'^\s')
+    raw['Description'] = raw['Description'].str.strip()
+    for col in NUMBER_COLUMNS:
+        raw[col] = pd.to_numeric(raw[col].str.replace(',', ''), errors = 'coerce')
+
+    ## Breakdown rows belong to the unit above them
+    sub = raw['Description'].map(SUB_ROWS)
+    raw['unit'] = (~sub.notna()).cumsum() - 1
+    units = raw[sub.isna()].set_index('unit')
+    breakdown = raw[sub.notna()].assign(part = sub[sub.notna()]).pivot_table(index = 'unit', columns = 'part',
+                                                                             values = 'Population', aggfunc = 'sum')
+    units = units.join(breakdown)
+
+    ## Walk the units: a province row is followed by counties adding up to exactly its population
+    pops = units['Population'].values
+    level = np.array(['county']*len(units), dtype = object)
+    level[0] = 'country'
+    province = np.empty(len(units), dtype = np.int64)
+    province[0] = -1
+    i = 1
+    while i < len(units):
+        level[i] = 'province'
+        province[i] = i
+        total, j = 0, i + 1
+        while j < len(units) and total < pops[i]:
+            total += pops[j]
+            province[j] = i
+            j += 1
+        if total != pops[i]:
+            raise ValueError('Counties after {} add up to {}, not {}'.format(units['Description'].iloc[i], total, pops[i]))
+        i = j
+
+    units['level'] = level
+    units['census_province'] = units['Description'].values[np.maximum(province, 0)]
+    units['province_row'] = province
+
+    bad = units['indented'] & (units['level'] != 'province')
+    if bad.any():
+        raise ValueError('Indented rows that are not provinces: {}'.format(list(units.loc[bad, 'Description'])))
+
+    cols = ['level', 'province_row', 'census_province', 'Description', 'Population', 'Male', 'Female', 'Household',
+            'urban', 'rural', 'unsettled']
+    return units[cols].rename(columns = {'Description': 'name', 'Population': 'population', 'Male': 'male',
+                                         'Female': 'female', 'Household': 'household'}).reset_index(drop = True)
+
+
+def census_provinces(census, gazetteer, mapping):
+    """
+    Shapefile province of each census province block, by majority of its counties' names
+    (exact or through mapping), falling back to the closest province name.
+    """
+    cty = census[census['level'] == 'county']
+    names = cty['name'].map(mapping).fillna(cty['name'])
+    votes = pd.DataFrame({'block': cty['province_row'], 'province_en': names.map(dict(zip(gazetteer['county_en'], gazetteer['province_en'])))})
+    prov = votes.dropna().groupby('block')['province_en'].agg(lambda s: s.value_counts().index[0])
+
+    blocks = census.loc[census['level'] == 'province', ['province_row', 'name']].set_index('province_row')['name']
+    missing = blocks.index.difference(prov.index)
+    if len(missing):
+        choices = gazetteer['province_en'].unique()
+        ratios = _ratio_matrix(blocks[missing], choices)
+        prov = pd.concat([prov, pd.Series(choices[ratios.argmax(axis = 1)], index = missing)])
+    return prov
+
+
+def county_populations(census, iran_data, mapping = None):
+    """
+    Census county populations keyed by the shapefile county ID (ADM2_PCODE), linked within province.
+    Returns county_en, province_en, census_name and the population columns, plus a conflicts frame
+    of census counties that couldn't be linked.
+    """
+    mapping = dict(mapping or {})
+    mapping.update(CENSUS_NAMES)
+
+    gazetteer = pd.DataFrame(iran_data)[['ADM2_PCODE', 'county_en', 'province_en']]
+    prov = census_provinces(census, gazetteer, mapping)
+
+    cty = census[census['level'] == 'county'].copy()
+    cty['province_en'] = cty['province_row'].map(prov)
+
+    links, conflicts = link_counties(cty, gazetteer, 'province_en', 'name', manual = mapping)
+    cty = cty.merge(links[['province', 'county', 'county_en']], how = 'left',
+                    left_on = ['province_en', 'name'], right_on = ['province', 'county'])
+    cty = cty.dropna(subset = ['county_en']).drop(columns = ['province', 'county', 'province_row', 'level'])
+
+    ## Several census counties can fold into one polygon (and the other way round is left unmatched)
+    num = ['population', 'male', 'female', 'household', 'urban', 'rural', 'unsettled']
+    out = cty.groupby('county_en', as_index = False).agg({**{c: 'sum' for c in num}, 'name': ' + '.join})
+    out = gazetteer.merge(out, how = 'left', on = 'county_en').rename(columns = {'name': 'census_name'})
+    return out.set_index('ADM2_PCODE'), conflicts
+
+
+def monthly_growth(totals = NATIONAL_TOTALS):
+    """
+    Monthly growth factor between the two national census totals.
+    """
+    (y0, p0), (y1, p1) = sorted(totals.items())[:2]
+    return (p1/p0)**(1.0/(CENSUS_MONTH[y1] - CENSUS_MONTH[y0]))
+
+
+class Denominators:
+    """
+    County x month population grid. populations is a frame indexed by county ID with one
+    column per census year (e.g. {2016: ...}); names optionally maps county_en to ID so
+    lookups can use either.
+    """
+    def __init__(self, populations, names = None, start = START, end = END, growth = None):
+        populations = pd.DataFrame(populations)
+        self.ids = pd.Index(populations.index)
+        self.months = np.arange(month_key(*start)[0], month_key(*end)[0] + 1, dtype = int)
+        self.names = pd.Series(dtype = object) if names is None else pd.Series(names)
+        growth = monthly_growth() if growth is None else growth
+
+        years = sorted(populations.columns)
+        keys = np.array([CENSUS_MONTH[y] for y in years], dtype = float)
+        logp = np.log(populations[years].values.astype(float))
+
+        ## Log-linear between census months; outside them, the national rate
+        t = self.months.astype(float)
+        if len(years) == 1:
+            grid = logp[:, [0]] + (t - keys[0])[None, :]*np.log(growth)
+        else:
+            grid = np.empty((len(self.ids), len(t)))
+            for i in range(len(self.ids)):
+                grid[i] = np.interp(t, keys, logp[i])
+            grid += np.where(t < keys[0], (t - keys[0])*np.log(growth), 0)[None, :]
+            grid += np.where(t > keys[-1], (t - keys[-1])*np.log(growth), 0)[None, :]
+        self.grid = np.exp(grid)
+
+    def rows(self, counties):
+        """
+        Grid rows for county IDs or county_en names (-1 where unknown).
+        """
+        counties = pd.Index(counties)
+        rows = self.ids.get_indexer(counties)
+        if len(self.names) and (rows < 0).any():
+            by_name = self.ids.get_indexer(pd.Index(self.names.reindex(counties).values))
+            rows = np.where(rows < 0, by_name, rows)
+        return rows
+
+    def lookup(self, counties, years, months):
+        """
+        Population for each (county, year, month) record; NaN where the county or month is outside the grid.
+        """
+        rows = self.rows(counties)
+        cols = month_key(years, months) - self.months[0]
+        ok = (rows >= 0) & ~np.isnan(cols) & (cols >= 0) & (cols < len(self.months))
+        out = np.full(len(rows), np.nan)
+        out[ok] = self.grid[rows[ok], cols[ok].astype(int)]
+        return out
+
+    def array(self, counties, months):
+        """
+        Populations on the same axes as a county_month_array result (county index, integer month keys).
+        """
+        rows = self.rows(counties)
+        cols = np.asarray(months, dtype = int) - self.months[0]
+        out = np.full((len(rows), len(cols)), np.nan)
+        ok_c = (cols >= 0) & (cols < len(self.months))
+        sub = self.grid[np.ix_(rows[rows >= 0], cols[ok_c])]
+        out[np.ix_(np.flatnonzero(rows >= 0), np.flatnonzero(ok_c))] = sub
+        return out
+
+
+@functools.lru_cache(maxsize = 4)
+def load_denominators(fp, start = START, end = END):
+    """
+    Parses the census under the project folder fp, links it to the county layer and builds the
+    monthly grid (cached per arguments).
+    Counties without a census population are left out of the grid.
+    """
+    census = parse_census(os.path.join(fp, 'Data', 'pop_by_county.csv'))
+    iran_data = read_iran(fp, ['ADM2_PCODE', 'ADM2_EN', 'ADM1_EN'], geometry = False)
+    pops, _ = county_populations(census, iran_data, read_mapping(os.path.join(fp, 'pop_data_mappings.csv')))
+    pops = pops.dropna(subset = ['population'])
+    return Denominators(pops[['population']].rename(columns = {'population': 2016}),
+                        names = pd.Series(pops.index, index = pops['county_en']), start = start, end = end)
+
+
+#%%
+if __name__ == '__main__':
+
+    census = parse_census(os.path.join('Data', 'pop_by_county.csv'))
+    print(census['level'].value_counts())
+    print(census[census['level'] == 'province'][['census_province', 'population']])
+
+    iran_data = read_iran(columns = ['ADM2_PCODE', 'ADM2_EN', 'ADM1_EN'], geometry = False)
+    pops, conflicts = county_populations(census, iran_data, read_mapping('pop_data_mappings.csv'))
+    print('Counties with a population:', pops['population'].notna().sum(), 'of', len(pops))
+    print(pops[pops['population'].isna()])
+    print(conflicts[['province', 'county', 'status', 'reason']])
+
+    den = load_denominators(os.getcwd())
+    print(den.lookup(['Urumia', 'IR015001', 'Tehran'], [2016, 2016, 2010], [10, 10, 1]))
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""
+Local query service over the county-month store
+
+Questions like "incidence in Hamedan in 2016 against NDVI" need a re-run of the scripts.
+This keeps every county-month variable as a (county, month) .npy array on shared axes
+(the store), opens them memory-mapped, and answers slices, aggregates and Moran / regression
+summaries over a small HTTP API on localhost (standard library only):
+
+    build_store(store_from_clean(fp), 'Data/store')
+    serve('Data/store')                      ## http://127.0.0.1:8765
+
+    GET /variables
+    GET /query?vars=incidence,ndvi&county=Hamedan&start=2016-01&end=2016-12
+    GET /aggregate?vars=cases&by=province&how=sum&start=2016-01&end=2016-12
+    GET /moran?var=incidence&start=2016-01&end=2016-12
+    GET /regress?y=incidence&x=ndvi,mean_2m_air_temperature&province=Hamedan
+
+Filters are county, province (comma separated lists), start and end (YYYY-MM). Results
+are cached per normalized query, so repeated dashboard requests skip the computation.
+"""
+
+import os
+import json
+import functools
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from county_month import month_key, key_to_period, county_month_array
+
+
+## Default store folder (relative to the working directory when the store is built or opened)
+STORE_DIR = os.path.join('Data', 'store')
+
+## Environmental variables in yearlyParams.csv / allParams.csv ('mean' is NDVI)
+ENV_NAMES = {'mean_2m_air_temperature': 'mean_2m_air_temperature', 'total_precipitation': 'total_precipitation', 'mean': 'ndvi'}
+
+
+######### Functions #############
+def env_arrays(wide, counties, months, county_col = 'ADM2_EN', names = ENV_NAMES):
+    """
+    (county, month) arrays from a wide Earth Engine table with <variable>_YYYYMM columns.
+    """
+    if county_col not in wide and wide.index.name == county_col:
+        wide = wide.reset_index()
+    wide = wide.drop_duplicates(county_col).set_index(county_col).reindex(pd.Index(counties))
+    months = np.asarray(months, dtype = int)
+    out = {}
+    for var, name in names.items():
+        cols = [c for c in wide.columns if c.startswith(var + '_') and c[len(var) + 1:].isdigit() and len(c) == len(var) + 7]
+        keys = month_key([int(c[-6:-2]) for c in cols], [int(c[-2:]) for c in cols]).astype(int)
+        arr = np.full((len(counties), len(months)), np.nan)
+        pos = np.searchsorted(months, keys)
+        ok = (pos < len(months)) & (months[np.minimum(pos, len(months) - 1)] == keys)
+        arr[:, pos[ok]] = wide[np.array(cols)[ok]].to_numpy(dtype = float)
+        out[name] = arr
+    return out
+
+
+def store_from_clean(fp = None, start = (2015, 1), end = (2018, 12)):
+    """
+    County-month arrays from the cleaned tables (Data/clean), the census denominators and the
+    environmental parameters, on the shapefile counties and the given months. Sources that
+    haven't been written yet are skipped.
+    """
+    from layer_cache import read_iran
+    from clean_outputs import read_table
+    from population import load_denominators
+    from national_0911 import jalali_to_gregorian
+
+    fp = os.getcwd() if fp is None else fp
+    clean = os.path.join(fp, 'Data', 'clean')
+    iran_data = read_iran(fp, ['ADM2_PCODE', 'ADM2_EN', 'ADM1_EN'], geometry = False)
+    counties = pd.Index(iran_data['county_en'])
+    months = np.arange(month_key(*start)[0], month_key(*end)[0] + 1, dtype = int)
+    arrays = {}
+
+    if os.path.exists(os.path.join(clean, 'human.feather')):
+        human = read_table('human', clean, ['county_en', 'Outbreak_yr', 'Outbreak_mth'])
+        human['year'], human['month'] = jalali_to_gregorian(human['Outbreak_yr'], human['Outbreak_mth'])
+        arrays['cases'], _, _ = county_month_array(human, counties = counties, months = months)
+        arrays['population'] = load_denominators(fp).array(counties, months)
+        arrays['incidence'] = 1e5*arrays['cases']/arrays['population']
+
+    for table, cols in [('animal_county_month', ['n_sample', 'n_infected', 'animal_inf_rate']),
+                        ('vaccination_county_month', ['animal_vac_cov', 'human_vac_cov'])]:
+        if os.path.exists(os.path.join(clean, table + '.feather')):
+            df = read_table(table, clean).rename(columns = {'county': 'county_en'})
+            for col in cols:
+                if col in df:
+                    arrays[col], _, _ = county_month_array(df, col, counties = counties, months = months, fill = np.nan)
+
+    env_file = os.path.join(fp, 'Data', 'yearlyParams.csv')
+    if os.path.exists(env_file):
+        arrays.update(env_arrays(pd.read_csv(env_file), counties, months))
+
+    return {'counties': counties, 'provinces': iran_data['province_en'].values, 'months': months, 'arrays': arrays}
+
+
+def build_store(store, out_dir = STORE_DIR, W = None):
+    """
+    Writes a store dict (counties, provinces, months, arrays) as one .npy per variable plus
+    index.json, and the contiguity matrix W (county order) if given.
+    """
+    os.makedirs(out_dir, exist_ok = True)
+    for name, arr in store['arrays'].items():
+        np.save(os.path.join(out_dir, name + '.npy'), np.asarray(arr, dtype = np.float64))
+    index = {'counties': list(map(str, store['counties'])), 'provinces': list(map(str, store['provinces'])),
+             'months': [int(m) for m in store['months']], 'variables': sorted(store['arrays'])}
+    with open(os.path.join(out_dir, 'index.json'), 'w') as f:
+        json.dump(index, f)
+    if W is not None:
+        sparse.save_npz(os.path.join(out_dir, 'weights.npz'), sparse.csr_matrix(W))
+    return out_dir
+
+
+def _period(value):
+    """
+    Month key of a 'YYYY-MM' string (None passes through).
+    """
+    if value in (None, ''):
+        return None
+    y, m = str(value).split('-')
+    return int(month_key(int(y), int(m))[0])
+
+
+class Store:
+    """
+    Memory-mapped county-month store with cached query results.
+    """
+    def __init__(self, path = STORE_DIR, cache_size = 256):
+        self.path = path = os.path.abspath(path)
+        with open(os.path.join(path, 'index.json')) as f:
+            index = json.load(f)
+        self.counties = pd.Index(index['counties'])
+        self.provinces = np.asarray(index['provinces'], dtype = object)
+        self.months = np.asarray(index['months'], dtype = int)
+        self.variables = index['variables']
+        self._arrays = {}
+        w_file = os.path.join(path, 'weights.npz')
+        self.W = sparse.load_npz(w_file) if os.path.exists(w_file) else None
+        self.run = functools.lru_cache(maxsize = cache_size)(self._run)
+
+    def array(self, name):
+        if name not in self.variables:
+            raise KeyError('Unknown variable: {}'.format(name))
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.path, name + '.npy'), mmap_mode = 'r')
+        return self._arrays[name]
+
+    def _rows_cols(self, counties = (), provinces = (), start = None, end = None):
+        rows = np.ones(len(self.counties), dtype = bool)
+        if counties:
+            rows &= self.counties.str.lower().isin([c.lower() for c in counties])
+        if provinces:
+            rows &= pd.Index(self.provinces).str.lower().isin([p.lower() for p in provinces])
+        cols = np.ones(len(self.months), dtype = bool)
+        if start is not None:
+            cols &= self.months >= start
+        if end is not None:
+            cols &= self.months <= end
+        return np.flatnonzero(rows), np.flatnonzero(cols)
+
+    def select(self, variables, counties = (), provinces = (), start = None, end = None):
+        """
+        Long frame of county_en, province_en, month and the variables for the filtered cells.
+        """
+        rows, cols = self._rows_cols(counties, provinces, start, end)
+        out = pd.DataFrame({'county_en': np.repeat(self.counties.values[rows], len(cols)),
+                            'province_en': np.repeat(self.provinces[rows], len(cols)),
+                            'month': np.tile(key_to_period(self.months[cols]).astype(str), len(rows))})
+        for v in variables:
+            out[v] = np.asarray(self.array(v)[np.ix_(rows, cols)]).ravel()
+        return out
+
+    def aggregate(self, variables, by = 'county', how = 'sum', **filters):
+        """
+        Variables summed or averaged (NaN ignored) by county, province, month or year.
+        """
+        df = self.select(variables, **filters)
+        key = {'county': 'county_en', 'province': 'province_en', 'month': 'month'}.get(by)
+        if by == 'year':
+            df['year'] = df['month'].str[:4]
+            key = 'year'
+        if key is None:
+            raise ValueError('by must be county, province, month or year')
+        return df.groupby(key)[list(variables)].agg(how).reset_index()
+
+    def moran(self, var, permutations = 999, counties = (), provinces = (), start = None, end = None):
+        """
+        Global Moran's I of one variable for every month in the range, over the filtered counties.
+        Counties with no value in a month are left out of that month's I (with their links in W)
+        rather than counted as zeros; n is the number of counties used.
+        """
+        from moran_permutation import moran_global
+        if self.W is None:
+            raise ValueError('The store has no weights.npz')
+        rows, cols = self._rows_cols(counties, provinces, start, end)
+        y = np.asarray(self.array(var)[np.ix_(rows, cols)], dtype = float)
+        W = sparse.csr_matrix(self.W)[rows][:, rows]
+        ok = np.isfinite(y)
+
+        ## Months missing the same counties share one call
+        parts = []
+        patterns, inverse = np.unique(ok.T, axis = 0, return_inverse = True)
+        for i, keep in enumerate(patterns):
+            j = np.flatnonzero(inverse.ravel() == i)
+            Wk = W[keep][:, keep]
+            if keep.sum() < 3 or Wk.sum() == 0:
+                continue
+            parts.append(moran_global(y[np.ix_(keep, j)], Wk, permutations = permutations, workers = 1).set_index(j))
+
+        cols_out = ['I', 'EI', 'p_sim', 'EI_sim', 'seI_sim', 'z_sim']
+        res = (pd.concat(parts) if parts else pd.DataFrame(columns = cols_out)).reindex(range(len(cols)))
+        res.insert(0, 'month', key_to_period(self.months[cols]).astype(str))
+        res.insert(1, 'n', ok.sum(0))
+        return res.reset_index(drop = True)
+
+    def regress(self, y, x, **filters):
+        """
+        OLS of y on the x variables over the filtered county-months with no missing values.
+        """
+        df = self.select([y] + list(x), **filters).replace([np.inf, -np.inf], np.nan).dropna(subset = [y] + list(x))
+        X = np.column_stack([np.ones(len(df))] + [df[v].values for v in x])
+        coef, _, _, _ = np.linalg.lstsq(X, df[y].values, rcond = None)
+        resid = df[y].values - X @ coef
+        tss = ((df[y].values - df[y].values.mean())**2).sum()
+        return {'n': int(len(df)), 'coef': dict(zip(['const'] + list(x), coef.tolist())),
+                'r2': float(1 - (resid**2).sum()/tss) if tss > 0 else None}
+
+    def _run(self, route, key):
+        """
+        Answers one normalized query; cached by (route, key).
+        """
+        q = dict(key)
+        filters = {'counties': q.get('county', ()), 'provinces': q.get('province', ()),
+                   'start': _period(q.get('start', [None])[0]), 'end': _period(q.get('end', [None])[0])}
+        if route == 'variables':
+            out = {'variables': self.variables, 'months': [str(p) for p in key_to_period(self.months)],
+                   'counties': len(self.counties)}
+        elif route == 'query':
+            out = self.select(q.get('vars', self.variables), **filters)
+        elif route == 'aggregate':
+            out = self.aggregate(q['vars'], q.get('by', ['county'])[0], q.get('how', ['sum'])[0], **filters)
+        elif route == 'moran':
+            out = self.moran(q['var'][0], int(q.get('permutations', [999])[0]), **filters)
+        elif route == 'regress':
+            out = self.regress(q['y'][0], q['x'], **filters)
+        else:
+            raise KeyError('Unknown route: {}'.format(route))
+
+        if isinstance(out, pd.DataFrame):
+            out = json.loads(out.to_json(orient = 'records'))
+        return json.dumps(out).encode()
+
+    def query(self, url):
+        """
+        Response body for a request path like '/query?vars=cases&county=Hamedan'.
+        """
+        parsed = urlparse(url)
+        params = parse_qs(parsed.query)
+        ## Parameters in a fixed order; values keep the caller's order (it sets the column order)
+        key = tuple(sorted((k, tuple(v2 for v1 in vals for v2 in v1.split(',') if v2)) for k, vals in params.items()))
+        return self.run(parsed.path.strip('/') or 'variables', key)
+
+
+def make_handler(store):
+    """
+    Request handler class serving GET requests from store.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            try:
+                body, status = store.query(self.path), 200
+            except (KeyError, ValueError) as e:
+                body, status = json.dumps({'error': str(e)}).encode(), 400
+            except Exception as e:
+                ## Anything else is a bug, but the client still gets a JSON answer
+                body, status = json.dumps({'error': '{}: {}'.format(type(e).__name__, e)}).encode(), 500
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            pass
+    return Handler
+
+
+def serve(path = STORE_DIR, host = '127.0.0.1', port = 8765):
+    """
+    Serves the store at path on host:port until interrupted.
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(Store(path)))
+    print('Serving {} on http://{}:{}'.format(path, host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+#%%
+if __name__ == '__main__':
+
+    import time
+    import tempfile
+    import threading
+    from urllib.request import urlopen
+    import synthetic_data as syn
+
+    ## Synthetic store: 400 counties in 20 provinces, 4 years
+    n = 400
+    gaz = syn.gazetteer(n, real = None, n_provinces = 20)
+    months = np.arange(month_key(2015, 1)[0], month_key(2018, 12)[0] + 1)
+    env = syn.env_cube(gaz['county_en'], 2015, 2018)
+    arrays = env_arrays(env, gaz['county_en'], months)
+    rng = np.random.default_rng(0)
+    arrays['incidence'] = rng.gamma(2, size = (n, len(months))) + 0.05*arrays['ndvi']
+    out_dir = build_store({'counties': gaz['county_en'], 'provinces': gaz['province_en'], 'months': months, 'arrays': arrays},
+                          tempfile.mkdtemp(), W = syn.grid_counties(n))
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(Store(out_dir)))
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    base = 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+    county, province = gaz['county_en'].iloc[0], gaz['province_en'].iloc[0]
+    for url in ['/variables', '/query?vars=incidence,ndvi&county={}&start=2016-01&end=2016-03'.format(county),
+                '/aggregate?vars=incidence&by=province&how=mean&start=2016-01&end=2016-12',
+                '/regress?y=incidence&x=ndvi&province={}'.format(province),
+                '/moran?var=incidence&start=2016-01&end=2016-02&permutations=99',
+                '/moran?var=incidence&province={}&start=2016-01&end=2016-02&permutations=99'.format(province)]:
+        for attempt in ['first', 'cached']:
+            t0 = time.perf_counter()
+            body = urlopen(base + url).read()
+            print('{:8s} {:6.1f} ms  {}'.format(attempt, 1000*(time.perf_counter() - t0), url))
+        print('   ', body[:150])
+    server.shutdown()
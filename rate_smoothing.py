@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Rate smoothing for small-population counties
+
+The raw Incidence column (100000*cases/population) is very noisy for small counties.
+This stage computes global empirical Bayes, local empirical Bayes and spatial rate
+smoothed versions of a rate for every county and every month at once, and writes
+them back onto the analysis tables as extra columns.
+
+Works for the human incidence (cases over population) and the animal infection rate
+(n_infected over n_sample) alike.
+"""
+
+import numpy as np
+from scipy import sparse
+
+from county_month import month_key
+
+
+######### Functions #############
+def _as_2d(cases, pop):
+    """
+    Cases as a (county, month) float array and pop broadcast to the same shape.
+    1-d inputs (e.g. county totals) are treated as a single month.
+    """
+    cases = np.asarray(cases, dtype = float)
+    if cases.ndim == 1:
+        cases = cases[:, None]
+    pop = np.asarray(pop, dtype = float)
+    pop = np.broadcast_to(pop.reshape(len(cases), -1), cases.shape)
+    return cases, pop
+
+
+def _shrink(rate, prior_mean, prior_var, pop):
+    """
+    Empirical Bayes estimate: a weighted average of the raw rate and the prior mean,
+    with more weight on the prior when the population is small.
+    """
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        weight = prior_var/(prior_var + prior_mean/pop)
+    weight = np.where(np.isfinite(weight), weight, 0.0)
+    return weight*rate + (1 - weight)*prior_mean
+
+
+def global_eb(cases, pop):
+    """
+    Global empirical Bayes (Marshall) smoothed rates, one prior per month.
+    cases is (county, month); pop is (county,) or (county, month). Counties with zero population are NaN.
+    """
+    cases, pop = _as_2d(cases, pop)
+    n = (pop > 0).sum(0)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        rate = np.where(pop > 0, cases/pop, 0.0)
+        mean = cases.sum(0)/pop.sum(0)
+        var = (pop*(rate - mean)**2).sum(0)/pop.sum(0) - mean/(pop.sum(0)/n)
+
+    out = _shrink(rate, mean, np.maximum(var, 0), pop)
+    return np.where(pop > 0, out, np.nan)
+
+
+def _with_self(W):
+    """
+    Binary neighbourhood matrix that includes each county itself.
+    """
+    W = sparse.csr_matrix(W)
+    W = (W != 0).astype(float)
+    return (W + sparse.identity(W.shape[0], format = 'csr')).minimum(1).tocsr()
+
+
+def local_eb(cases, pop, W):
+    """
+    Local empirical Bayes smoothed rates: as global_eb, but the prior mean and variance for each
+    county come from the county and its neighbours in W (any sparse weights; only the pattern is used).
+    """
+    cases, pop = _as_2d(cases, pop)
+    S = _with_self(W)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        rate = np.where(pop > 0, cases/pop, 0.0)
+
+        ## Neighbourhood sums for every month at once; the variance term is expanded so it's all sparse products
+        sum_c = S @ cases
+        sum_p = S @ pop
+        mean = sum_c/sum_p
+        sq = (S @ (pop*rate**2)) - 2*mean*(S @ (pop*rate)) + mean**2*sum_p
+        var = sq/sum_p - mean/(sum_p/np.asarray(S.sum(1)))
+
+    out = _shrink(rate, np.nan_to_num(mean), np.nan_to_num(np.maximum(var, 0)), pop)
+    return np.where(pop > 0, out, np.nan)
+
+
+def spatial_rate(cases, pop, W):
+    """
+    Spatially smoothed rate: total cases over total population of each county and its neighbours.
+    """
+    cases, pop = _as_2d(cases, pop)
+    S = _with_self(W)
+    sum_p = S @ pop
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return np.where(sum_p > 0, (S @ cases)/sum_p, np.nan)
+
+
+def smooth_rates(cases, pop, W, scale = 1.0):
+    """
+    Raw, global EB, local EB and spatially smoothed rates, all multiplied by scale
+    (use 100000 for incidence per 100,000). Returns a dict of (county, month) arrays.
+    """
+    cases, pop = _as_2d(cases, pop)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        raw = np.where(pop > 0, cases/pop, np.nan)
+    return {'raw': scale*raw,
+            'ebg': scale*global_eb(cases, pop),
+            'ebl': scale*local_eb(cases, pop, W),
+            'sm': scale*spatial_rate(cases, pop, W)}
+
+
+def add_smoothed_rates(table, rates, counties, months, name, county_col = 'county_en', year_col = 'year', month_col = 'month'):
+    """
+    Writes smoothed rate arrays back onto a record-level table, one column per method (e.g. Incidence_ebl).
+    rates is the dict from smooth_rates on the (counties, months) axes. Each record picks up its
+    county-month cell by integer indexing, so there's no merge and the table keeps its rows.
+    If months is None the arrays are county totals and every record gets its county's value.
+    """
+    rows = np.asarray(counties.get_indexer(table[county_col]))
+
+    if months is None:
+        cols = np.zeros(len(table), dtype = int)
+        ok = rows >= 0
+    else:
+        months = np.asarray(months, dtype = int)
+        keys = month_key(table[year_col], table[month_col])
+        cols = np.clip(np.searchsorted(months, np.nan_to_num(keys, nan = -1)), 0, len(months) - 1)
+        ok = (rows >= 0) & (months[cols] == keys)
+
+    for method, arr in rates.items():
+        if method == 'raw':
+            continue
+        table[name + '_' + method] = np.where(ok, np.asarray(arr)[np.where(ok, rows, 0), cols], np.nan)
+
+    return table
+
+
+#%%
+if __name__ == '__main__':
+
+    ## Example (after running the cleaning script and the aggregation in Tanner_regression.py):
+    ##
+    ## from county_month import county_month_array
+    ## from spatial_weights import queen_sparse
+    ##
+    ## W = queen_sparse(iran_data)
+    ## counties = pd.Index(iran_data['county_en'])
+    ## pop = pop_sp_data.drop_duplicates('county_en').set_index('county_en')['Population'].reindex(counties)
+    ##
+    ## cases, _, months = county_month_array(human_sp_data, counties = counties)
+    ## add_smoothed_rates(human_sp_data, smooth_rates(cases, pop, W, 100000), counties, months, 'Incidence')
+    ##
+    ## infected, _, months = county_month_array(ani_sp_data, 'n_infected', counties = counties)
+    ## sampled, _, _ = county_month_array(ani_sp_data, 'n_sample', counties = counties, months = months)
+    ## add_smoothed_rates(ani_sp_data, smooth_rates(infected, sampled, W), counties, months, 'animal_inf_rate')
+
+    rng = np.random.default_rng(3)
+    W = sparse.random(50, 50, 0.08, random_state = 3, format = 'csr')
+    W = ((W + W.T) > 0).astype(float)
+    pop = rng.integers(500, 500000, 50)
+    cases = rng.poisson(3e-4*pop[:, None], (50, 24))
+
+    rates = smooth_rates(cases, pop, W, 100000)
+    for k, v in rates.items():
+        print(k, np.nanstd(v[pop < 5000]).round(2), np.nanstd(v[pop >= 5000]).round(2))
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Province-blocked county linkage
+
+match_names compares every register county name with every shapefile county, by name only.
+That lets a county be joined to a polygon in another province without anyone noticing (the
+QA notes flag 'Behbahan' under two provinces). This links each distinct (province, county)
+pair in a register to a shapefile county using:
+
+    name similarity     Levenshtein ratio of the capitalized names
+    province agreement  candidates are blocked by province, so only the record's own
+                        province's counties are compared (~30x fewer comparisons)
+    containment         when the records have lat/long, the share of them inside the candidate polygon
+
+Manual mappings (the match_dict_man style dicts) are used as candidates too, and are held to
+the same province check. Pairs that can't be linked consistently go to a conflict report and
+get no county, so they don't join to any polygon:
+
+    links, conflicts = link_counties(human_data, iran_data, 'Province', 'County', manual = match_dict_man)
+    human_data = apply_links(human_data, links, 'Province', 'County')
+"""
+
+import numpy as np
+import pandas as pd
+import Levenshtein as leven
+
+
+## Score weights for name similarity, province agreement and containment
+WEIGHTS = {'name': 0.6, 'province': 0.25, 'point': 0.15}
+
+
+######### Functions #############
+def _ratio_matrix(names, targets):
+    """
+    Levenshtein ratio between every pair of capitalized names.
+    """
+    names = pd.Series(names, dtype = object).str.capitalize()
+    targets = pd.Series(targets, dtype = object).str.capitalize()
+    return np.array([[leven.ratio(a, b) for b in targets] for a in names]).reshape(len(names), len(targets))
+
+
+def record_pairs(records, province_col, county_col):
+    """
+    Distinct (province, county) pairs with their record counts. Everything else works on these,
+    not on the records.
+    """
+    pairs = records.groupby([province_col, county_col], dropna = True).size().rename('n_records').reset_index()
+    return pairs.rename(columns = {province_col: 'province', county_col: 'county'})
+
+
+def containment(records, iran_data, province_col, county_col, lat_col, lon_col):
+    """
+    For each (province, county) pair, the share of its located records falling inside each
+    shapefile county: a frame of province, county, county_en, point_share.
+    """
+    import geopandas as gpd
+
+    located = records.dropna(subset = [lat_col, lon_col, province_col, county_col])
+    points = gpd.GeoDataFrame(located[[province_col, county_col]].reset_index(drop = True),
+                              geometry = gpd.points_from_xy(located[lon_col], located[lat_col]), crs = 'EPSG:4326')
+    polys = gpd.GeoDataFrame(iran_data[['county_en', 'geometry']], geometry = 'geometry')
+    polys = polys.set_crs('EPSG:4326') if polys.crs is None else polys.to_crs('EPSG:4326')
+
+    hits = gpd.sjoin(points, polys, how = 'left', predicate = 'within')
+    share = hits.groupby([province_col, county_col])['county_en'].value_counts(normalize = True, dropna = False)
+    share = share.rename('point_share').reset_index()
+    return share.rename(columns = {province_col: 'province', county_col: 'county'})
+
+
+def block_candidates(pairs, gazetteer, manual = None, top = 3):
+    """
+    Candidates for every pair from its own province only: the top name matches plus any manual
+    mapping. Returns one row per (pair, candidate) with name_ratio and whether it came from the manual dict.
+    """
+    manual = manual or {}
+    cands = []
+    for prov, grp in pairs.groupby('province', sort = False):
+        block = gazetteer.loc[gazetteer['province_en'] == prov, 'county_en'].to_numpy(dtype = object)
+        if len(block) == 0:
+            continue
+        ratios = _ratio_matrix(grp['county'], block)
+        k = min(top, len(block))
+        best = np.argsort(-ratios, axis = 1, kind = 'stable')[:, :k]
+        cands.append(pd.DataFrame({'province': prov,
+                                   'county': np.repeat(grp['county'].values, k),
+                                   'county_en': block[best].ravel(),
+                                   'name_ratio': np.take_along_axis(ratios, best, axis = 1).ravel(),
+                                   'manual': False}))
+
+    ## Manual targets are candidates whatever their name similarity
+    man = pairs[pairs['county'].isin(manual)]
+    if len(man):
+        cands.append(pd.DataFrame({'province': man['province'].values, 'county': man['county'].values,
+                                   'county_en': man['county'].map(manual).values, 'name_ratio': 1.0, 'manual': True}))
+
+    cols = ['province', 'county', 'county_en', 'name_ratio', 'manual']
+    if not cands:
+        return pd.DataFrame(columns = cols)
+    return pd.concat(cands, ignore_index = True)[cols]
+
+
+def link_counties(records, iran_data, province_col = 'Province', county_col = 'County', lat_col = None, lon_col = None,
+                  manual = None, cutoff = 0.75, weights = WEIGHTS, top = 3):
+    """
+    Links each distinct (province, county) pair in records to a shapefile county.
+    province names must already be in the shapefile's spelling (the match_dict_prov step).
+
+    Returns (links, conflicts): links has one row per pair with the chosen county_en, its province,
+    name_ratio, in_province, point_share, score, status ('linked', 'conflict' or 'unmatched')
+    and reason; conflicts is the rows of links that aren't linked.
+    """
+    gazetteer = pd.DataFrame(iran_data)[['county_en', 'province_en']].drop_duplicates('county_en')
+    province_of = dict(zip(gazetteer['county_en'], gazetteer['province_en']))
+    pairs = record_pairs(records, province_col, county_col)
+
+    cands = block_candidates(pairs, gazetteer, manual, top)
+    cands['province_en'] = cands['county_en'].map(province_of)
+    cands['in_province'] = (cands['province_en'] == cands['province']).astype(float)
+
+    use_points = lat_col is not None and lon_col is not None and 'geometry' in iran_data
+    if use_points:
+        share = containment(records, iran_data, province_col, county_col, lat_col, lon_col)
+        cands = cands.merge(share, how = 'left', on = ['province', 'county', 'county_en'])
+    cands['point_share'] = cands['point_share'].fillna(0.0) if use_points else np.nan
+
+    point_w = weights['point'] if use_points else 0.0
+    cands['score'] = (weights['name']*cands['name_ratio'] + weights['province']*cands['in_province']
+                      + point_w*cands['point_share'].fillna(0.0))/(weights['name'] + weights['province'] + point_w)
+
+    ## Manual mappings win over name matches, otherwise the best score
+    cands = cands.sort_values(['manual', 'score'], ascending = False, kind = 'stable')
+    best = cands.drop_duplicates(['province', 'county'])
+    links = pairs.merge(best, how = 'left', on = ['province', 'county'])
+
+    links['status'] = 'linked'
+    links['reason'] = ''
+
+    ## Province not in the shapefile at all
+    no_prov = ~links['province'].isin(gazetteer['province_en'])
+    links.loc[no_prov, ['status', 'reason']] = ['unmatched', 'unknown province']
+
+    ## Manual mappings that point outside the record's province
+    bad_manual = links['manual'].eq(True) & links['in_province'].eq(0)
+    links.loc[bad_manual, 'status'] = 'conflict'
+    links.loc[bad_manual, 'reason'] = np.where(links.loc[bad_manual, 'province_en'].isna(), 'manual target not in the county layer',
+                                               'manual target is in ' + links.loc[bad_manual, 'province_en'].astype(str))
+
+    ## Weak in-province matches: check whether the name belongs to a county in another province
+    weak = links['status'].eq('linked') & ~links['manual'].eq(True) & (links['name_ratio'].fillna(0) < cutoff)
+    if weak.any():
+        ratios = _ratio_matrix(links.loc[weak, 'county'], gazetteer['county_en'])
+        j = ratios.argmax(axis = 1)
+        elsewhere = ratios[np.arange(len(j)), j] >= cutoff
+        idx = links.index[weak]
+        links.loc[idx[elsewhere], 'status'] = 'conflict'
+        links.loc[idx[elsewhere], 'reason'] = ['name matches {} in {}'.format(c, p) for c, p in
+                                               zip(gazetteer['county_en'].to_numpy(dtype = object)[j[elsewhere]],
+                                                   gazetteer['province_en'].to_numpy(dtype = object)[j[elsewhere]])]
+        links.loc[idx[~elsewhere], ['status', 'reason']] = ['unmatched', 'no similar county in province']
+
+    ## Records located mostly outside the linked county
+    if use_points:
+        top_share = cands.groupby(['province', 'county'])['point_share'].max()
+        off = links['status'].eq('linked') & (links['point_share'] < 0.5) & \
+              (links.set_index(['province', 'county']).index.map(top_share).fillna(0).values >= 0.5)
+        links.loc[off, ['status', 'reason']] = ['conflict', 'records located in another county']
+
+    links.loc[links['status'] != 'linked', 'county_en'] = None
+    links.attrs['comparisons'] = len(pairs)*len(gazetteer), int(pairs['province'].map(gazetteer['province_en'].value_counts()).fillna(0).sum())
+
+    conflicts = links[links['status'] != 'linked'].reset_index(drop = True)
+    return links, conflicts
+
+
+def apply_links(records, links, province_col = 'Province', county_col = 'County', out_col = 'county_en', keep_unlinked = False):
+    """
+    Adds the linked shapefile county to each record. Records from conflicting or unmatched pairs get
+    no county, so a county joined on out_col is never one the linkage rejected (they are listed in
+    the conflict report). keep_unlinked = True gives them their own county name instead, for display.
+    """
+    lookup = links.set_index(['province', 'county'])['county_en']
+    keys = pd.MultiIndex.from_arrays([records[province_col], records[county_col]])
+    records = records.copy()
+    linked = lookup.reindex(keys).values
+    if keep_unlinked:
+        linked = pd.Series(linked, index = records.index).fillna(records[county_col]).values
+    records[out_col] = linked
+    return records
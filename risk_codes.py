@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Occupation and livestock interaction codes
+
+The human register stores Occupation (1-19) and Livestock interaction type (1-10) as
+codes; Job_Interaction_Code.txt has the two decoding tables as tab-separated text.
+read_code_tables parses them, and the codes are applied as categoricals built straight
+from the integer codes (pd.Categorical.from_codes, no string column per case).
+
+Interaction types are combinations of exposure routes ('Alive livestock contact-Presence
+in barn-Keeping livestock at home'), so each type is also a set of bit flags:
+
+    human_data = apply_codes(human_data)
+    slaughter = has_exposure(human_data['Int_flags'], 'Livestock slaughter')
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+
+CODE_FILE = 'Job_Interaction_Code.txt'
+
+
+######### Functions #############
+def read_code_tables(path = CODE_FILE):
+    """
+    Code tables in the file, keyed by their header ('Job', 'Interaction type'):
+    each a Series of labels indexed by integer code. Tables are separated by blank lines.
+    """
+    with open(path, encoding = 'utf-8') as f:
+        blocks = [b for b in f.read().replace('\r', '').split('\n\n') if b.strip()]
+
+    tables = {}
+    for block in blocks:
+        rows = [line.split('\t') for line in block.strip().split('\n') if line.strip()]
+        name = rows[0][1].strip()
+        tables[name] = pd.Series([r[1].strip() for r in rows[1:]], index = [int(r[0]) for r in rows[1:]], name = name)
+    return tables
+
+
+def exposure_routes(types, sep = '-'):
+    """
+    Distinct exposure routes making up the interaction types, in order of first appearance.
+    """
+    routes = []
+    for label in types:
+        for part in label.split(sep):
+            if part.strip() not in routes:
+                routes.append(part.strip())
+    return routes
+
+
+def type_flags(types, routes = None, sep = '-'):
+    """
+    Bit flags for each interaction type code (bit i set if the type includes routes[i]),
+    as a lookup array indexed by code (0 for unknown codes).
+    """
+    routes = exposure_routes(types, sep) if routes is None else routes
+    if len(routes) > 8:
+        raise ValueError('More than 8 exposure routes do not fit a uint8 flag')
+    lookup = np.zeros(types.index.max() + 1, dtype = np.uint8)
+    for code, label in types.items():
+        for part in label.split(sep):
+            lookup[code] |= np.uint8(1 << routes.index(part.strip()))
+    return lookup, routes
+
+
+def coded(values, table):
+    """
+    Categorical of table's labels from a column of integer codes. Codes outside the table
+    (including 'Null' and blanks) are missing.
+    """
+    codes = pd.to_numeric(pd.Series(values), errors = 'coerce')
+    pos = pd.Index(table.index).get_indexer(codes)
+    return pd.Categorical.from_codes(pos.astype(np.int8 if len(table) < 127 else np.int16), categories = table.values)
+
+
+def interaction_flags(values, lookup):
+    """
+    uint8 exposure flags per record from interaction type codes (0 where the code is missing or unknown).
+    """
+    codes = pd.to_numeric(pd.Series(values), errors = 'coerce').to_numpy()
+    ok = ~np.isnan(codes) & (codes >= 0) & (codes < len(lookup))
+    out = np.zeros(len(codes), dtype = np.uint8)
+    out[ok] = lookup[codes[ok].astype(int)]
+    return out
+
+
+def route_mask(routes, wanted):
+    """
+    Bit mask for one or more exposure route names.
+    """
+    wanted = [wanted] if isinstance(wanted, str) else list(wanted)
+    return np.uint8(sum(1 << routes.index(w) for w in wanted))
+
+
+def has_exposure(flags, wanted, routes = None, how = 'any'):
+    """
+    Records exposed through any (or all, how = 'all') of the wanted routes, by bit test.
+    routes defaults to the routes of the bundled code file.
+    """
+    routes = ROUTES if routes is None else routes
+    mask = route_mask(routes, wanted)
+    flags = np.asarray(flags, dtype = np.uint8)
+    return (flags & mask) == mask if how == 'all' else (flags & mask) != 0
+
+
+def apply_codes(human_data, tables = None, occupation_col = 'Occupation', type_col = 'Livestock_int_type'):
+    """
+    Replaces the occupation and interaction type codes with categoricals and adds Int_flags.
+    """
+    tables = read_code_tables() if tables is None else tables
+    lookup, _ = type_flags(tables['Interaction type'])
+
+    human_data = human_data.copy()
+    human_data['Int_flags'] = interaction_flags(human_data[type_col], lookup)
+    human_data[occupation_col] = coded(human_data[occupation_col], tables['Job'])
+    human_data[type_col] = coded(human_data[type_col], tables['Interaction type'])
+    return human_data
+
+
+## Routes of the bundled code file, so flags mean the same thing everywhere
+try:
+    ROUTES = exposure_routes(read_code_tables(os.path.join(os.path.dirname(os.path.abspath(__file__)), CODE_FILE))['Interaction type'])
+except (OSError, KeyError):
+    ROUTES = []
+
+
+#%%
+if __name__ == '__main__':
+
+    import time
+    import synthetic_data as syn
+
+    tables = read_code_tables()
+    print(tables['Job'])
+    lookup, routes = type_flags(tables['Interaction type'])
+    print(pd.DataFrame({'type': tables['Interaction type'], 'flags': [format(lookup[c], '05b') for c in tables['Interaction type'].index]}))
+
+    gaz = syn.gazetteer(429)
+    human = syn.human_register(1000000, gaz).rename(columns = {'Occuptio': 'Occupation', 'Livestock interaction type': 'Livestock_int_type'})
+    human = apply_codes(human)
+    print(human[['Occupation', 'Livestock_int_type', 'Int_flags']].head())
+
+    ## Same cases as substring matching on the decoded labels
+    t0 = time.perf_counter()
+    by_flag = has_exposure(human['Int_flags'], 'Livestock slaughter')
+    t1 = time.perf_counter()
+    by_str = human['Livestock_int_type'].astype(str).str.contains('Livestock slaughter').values
+    t2 = time.perf_counter()
+    assert (by_flag == by_str).all()
+    print('Bit test {:.1f} ms, substring {:.1f} ms'.format(1000*(t1 - t0), 1000*(t2 - t1)))
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Human risk factor cube
+
+The 'Data for Katharine' block groups the human cases by five string columns and merges
+county counts, population and SES onto the result. Every other slice (by occupation,
+interaction type, dairy consumption, sex, age ...) would be another groupby and merge chain.
+
+RiskCube codes each risk factor once as integers and keeps the case counts of the finest
+cells (one row per combination that occurs). Any cross-tab is a roll-up of those cells,
+computed from the smallest aggregate already cached that contains the requested factors,
+so repeated slicing is array work on a few thousand cells rather than a pass over the records:
+
+    cube = RiskCube(human_cases)
+    cube.table(['Occupation', 'Sex'])                      ## roll-up
+    cube.table(['Age_group'], where = {'Pop_setting': 'Rural'})    ## drill-down
+    cube.crosstab('Occupation', 'Unpast_dairy')
+    cube.rates(['county_en', 'Pop_setting'], population)   ## cases per county population
+"""
+
+import numpy as np
+import pandas as pd
+
+
+## Risk factors kept in the cube by default (Age is binned into Age_group first)
+RISK_FACTORS = ['county_en', 'province_en', 'Occupation', 'Livestock_int_hist', 'Livestock_int_type',
+                'Livestock_vac_hist', 'Unpast_dairy', 'Pop_setting', 'Sex', 'Age_group']
+
+AGE_BINS = [0, 15, 25, 35, 45, 55, 65, np.inf]
+AGE_LABELS = ['0-14', '15-24', '25-34', '35-44', '45-54', '55-64', '65+']
+
+
+######### Functions #############
+def age_groups(age, bins = AGE_BINS, labels = AGE_LABELS):
+    """
+    Age bands as an ordered categorical (non-numeric ages are missing).
+    """
+    return pd.cut(pd.to_numeric(pd.Series(age), errors = 'coerce'), bins = bins, labels = labels, right = False)
+
+
+def _encode(values):
+    """
+    Integer codes and labels for one factor. Missing values are kept as their own last label (None)
+    so cell counts always add up to the number of cases.
+    """
+    values = pd.Series(values)
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes, labels = values.cat.codes.to_numpy().astype(np.int64), list(values.cat.categories)
+    else:
+        codes, uniques = pd.factorize(values, sort = True)
+        codes, labels = codes.astype(np.int64), list(uniques)
+    if (codes < 0).any():
+        codes[codes < 0] = len(labels)
+        labels.append(None)
+    return codes, labels
+
+
+def _pack(codes, sizes):
+    """
+    One int64 key per row from several code columns (mixed radix).
+    """
+    key = np.zeros(len(codes), dtype = np.int64)
+    for j, size in enumerate(sizes):
+        key = key*size + codes[:, j]
+    return key
+
+
+class RiskCube:
+    """
+    Case counts over categorical risk factors with cached partial aggregates.
+    data has one row per case; dims are the factor columns (Age is binned into Age_group
+    when Age_group is asked for and missing). weights optionally counts each row differently.
+    """
+    def __init__(self, data, dims = RISK_FACTORS, weights = None):
+        data = pd.DataFrame(data)
+        if 'Age_group' in dims and 'Age_group' not in data and 'Age' in data:
+            data = data.assign(Age_group = age_groups(data['Age']).values)
+        dims = [d for d in dims if d in data]
+
+        self.dims = list(dims)
+        self.labels = {}
+        codes = np.empty((len(data), len(dims)), dtype = np.int64)
+        for j, d in enumerate(dims):
+            codes[:, j], self.labels[d] = _encode(data[d])
+        self.sizes = np.array([len(self.labels[d]) for d in dims], dtype = np.int64)
+        if np.log2(self.sizes.astype(float)).sum() >= 63:
+            raise ValueError('Too many factor combinations to pack into one key; use fewer dims')
+
+        w = np.ones(len(data)) if weights is None else np.asarray(weights, dtype = float)
+        self.total = w.sum()
+        self.integer = weights is None
+
+        ## Finest cells: one per combination that occurs
+        cells, inverse = np.unique(_pack(codes, self.sizes), return_inverse = True)
+        counts = np.bincount(inverse.ravel(), weights = w, minlength = len(cells))
+        self._cache = {tuple(range(len(dims))): (self._unpack(cells, range(len(dims))), counts)}
+
+    def _unpack(self, keys, pos):
+        """
+        Code columns back from packed keys over the dims at positions pos.
+        """
+        pos = list(pos)
+        out = np.empty((len(keys), len(pos)), dtype = np.int64)
+        for j in range(len(pos) - 1, -1, -1):
+            size = self.sizes[pos[j]]
+            out[:, j] = keys % size
+            keys = keys//size
+        return out
+
+    def _positions(self, dims):
+        missing = [d for d in dims if d not in self.dims]
+        if missing:
+            raise KeyError('Not in the cube: {}'.format(missing))
+        return tuple(sorted(self.dims.index(d) for d in dims))
+
+    def _aggregate(self, pos):
+        """
+        Codes and counts of the cells over the dims at pos, rolled up from the smallest cached
+        aggregate that contains them (and cached in turn).
+        """
+        if pos in self._cache:
+            return self._cache[pos]
+        parent = min((k for k in self._cache if set(pos) <= set(k)), key = lambda k: len(self._cache[k][1]))
+        pcodes, pcounts = self._cache[parent]
+        sub = pcodes[:, [parent.index(p) for p in pos]]
+        cells, inverse = np.unique(_pack(sub, self.sizes[list(pos)]), return_inverse = True)
+        out = (self._unpack(cells, pos), np.bincount(inverse.ravel(), weights = pcounts, minlength = len(cells)))
+        self._cache[pos] = out
+        return out
+
+    def _code_of(self, dim, value):
+        """
+        Codes matching a filter value (a label or list of labels; None matches missing).
+        """
+        values = value if isinstance(value, (list, tuple, set, np.ndarray)) else [value]
+        labels = self.labels[dim]
+        return [i for i, lab in enumerate(labels) if any((lab is None and v is None) or (lab is not None and lab == v) for v in values)]
+
+    def cells(self, dims, where = None, dropna = True):
+        """
+        Codes (one column per dim, in the cube's order) and counts of the non-empty cells,
+        optionally restricted to where = {dim: label or labels}.
+        """
+        where = where or {}
+        pos = self._positions(list(dims))
+        full = self._positions(set(dims) | set(where))
+        codes, counts = self._aggregate(full)
+
+        keep = np.ones(len(counts), dtype = bool)
+        for d, value in where.items():
+            keep &= np.isin(codes[:, full.index(self.dims.index(d))], self._code_of(d, value))
+        if dropna:
+            for p in pos:
+                if self.labels[self.dims[p]][-1] is None:
+                    keep &= codes[:, full.index(p)] != self.sizes[p] - 1
+        codes, counts = codes[keep], counts[keep]
+
+        if full != pos:
+            sub = codes[:, [full.index(p) for p in pos]]
+            cells, inverse = np.unique(_pack(sub, self.sizes[list(pos)]), return_inverse = True)
+            codes, counts = self._unpack(cells, pos), np.bincount(inverse.ravel(), weights = counts, minlength = len(cells))
+        return [self.dims[p] for p in pos], codes, counts
+
+    def table(self, dims, where = None, dropna = True, name = 'count'):
+        """
+        Long cross-tab: one row per non-empty combination of dims with its case count.
+        dropna = True leaves out cells with a missing factor, like groupby.
+        """
+        order, codes, counts = self.cells(dims, where, dropna)
+        out = pd.DataFrame({d: np.asarray(self.labels[d], dtype = object)[codes[:, j]] for j, d in enumerate(order)})
+        out[name] = counts.astype(np.int64) if self.integer else counts
+        return out[list(dims) + [name]]
+
+    def crosstab(self, rows, cols, where = None, dropna = True):
+        """
+        Wide cross-tab of rows by cols (each a factor or a list of factors), zero where no cases.
+        """
+        rows = [rows] if isinstance(rows, str) else list(rows)
+        cols = [cols] if isinstance(cols, str) else list(cols)
+        long = self.table(rows + cols, where, dropna)
+        return long.pivot_table(index = rows, columns = cols, values = 'count', aggfunc = 'sum', fill_value = 0)
+
+    def rates(self, dims, population, county_col = 'county_en', where = None, per = 1):
+        """
+        Cases per county population for cells that include the county: adds county_count (all cases
+        in the county), Population and inf_rate = per*count/Population. population is a Series
+        indexed by county name.
+        """
+        dims = list(dims)
+        if county_col not in dims:
+            raise ValueError('rates needs {} among the dims'.format(county_col))
+        out = self.table(dims, where)
+        out['county_count'] = out[county_col].map(self.table([county_col]).set_index(county_col)['count'])
+        out['Population'] = out[county_col].map(population)
+        out['inf_rate'] = per*out['count']/out['Population']
+        return out
+
+
+#%%
+if __name__ == '__main__':
+
+    import time
+    import synthetic_data as syn
+    from streaming_ingest import clean_human
+
+    gaz = syn.gazetteer(429)
+    human = clean_human(syn.human_register(200000, gaz, share_misspelled = 0), {})
+    human = human.rename(columns = {'County': 'county_en', 'Province': 'province_en'})
+
+    t0 = time.perf_counter()
+    cube = RiskCube(human)
+    print('Cube: {} cells in {:.2f}s'.format(len(cube._cache[tuple(range(len(cube.dims)))][1]), time.perf_counter() - t0))
+
+    dims = ['county_en', 'province_en', 'Livestock_int_hist', 'Livestock_vac_hist', 'Pop_setting']
+    t0 = time.perf_counter()
+    counts = cube.table(dims)
+    print('Roll-up {:.1f} ms'.format(1000*(time.perf_counter() - t0)))
+    t0 = time.perf_counter()
+    print(cube.crosstab('Occupation', 'Sex', where = {'Unpast_dairy': 'Yes'}).head())
+    print('Drill-down {:.1f} ms'.format(1000*(time.perf_counter() - t0)))
+
+    ## Same counts as the groupby in the Katharine block
+    check = human.groupby(dims).size().reset_index(name = 'count')
+    merged = check.merge(counts, on = dims, suffixes = ('', '_cube'))
+    assert len(merged) == len(check) == len(counts) and (merged['count'] == merged['count_cube']).all()
+    print('Counts match groupby')
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+Space-time scan statistic
+
+Kulldorff-style Poisson space-time scan over the monthly county series, for outbreak alerting.
+Candidate clusters are cylinders: a circle of the k nearest counties (by centroid distance)
+around each county, up to a share of the population, crossed with a window of consecutive months. Observed and expected counts
+for every cylinder come from prefix sums over the neighbour orderings and over time, and the
+Monte Carlo replicates are spread over a process pool.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from spatial_weights import neighbour_order
+from county_month import key_to_period
+
+
+######### Functions #############
+def expected_counts(cases, pop, time_adjust = True):
+    """
+    Expected cases per (county, month) under the null of no clustering.
+    pop may be (county,) or (county, month). With time_adjust each month's expected total
+    equals its observed total, so purely temporal trends (seasonality) don't show up as clusters.
+    """
+    cases = np.asarray(cases, dtype = float)
+    pop = np.broadcast_to(np.asarray(pop, dtype = float).reshape(len(cases), -1), cases.shape)
+
+    if time_adjust:
+        return pop*cases.sum(0)/pop.sum(0)
+    return pop*cases.sum()/pop.sum()
+
+
+def _windows(n_mth, max_len, prospective):
+    """
+    Window lengths (in months) to scan. Prospective scans only look at windows that run up to the latest month.
+    """
+    return np.arange(1, min(max_len, n_mth) + 1), prospective
+
+
+def _prefix(arr, order):
+    """
+    Prefix sums over the neighbour ordering and over time: out[i, k, t] is the total of
+    the k+1 nearest counties to i over months [0, t).
+    """
+    out = np.zeros(order.shape + (arr.shape[1] + 1,))
+    out[:, :, 1:] = np.cumsum(np.cumsum(arr[order], axis = 1), axis = 2)
+    return out
+
+
+def _llr(c, e, total):
+    """
+    Poisson log likelihood ratio for cylinders with c observed and e expected cases (high rate clusters only).
+    Evaluated in double precision (the prefix sums it takes differences of are large); the second
+    term is written with log1p so it stays accurate when the cylinder is a small share of the total.
+    """
+    keep = c > e
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        llr = c*np.log(c/e) + (total - c)*np.log1p((e - c)/(total - e))
+    return np.where(keep, llr, 0.0)
+
+
+def _window_sums(case_prefix, exp_prefix, L, prospective):
+    """
+    Observed and expected counts of every cylinder with a window of L months: plain slices of the prefix arrays.
+    """
+    T = case_prefix.shape[2] - 1
+    if prospective:
+        return (case_prefix[:, :, T:] - case_prefix[:, :, T-L:T-L+1],
+                exp_prefix[:, :, T:] - exp_prefix[:, :, T-L:T-L+1])
+    return case_prefix[:, :, L:] - case_prefix[:, :, :-L], exp_prefix[:, :, L:] - exp_prefix[:, :, :-L]
+
+
+def _best_per_center(case_prefix, exp_prefix, lengths, prospective, total):
+    """
+    Highest LLR cylinder for each center. Returns LLR, radius position, window start and window end
+    (exclusive) per center.
+    """
+    n, T = case_prefix.shape[0], case_prefix.shape[2] - 1
+
+    best = np.zeros(n)
+    best_k = np.zeros(n, dtype = int)
+    best_s = np.zeros(n, dtype = int)
+    best_len = np.ones(n, dtype = int)
+
+    for L in lengths:
+        c, e = _window_sums(case_prefix, exp_prefix, L, prospective)
+        llr = _llr(c, e, total).reshape(n, -1)
+
+        pos = llr.argmax(1)
+        val = llr[np.arange(n), pos]
+        better = val > best
+        best = np.where(better, val, best)
+        best_k = np.where(better, pos//c.shape[2], best_k)
+        best_s = np.where(better, (T - L) if prospective else pos%c.shape[2], best_s)
+        best_len = np.where(better, L, best_len)
+
+    return best, best_k, best_s, best_s + best_len
+
+
+def _max_llr(case_prefix, exp_prefix, lengths, prospective, total):
+    """
+    Highest LLR over every cylinder, without tracking where it is (all a null replicate needs).
+    """
+    return max(_llr(*_window_sums(case_prefix, exp_prefix, L, prospective), total).max() for L in lengths)
+
+
+def _chunks(size, chunk):
+    """
+    Centers in chunks of similar neighbour list length, each with the list length it needs.
+    Centers in dense areas reach the population limit within a few counties, so most chunks
+    only scan a fraction of the longest list.
+    """
+    by_size = np.argsort(size, kind = 'stable')
+    for i in range(0, len(size), chunk):
+        idx = by_size[i:i+chunk]
+        yield idx, size[idx].max()
+
+
+def _scan(cases, order, size, exp_prefix, windows, chunk = 32, only_max = False):
+    """
+    Best cylinder for every center, or with only_max just the highest LLR. Each chunk only builds
+    prefix sums out to its longest neighbour list; the observed prefix sums are computed once per
+    chunk and reused for every window length. Cases beyond a center's population limit are zeroed,
+    so those cylinders have no excess and score 0.
+    """
+    total = cases.sum()
+    parts = []
+    for idx, K in _chunks(size, chunk):
+        case_prefix = _prefix(cases, order[idx, :K])
+        case_prefix[np.arange(K)[None, :] >= size[idx, None]] = 0.0
+        args = (case_prefix, exp_prefix[idx, :K], *windows, total)
+        parts.append(_max_llr(*args) if only_max else _best_per_center(*args))
+
+    if only_max:
+        return max(parts)
+    inv = np.argsort(np.concatenate([idx for idx, _ in _chunks(size, chunk)]))
+    return [np.concatenate(p)[inv] for p in zip(*parts)]
+
+
+## Worker state for the process pool, set once per process by _init_worker
+_shared = {}
+
+def _init_worker(order, size, margins, prob, exp_prefix, windows):
+    _shared.update(order = order, size = size, margins = margins, prob = prob, exp_prefix = exp_prefix, windows = windows)
+
+
+def null_margins(cases, pop, time_adjust = True):
+    """
+    What the null replicates hold fixed, and the cell probabilities to redistribute it with: each
+    month's total over the counties by population (time_adjust), or the overall total over every cell.
+    These are the margins expected_counts uses, so each replicate has the observed expected counts.
+    """
+    cases = np.asarray(cases, dtype = float)
+    pop = np.broadcast_to(np.asarray(pop, dtype = float).reshape(len(cases), -1), cases.shape)
+    if time_adjust:
+        return np.rint(cases.sum(0)).astype(np.int64), (pop/pop.sum(0)).T
+    return int(np.rint(cases.sum())), (pop/pop.sum()).ravel()
+
+
+def _replicates(seed_seq, n_rep):
+    """
+    Max LLR for n_rep null replicates (see null_margins). Conditioning on the same margins as the
+    expected counts keeps them valid for the simulated data, so the shared prefix sums are reused.
+    """
+    rng = np.random.default_rng(seed_seq)
+    margins, prob = _shared['margins'], _shared['prob']
+    shape = (_shared['order'].shape[0], _shared['exp_prefix'].shape[2] - 1)
+
+    out = np.empty(n_rep)
+    for r in range(n_rep):
+        sim = rng.multinomial(margins, prob)
+        sim = (sim.T if np.ndim(margins) else sim.reshape(shape)).astype(float)
+        out[r] = _scan(sim, _shared['order'], _shared['size'], _shared['exp_prefix'], _shared['windows'], only_max = True)
+    return out
+
+
+def space_time_scan(cases, pop, xy, max_pop_frac = 0.1, max_k = None, max_len = 12, prospective = False,
+                    time_adjust = True, replicates = 999, seed = 0, workers = None, n_clusters = 10):
+    """
+    Poisson space-time scan over (county, month) case counts.
+
+    cases:       (county, month) case counts
+    pop:         (county,) or (county, month) population at risk
+    xy:          (county, 2) projected centroids (see spatial_weights.centroids)
+    max_pop_frac: largest share of the population a circle may hold. The scan time grows about linearly
+                 with it: for 429 counties x 108 months one scan takes about 0.5 s on one core at 0.1
+                 (so 999 replicates are under 10 minutes of CPU time, divided over the workers) and
+                 3.5 s at 0.5, the usual SaTScan limit. Brucellosis clusters are a few counties, so 0.1 is the default
+    max_len:     longest time window, in months
+    prospective: only scan windows ending in the latest month (for alerting)
+    replicates:  Monte Carlo replicates, run in a process pool with `workers` processes; each is a full scan
+
+    Returns a dataframe of the most likely cluster and secondary clusters that don't overlap it
+    spatially, with county positions, month window, observed/expected counts, relative risk, LLR and p-value.
+    """
+    cases = np.asarray(cases, dtype = float)
+    n_cty, n_mth = cases.shape
+    total = cases.sum()
+
+    expected = expected_counts(cases, pop, time_adjust)
+    pop_tot = np.broadcast_to(np.asarray(pop, dtype = float).reshape(n_cty, -1), cases.shape).mean(1)
+
+    ## Neighbour orderings and the expected-count prefix sums are shared by the observed scan and every replicate
+    order, size = neighbour_order(xy, pop_tot, max_pop_frac, max_k)
+    windows = _windows(n_mth, max_len, prospective)
+    exp_prefix = _prefix(expected, order)
+
+    llr, k, start, end = _scan(cases, order, size, exp_prefix, windows)
+
+    ## Keep the best cylinder per center, then drop any that overlap a higher ranked cluster
+    clusters = []
+    taken = np.zeros(n_cty, dtype = bool)
+    for i in np.argsort(-llr):
+        if llr[i] <= 0 or len(clusters) >= n_clusters:
+            break
+        members = order[i, :k[i] + 1]
+        if taken[members].any():
+            continue
+        taken[members] = True
+
+        s, e = start[i], end[i]
+        obs = cases[members, s:e].sum()
+        exp = expected[members, s:e].sum()
+        clusters.append({'center': i, 'counties': members, 'start': s, 'end': e - 1,
+                         'observed': obs, 'expected': exp,
+                         'rel_risk': (obs/exp)/((total - obs)/(total - exp)) if total > obs else np.inf,
+                         'llr': llr[i]})
+
+    clusters = pd.DataFrame(clusters, columns = ['center', 'counties', 'start', 'end', 'observed',
+                                                 'expected', 'rel_risk', 'llr'])
+
+    if replicates <= 0 or clusters.empty:
+        clusters['p_value'] = np.nan
+        return clusters
+
+    ## Independent, reproducible random streams for each worker task
+    workers = workers or os.cpu_count()
+    n_tasks = min(replicates, 4*workers)
+    seeds = np.random.SeedSequence(seed).spawn(n_tasks)
+    counts = np.diff(np.linspace(0, replicates, n_tasks + 1).astype(int))
+
+    margins, prob = null_margins(cases, pop, time_adjust)
+    with ProcessPoolExecutor(workers, initializer = _init_worker,
+                             initargs = (order, size, margins, prob, exp_prefix, windows)) as pool:
+        null = np.concatenate(list(pool.map(_replicates, seeds, counts)))
+
+    clusters['p_value'] = [(1 + (null >= l).sum())/(replicates + 1) for l in clusters['llr']]
+    clusters.attrs['null_llr'] = null
+
+    return clusters
+
+
+def label_clusters(clusters, counties, months):
+    """
+    Swaps the position indices in a space_time_scan result for county names and monthly periods.
+    months are the integer month keys from county_month.county_month_array.
+    """
+    periods = key_to_period(months)
+    out = clusters.copy()
+    out['center'] = np.asarray(counties)[out['center'].values]
+    out['counties'] = [list(np.asarray(counties)[m]) for m in out['counties']]
+    out['start'] = periods[out['start'].values]
+    out['end'] = periods[out['end'].values]
+    return out
+
+
+#%%
+if __name__ == '__main__':
+
+    ## Synthetic check: one planted cluster on a random set of 429 counties over 108 months
+    rng = np.random.default_rng(2)
+    xy = rng.random((429, 2))*1e6
+    pop = rng.integers(2e4, 1e6, 429)
+    rate = np.full((429, 108), 2e-5)
+
+    near = np.argsort(((xy - xy[0])**2).sum(1))[:5]
+    rate[np.ix_(near, np.arange(60, 66))] *= 4
+    cases = rng.poisson(rate*pop[:, None])
+
+    import time
+    t0 = time.time()
+    print(space_time_scan(cases, pop, xy, replicates = 9, n_clusters = 3))
+    print(near, time.time() - t0)
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Spatial neighbour structures for the county layer
+
+Centroids, distance-ordered neighbour lists and sparse weights shared by the
+scan statistic, rate smoothing and Moran's I stages.
+"""
+
+import numpy as np
+from scipy import sparse
+from libpysal.weights.contiguity import Queen
+
+
+######### Functions #############
+def centroids(gdf, crs = 'EPSG:32639'):
+    """
+    Returns an (n, 2) array of county centroids. The layer is projected first
+    (UTM 39N by default, which covers most of Iran) so distances come out in metres.
+    """
+    pts = gdf.to_crs(crs).geometry.centroid
+    return np.column_stack([pts.x.values, pts.y.values])
+
+
+def neighbour_order(xy, pop = None, max_pop_frac = 0.5, max_k = None):
+    """
+    For every county, the other counties sorted by centroid distance (the county itself first).
+    The lists are cut where the cumulative population passes max_pop_frac of the total
+    (the usual scan statistic limit) and/or at max_k counties.
+    Returns an (n, K) index array and an (n,) array of how many entries of each row are usable.
+    """
+    xy = np.asarray(xy, dtype = float)
+    n = len(xy)
+
+    dist = np.sqrt(((xy[:, None, :] - xy[None, :, :])**2).sum(2))
+    order = np.argsort(dist, axis = 1, kind = 'stable')
+
+    ## Keep the county itself in position 0 even when two centroids coincide
+    self_pos = np.argmax(order == np.arange(n)[:, None], axis = 1)
+    order[np.arange(n), self_pos] = order[:, 0]
+    order[:, 0] = np.arange(n)
+
+    size = np.full(n, n)
+    if pop is not None:
+        pop = np.asarray(pop, dtype = float)
+        cum = np.cumsum(pop[order], axis = 1)
+        size = np.maximum((cum <= max_pop_frac*pop.sum()).sum(1), 1)
+    if max_k is not None:
+        size = np.minimum(size, max_k)
+
+    return order[:, :size.max()], size
+
+
+def queen_sparse(gdf):
+    """
+    Binary Queen contiguity weights for the rows of gdf (in row order) as a scipy CSR matrix.
+    Same neighbourhoods as the Queen.from_dataframe weights used for Moran's I.
+    """
+    w = Queen.from_dataframe(gdf, silence_warnings = True)
+    return w.sparse.tocsr().astype(float)
+
+
+def row_standardize(W):
+    """
+    Row standardizes a sparse weights matrix (the 'r' transform). Rows with no neighbours stay zero.
+    """
+    rs = np.asarray(W.sum(1)).ravel()
+    rs[rs == 0] = 1
+    return sparse.diags(1/rs) @ W
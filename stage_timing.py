@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+Stage timing and memory instrumentation
+
+Records, for each pipeline stage: wall time, rows in and out, process peak RSS and
+DataFrame memory usage, and writes one JSON report per run so slow runs can be traced
+to a stage and compared over time.
+
+Three ways to mark a stage:
+
+    run = RunLog('data_merge2')
+
+    run.start('human_cleaning', human_data)        ## between script cells, no re-indenting
+    ...
+    run.stop(human_sp_data)
+
+    with run.stage('aggregation', human_sp_data) as st:
+        ...
+        st.rows_out(ag_data)
+
+    match_names = run.timed('match_names')(match_names)   ## every call is recorded
+
+    run.write()
+
+Set BRUC_PROFILE=cprofile (or pyinstrument, if installed) to also profile each stage;
+the top functions by cumulative time are stored with the stage.
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import pstats
+import cProfile
+import platform
+import functools
+import contextlib
+from datetime import datetime
+
+import pandas as pd
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+## Default folder for run reports (relative to the working directory when the RunLog is made)
+RUN_DIR = os.path.join('Data', 'runs')
+
+
+######### Functions #############
+def rss_mb():
+    """
+    Current resident memory of this process in MB (None if it can't be read).
+    """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss/2**20
+    return None
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process so far, in MB.
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        ## ru_maxrss is in bytes on macOS and kB on Linux
+        return peak/2**20 if sys.platform == 'darwin' else peak/2**10
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss)/2**20
+    return None
+
+
+def frame_stats(obj):
+    """
+    Row count and deep memory usage (MB) of a DataFrame or Series; (None, None) for anything else.
+    """
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        mem = obj.memory_usage(deep = True)
+        return len(obj), float(mem.sum() if hasattr(mem, 'sum') else mem)/2**20
+    return None, None
+
+
+class _Profiler:
+    """
+    Wraps cProfile or pyinstrument behind the same start/stop/report calls.
+    Only the outermost open stage is profiled: a nested enable() would take the profiler
+    over from the outer stage (and raises on Python 3.12+), so nested stages only record
+    that they ran inside a profiled stage.
+    """
+    ## Number of profilers currently running in this process
+    active = 0
+
+    def __init__(self, kind, top = 15):
+        self.kind = kind
+        self.top = top
+        self.running = False
+        if kind == 'pyinstrument':
+            from pyinstrument import Profiler
+            self.prof = Profiler()
+        else:
+            self.prof = cProfile.Profile()
+
+    def start(self):
+        if _Profiler.active or sys.getprofile() is not None:
+            return
+        if self.kind == 'pyinstrument':
+            self.prof.start()
+        else:
+            self.prof.enable()
+        self.running = True
+        _Profiler.active += 1
+
+    def stop(self):
+        if not self.running:
+            return 'not profiled separately (nested in a profiled stage)'
+        self.running = False
+        _Profiler.active -= 1
+        if self.kind == 'pyinstrument':
+            self.prof.stop()
+            return self.prof.output_text(unicode = True, color = False)
+        self.prof.disable()
+        out = io.StringIO()
+        pstats.Stats(self.prof, stream = out).sort_stats('cumulative').print_stats(self.top)
+        return out.getvalue()
+
+
+class _Stage:
+    """
+    One open stage. rows_out can be called inside a with block to record the output frame.
+    """
+    def __init__(self, name, data, profile, **info):
+        self.record = {'stage': name, 'started': datetime.now().isoformat(timespec = 'seconds'), **info}
+        self.record['rows_in'], self.record['mem_in_mb'] = frame_stats(data)
+        self.record['rss_start_mb'] = rss_mb()
+        self.profiler = _Profiler(profile) if profile else None
+        if self.profiler:
+            self.profiler.start()
+        self.t0 = time.perf_counter()
+
+    def rows_out(self, data):
+        self.record['rows_out'], self.record['mem_out_mb'] = frame_stats(data)
+
+    def close(self, data = None):
+        self.record['seconds'] = time.perf_counter() - self.t0
+        if self.profiler:
+            self.record['profile'] = self.profiler.stop()
+        if data is not None:
+            self.rows_out(data)
+        self.record.setdefault('rows_out', None)
+        self.record.setdefault('mem_out_mb', None)
+        self.record['rss_end_mb'] = rss_mb()
+        self.record['peak_rss_mb'] = peak_rss_mb()
+        return self.record
+
+
+class RunLog:
+    """
+    Collects stage records for one pipeline run and writes them as JSON.
+    """
+    def __init__(self, name, profile = None, out_dir = RUN_DIR):
+        self.name = name
+        self.profile = profile if profile is not None else os.environ.get('BRUC_PROFILE') or None
+        self.out_dir = os.path.abspath(out_dir) if out_dir else out_dir
+        self.started = datetime.now()
+        self.stages = []
+        self._open = None
+
+    def start(self, name, data = None, **info):
+        """
+        Opens a stage (closing any stage still open). Keyword arguments are stored with the record.
+        """
+        if self._open is not None:
+            self.stop()
+        self._open = _Stage(name, data, self.profile, **info)
+
+    def stop(self, data = None):
+        """
+        Closes the open stage, recording data as its output.
+        """
+        if self._open is None:
+            return None
+        record = self._open.close(data)
+        self.stages.append(record)
+        self._open = None
+        return record
+
+    @contextlib.contextmanager
+    def stage(self, name, data = None, **info):
+        """
+        Context manager version of start/stop. Nested stages are recorded independently.
+        """
+        st = _Stage(name, data, self.profile, **info)
+        try:
+            yield st
+        finally:
+            self.stages.append(st.close())
+
+    def timed(self, name = None):
+        """
+        Decorator recording every call of a function as a stage. Rows in come from the first
+        DataFrame/Series argument, rows out from the return value.
+        """
+        def wrap(func):
+            @functools.wraps(func)
+            def inner(*args, **kwargs):
+                data = next((a for a in args if isinstance(a, (pd.DataFrame, pd.Series))), None)
+                st = _Stage(name or func.__name__, data, self.profile)
+                try:
+                    result = func(*args, **kwargs)
+                finally:
+                    self.stages.append(st.close())
+                self.stages[-1]['rows_out'], self.stages[-1]['mem_out_mb'] = frame_stats(result)
+                return result
+            return inner
+        return wrap
+
+    def summary(self):
+        """
+        Stages as a dataframe, with repeated stages (e.g. timed functions) totalled.
+        """
+        df = pd.DataFrame(self.stages)
+        if df.empty:
+            return df
+        return df.groupby('stage', sort = False).agg(calls = ('seconds', 'size'), seconds = ('seconds', 'sum'),
+                                                     rows_in = ('rows_in', 'max'), rows_out = ('rows_out', 'max'),
+                                                     peak_rss_mb = ('peak_rss_mb', 'max'))
+
+    def report(self):
+        return {'run': self.name,
+                'started': self.started.isoformat(timespec = 'seconds'),
+                'seconds': (datetime.now() - self.started).total_seconds(),
+                'python': platform.python_version(),
+                'pandas': pd.__version__,
+                'host': platform.node(),
+                'peak_rss_mb': peak_rss_mb(),
+                'stages': self.stages}
+
+    def write(self, path = None):
+        """
+        Writes the run report as JSON and returns the file path. Closes any stage still open.
+        """
+        self.stop()
+        if path is None:
+            os.makedirs(self.out_dir, exist_ok = True)
+            path = os.path.join(self.out_dir, '{}_{}.json'.format(self.name, self.started.strftime('%Y%m%d_%H%M%S')))
+        with open(path, 'w') as fh:
+            json.dump(self.report(), fh, indent = 1, default = str)
+        return path
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Chunked ingestion of the case registers
+
+The cleaning scripts read Human_Brucellosis_2015-2018_V2.csv (and animal_vac_data.csv) whole.
+The national registers are much bigger than the 2015-2018 extract, so this reads them in
+chunks and reduces each chunk to county-month counts as it goes: clean, rename, map county
+names, group, add to the running totals. Peak memory is set by chunksize plus the number of
+county-months, not the file size.
+
+County names are linked the way data_merge2.py links them (place_names.human_places): the
+distinct (province, county) pairs are read first, two columns at a time, and linked once, then
+every chunk gets the shapefile province names and the linked counties (link_human). The streamed
+counts can be checked against human_places run on the whole register (merged_counts).
+"""
+
+import os
+import posixpath
+import pandas as pd
+
+
+## Column renames applied to the human register (same as data_merge2.py)
+HUMAN_COLUMNS = {'Urban/Rural/Itinerant/Nomadic':'Pop_setting',
+                 'Prepnancy':'Pregnancy',
+                 'Occuptio':'Occupation',
+                 'Livestock interaction history':'Livestock_int_hist',
+                 'Livestock interaction type':'Livestock_int_type',
+                 'Unpasteurized dairy consumption ':'Unpast_dairy',
+                 'Other family members infection':'Fam_members_inf',
+                 'Outbreak Year':'Outbreak_yr',
+                 'Outbreak Month':'Outbreak_mth',
+                 'Diagnosis Year':'Diagnosis_yr',
+                 'Diagnosis Month':'Diagnosis_mth',
+                 'Livestock vaccination history':'Livestock_vac_hist'}
+
+## Duplicate province spellings in the human register
+HUMAN_PROVINCES = {'Khorasan jonobi':'Khorasan Jonobi',
+                   'Khorasan shomali':'Khorasan Shomali'}
+
+ANIMAL_COLUMNS = ['id', 'unitCode', 'unitType', 'province',
+                  'county', 'livestock_type', 'time_j', 'time_g',
+                  'lat' , 'long', 'n_sample', 'n_checked', 'n_infected',
+                  'n_rejected', 'n_suspicious']
+
+ANIMAL_COUNTS = ['n_sample', 'n_checked', 'n_infected', 'n_rejected', 'n_suspicious']
+
+
+######### Functions #############
+def data_path(base, *parts):
+    """
+    Joins a local folder or a URL (e.g. the raw github path) with file path parts.
+    os.path.join would use backslashes for URLs on Windows.
+    """
+    if '://' in base:
+        return posixpath.join(base, *parts)
+    return os.path.join(base, *parts)
+
+
+def read_mapping(path):
+    """
+    Reads one of the *_data_mappings.csv files (source name, shapefile name) into a dict.
+    """
+    mapping = pd.read_csv(path, dtype = str)
+    return dict(zip(mapping.iloc[:, 0], mapping.iloc[:, 1]))
+
+
+def clean_human(chunk, county_map):
+    """
+    Renames columns, fixes duplicate province spellings and maps county names onto the shapefile names.
+    """
+    chunk = chunk.drop(columns = [c for c in chunk.columns if c.startswith('Unnamed:')])
+    chunk = chunk.rename(columns = HUMAN_COLUMNS)
+    chunk['Province'] = chunk['Province'].replace(HUMAN_PROVINCES)
+    chunk['County'] = chunk['County'].map(county_map).fillna(chunk['County'])
+    return chunk
+
+
+def clean_animal(chunk, county_map):
+    """
+    Sets the animal column names, splits the gregorian date into month and year and maps county names.
+    """
+    chunk.columns = ANIMAL_COLUMNS
+    chunk[['month', 'year']] = chunk['time_g'].str.split('/', expand = True)[[0, 2]]
+    chunk['county'] = chunk['county'].map(county_map).fillna(chunk['county'])
+    return chunk
+
+
+def human_pairs(path, chunksize = 100000):
+    """
+    Distinct (Province, County) pairs of a human register, reading only those two columns.
+    """
+    chunks = pd.read_csv(path, usecols = ['Province', 'County'], dtype = str, chunksize = chunksize)
+    return pd.concat([chunk.drop_duplicates() for chunk in chunks]).drop_duplicates().reset_index(drop = True)
+
+
+def human_links(path, iran_data, xwalk = None, chunksize = 100000):
+    """
+    County links for every (province, county) pair of a register, made once before streaming with
+    place_names.human_places, so they don't depend on which chunk a pair turns up in.
+    """
+    from place_names import human_places
+    _, links, conflicts = human_places(human_pairs(path, chunksize), iran_data, xwalk = xwalk)
+    return links
+
+
+def link_human(chunk, links):
+    """
+    clean_human, then the shapefile province names and the linked counties (links from human_links),
+    as human_places does on the full table.
+    """
+    from place_names import human_province_names
+    from record_linkage import apply_links
+
+    chunk = clean_human(chunk, {})
+    chunk['Province'] = human_province_names(chunk['Province'])
+    chunk['County'] = apply_links(chunk, links, 'Province', 'County')['county_en'].values
+    return chunk
+
+
+def aggregate(chunk, by, values = None):
+    """
+    Reduces records to counts (values = None) or sums of the value columns per group.
+    Missing keys are kept as their own group so no records are lost.
+    """
+    grouped = chunk.groupby(by, dropna = False)
+    if values is None:
+        return grouped.size().rename('cases').to_frame()
+    return grouped[values].sum()
+
+
+def _combine(partials, by):
+    """
+    Adds up partial aggregates from several chunks.
+    """
+    return pd.concat(partials).groupby(level = by, dropna = False).sum()
+
+
+def stream_counts(path, clean, county_map, by, values = None, chunksize = 100000, dtype = None, **read_args):
+    """
+    Reads a csv in chunks, cleans each chunk and folds its group totals into a running total.
+    The partial totals are folded together every 10 chunks so memory stays on the order of the number of groups.
+    """
+    total = None
+    partials = []
+    for chunk in pd.read_csv(path, chunksize = chunksize, dtype = dtype, **read_args):
+        partials.append(aggregate(clean(chunk, county_map), by, values))
+        if len(partials) >= 10:
+            total = _combine(partials if total is None else [total] + partials, by)
+            partials = []
+
+    if partials:
+        total = _combine(partials if total is None else [total] + partials, by)
+
+    return total.sort_index()
+
+
+def stream_human_counts(path, links, by = ('County', 'Outbreak_yr', 'Outbreak_mth'), chunksize = 100000):
+    """
+    County-month human case counts from a register of any size (jalali outbreak year/month by default),
+    with the counties linked by links (human_links). All columns are read as strings so every chunk
+    gets the same key types.
+    """
+    return stream_counts(path, link_human, links, list(by), chunksize = chunksize, dtype = str)
+
+
+def stream_animal_counts(path, county_map, by = ('county', 'year', 'month'), chunksize = 100000):
+    """
+    County-month sums of the animal test counts (n_sample ... n_suspicious).
+    """
+    dtype = dict(zip(ANIMAL_COLUMNS, [str]*10 + [float]*5))
+    return stream_counts(path, clean_animal, county_map, list(by), ANIMAL_COUNTS, chunksize,
+                         dtype = dtype, header = 0, names = ANIMAL_COLUMNS)
+
+
+def merged_counts(path, iran_data, xwalk = None, by = ('County', 'Outbreak_yr', 'Outbreak_mth')):
+    """
+    The same counts from the whole register cleaned as data_merge2.py does (human_places on the
+    full table, no prepass). Used to check the streamed totals.
+    """
+    from place_names import human_places
+    data, links, conflicts = human_places(clean_human(pd.read_csv(path, dtype = str), {}), iran_data, xwalk = xwalk)
+    return aggregate(data, list(by)).sort_index()
+
+
+#%%
+if __name__ == '__main__':
+
+    import sys
+    from layer_cache import read_iran
+    from crosswalk import read_crosswalk
+
+    ## Usage: python streaming_ingest.py <human register csv> [chunksize]
+    fp = os.getcwd()
+    human_path = sys.argv[1] if len(sys.argv) > 1 else data_path(fp, 'Data', 'Human_Brucellosis_2015-2018_V2.csv')
+    chunksize = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+
+    iran_data = read_iran(fp, geometry = False)
+    xwalk = read_crosswalk(data_path(fp, 'county_crosswalk.csv'))
+
+    links = human_links(human_path, iran_data, xwalk, chunksize)
+    streamed = stream_human_counts(human_path, links, chunksize = chunksize)
+    full = merged_counts(human_path, iran_data, xwalk)
+
+    print(streamed.head())
+    print('{:.1%} of the counts on a shapefile county'.format(streamed.loc[streamed.index.get_level_values('County').isin(iran_data['county_en']), 'cases'].sum()/streamed['cases'].sum()))
+    print('Identical to the data_merge2 counts:', streamed.equals(full))
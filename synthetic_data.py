@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic inputs for benchmarking
+
+The real tables are small (about 4.5k human records, 430 counties), so they don't show how
+the pipeline scales. These generators make tables with the same columns and value formats
+at any size:
+
+    gazetteer      county/province names, scaled up with made-up names
+    name_variants  the same names with transliteration noise, like the registers' spellings
+    human_register rows shaped like Human_Brucellosis_2015-2018_V2.csv (raw column names)
+    animal_tests   rows shaped like animal_vac_data.csv
+    env_cube       a wide county x month table shaped like yearlyParams.csv / allParams.csv
+
+Everything is driven by a seed so benchmark runs are comparable.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import jdatetime
+
+from streaming_ingest import ANIMAL_COLUMNS
+
+
+## Substitutions seen between the registers' romanizations and the shapefile names
+TRANSLITERATIONS = [('ou', 'u'), ('u', 'ou'), ('ee', 'i'), ('i', 'ee'), ('e', 'a'), ('a', 'e'),
+                    ('kh', 'x'), ('gh', 'q'), ('q', 'gh'), ('sh', 'ch'), ('y', 'i'), ('aa', 'a'),
+                    ('-e-', ' '), ('-', ' '), (' ', '-'), ('h', '')]
+
+SYLLABLES = ['ab', 'ad', 'bad', 'bam', 'dar', 'deh', 'gar', 'gol', 'jan', 'kal', 'kan', 'kar',
+             'khor', 'lar', 'mah', 'mar', 'nah', 'pol', 'qal', 'rud', 'sar', 'shah', 'shir',
+             'tak', 'zan', 'zar', 'ban', 'dasht', 'kuh', 'ran', 'sab', 'tab']
+
+## Human register columns, in file order
+HUMAN_RAW_COLUMNS = ['ID', 'Province', 'County', 'Urban/Rural/Itinerant/Nomadic', 'Age', 'Sex',
+                     'Prepnancy', 'Occuptio', 'Livestock interaction history', 'Livestock interaction type',
+                     'Unpasteurized dairy consumption ', 'Other family members infection',
+                     'Outbreak Year', 'Outbreak Month', 'Diagnosis Year', 'Diagnosis Month',
+                     'Livestock vaccination history', 'Unnamed: 17', 'Unnamed: 18', 'Unnamed: 19']
+
+LIVESTOCK_TYPES = ['Cow', 'Sheep', 'Goat', 'Camel']
+
+ENV_VARIABLES = ['mean_2m_air_temperature', 'total_precipitation', 'mean']
+
+
+######### Functions #############
+def base_gazetteer(fp = None):
+    """
+    Real county and province names from the county layer, or made-up ones if it can't be read.
+    """
+    try:
+        from layer_cache import read_iran
+        return read_iran(fp, ['ADM2_EN', 'ADM1_EN'], geometry = False)[['county_en', 'province_en']]
+    except Exception:
+        return gazetteer(429, real = None)
+
+
+def _made_up_names(n, rng, taken = ()):
+    """
+    n distinct pronounceable names made from SYLLABLES, avoiding the ones in taken.
+    """
+    taken = set(taken)
+    names = []
+    while len(names) < n:
+        k = rng.integers(2, 4, size = n)
+        parts = rng.choice(SYLLABLES, size = (n, 3))
+        for row, length in zip(parts, k):
+            name = ''.join(row[:length]).capitalize()
+            if name not in taken:
+                taken.add(name)
+                names.append(name)
+                if len(names) == n:
+                    break
+    return names
+
+
+def gazetteer(n, real = 'default', n_provinces = None, seed = 0):
+    """
+    n county names with provinces. The real 429 names come first (real = a county/province table,
+    'default' to read the layer, or None for none); the rest are made up.
+    """
+    rng = np.random.default_rng(seed)
+    if isinstance(real, str):
+        real = base_gazetteer()
+    real = pd.DataFrame(columns = ['county_en', 'province_en']) if real is None else real.iloc[:n]
+
+    extra = n - len(real)
+    if extra <= 0:
+        return real.reset_index(drop = True)
+
+    n_provinces = n_provinces or max(31, n//14)
+    provinces = real['province_en'].unique().tolist()
+    provinces += _made_up_names(max(n_provinces - len(provinces), 0), rng, provinces)
+
+    made = pd.DataFrame({'county_en': _made_up_names(extra, rng, real['county_en']),
+                         'province_en': rng.choice(provinces, size = extra)})
+    return pd.concat([real, made], ignore_index = True)
+
+
+def transliterate(name, rng, n_edits = 1):
+    """
+    One noisy spelling of name: n_edits transliteration substitutions, with the odd
+    dropped/doubled letter and change of case, as in the registers.
+    """
+    out = name
+    for _ in range(n_edits):
+        options = [(a, b) for a, b in TRANSLITERATIONS if a in out.lower()]
+        r = rng.random()
+        if options and r < 0.7:
+            a, b = options[rng.integers(len(options))]
+            i = out.lower().find(a)
+            if out[i:i + 1].isupper():
+                b = b.capitalize()
+            out = out[:i] + b + out[i + len(a):]
+        elif len(out) > 3 and r < 0.85:
+            i = rng.integers(1, len(out) - 1)
+            out = out[:i] + out[i + 1:]
+        elif len(out) > 1:
+            i = rng.integers(1, len(out))
+            out = out[:i] + out[i] + out[i:]
+    if rng.random() < 0.2:
+        out = out.lower()
+    return out.strip() or name
+
+
+def name_variants(names, share = 0.3, max_edits = 2, seed = 0):
+    """
+    The names with a share of them misspelled (1 to max_edits edits each).
+    Returns a frame with the variant and the true name.
+    """
+    rng = np.random.default_rng(seed)
+    names = pd.Series(names).reset_index(drop = True)
+    noisy = rng.random(len(names)) < share
+    edits = rng.integers(1, max_edits + 1, size = len(names))
+    variants = [transliterate(nm, rng, e) if flag else nm for nm, flag, e in zip(names, noisy, edits)]
+    return pd.DataFrame({'variant': variants, 'true': names})
+
+
+def _spellings(gaz, share, seed):
+    """
+    Spelling used by the register for each county (fixed per county, like a real register).
+    """
+    return dict(zip(gaz['county_en'], name_variants(gaz['county_en'], share, seed = seed)['variant']))
+
+
+def human_register(n, gaz, years = (1394, 1397), share_misspelled = 0.3, null_share = 0.02, seed = 0):
+    """
+    n human case records with the raw register columns and value formats (strings, 'Null' for missing).
+    County names are misspelled for share_misspelled of the counties.
+    """
+    rng = np.random.default_rng(seed)
+    spell = _spellings(gaz, share_misspelled, seed)
+
+    ## Case counts are skewed towards a minority of counties
+    weight = rng.gamma(0.5, size = len(gaz))
+    idx = rng.choice(len(gaz), size = n, p = weight/weight.sum())
+
+    yr = rng.integers(years[0], years[1] + 1, size = n).astype(str).astype(object)
+    mth = rng.integers(1, 13, size = n).astype(str).astype(object)
+    yr[rng.random(n) < null_share] = 'Null'
+
+    yes_no = np.array(['Yes', 'No', 'Null'])
+    data = {'ID': np.arange(n),
+            'Province': gaz['province_en'].values[idx],
+            'County': pd.Series(gaz['county_en'].values[idx]).map(spell).values,
+            'Urban/Rural/Itinerant/Nomadic': rng.choice(['Urban', 'Rural', 'Itinerant', 'Nomadic'], size = n, p = [0.3, 0.6, 0.05, 0.05]),
+            'Age': rng.integers(1, 90, size = n),
+            'Sex': rng.choice(['Male', 'Female'], size = n),
+            'Prepnancy': rng.choice(yes_no, size = n, p = [0.02, 0.9, 0.08]),
+            'Occuptio': rng.integers(1, 20, size = n),
+            'Livestock interaction history': rng.choice(yes_no, size = n, p = [0.6, 0.3, 0.1]),
+            'Livestock interaction type': rng.choice(np.r_[np.arange(1, 11).astype(str), ['Null']], size = n),
+            'Unpasteurized dairy consumption ': rng.choice(yes_no, size = n, p = [0.5, 0.4, 0.1]),
+            'Other family members infection': rng.choice(yes_no, size = n, p = [0.1, 0.8, 0.1]),
+            'Outbreak Year': yr,
+            'Outbreak Month': mth,
+            'Diagnosis Year': yr,
+            'Diagnosis Month': mth,
+            'Livestock vaccination history': rng.choice(yes_no, size = n, p = [0.3, 0.4, 0.3])}
+
+    df = pd.DataFrame(data)
+    for col in HUMAN_RAW_COLUMNS[-3:]:
+        df[col] = np.nan
+    return df[HUMAN_RAW_COLUMNS]
+
+
+def animal_tests(n, gaz, years = (2015, 2018), share_misspelled = 0.3, seed = 0):
+    """
+    n animal test records with the animal_vac_data.csv columns (time_j as jalali y/m/d, time_g as gregorian m/d/y).
+    """
+    rng = np.random.default_rng(seed)
+    spell = _spellings(gaz, share_misspelled, seed + 1)
+    idx = rng.integers(len(gaz), size = n)
+
+    days = pd.to_datetime('{}-01-01'.format(years[0])) + pd.to_timedelta(rng.integers(0, 365*(years[1] - years[0] + 1), size = n), unit = 'D')
+    ## Jalali dates are converted once per distinct day
+    uniq = pd.Series(days.unique())
+    jal = {d: jdatetime.date.fromgregorian(date = d.date()).strftime('%Y/%m/%d') for d in uniq}
+
+    n_sample = rng.integers(1, 200, size = n)
+    n_checked = n_sample - rng.binomial(n_sample, 0.05)
+    n_infected = rng.binomial(n_checked, 0.03)
+    n_suspicious = rng.binomial(n_checked - n_infected, 0.01)
+    n_rejected = rng.binomial(n_infected, 0.5)
+
+    df = pd.DataFrame({'id': np.arange(n),
+                       'unitCode': rng.integers(1000, 9999, size = n),
+                       'unitType': rng.choice(['Farm', 'Village', 'Industrial'], size = n),
+                       'province': gaz['province_en'].values[idx],
+                       'county': pd.Series(gaz['county_en'].values[idx]).map(spell).values,
+                       'livestock_type': rng.choice(LIVESTOCK_TYPES, size = n, p = [0.4, 0.35, 0.2, 0.05]),
+                       'time_j': pd.Series(days).map(jal).values,
+                       'time_g': days.strftime('%m/%d/%Y').str.lstrip('0').str.replace('/0', '/', regex = False),
+                       'lat': rng.uniform(25, 40, size = n),
+                       'long': rng.uniform(44, 63, size = n),
+                       'n_sample': n_sample, 'n_checked': n_checked, 'n_infected': n_infected,
+                       'n_rejected': n_rejected, 'n_suspicious': n_suspicious})
+    df.columns = ANIMAL_COLUMNS
+    return df
+
+
+def env_cube(counties, start_year = 2008, end_year = 2018, variables = ENV_VARIABLES, seed = 0):
+    """
+    Wide environmental table indexed by ADM2_EN with <variable>_YYYYMM columns plus mean_elevation,
+    the layout addEnvData reads.
+    """
+    rng = np.random.default_rng(seed)
+    periods = ['{}{:02d}'.format(y, m) for y in range(start_year, end_year + 1) for m in range(1, 13)]
+    n = len(counties)
+    season = np.cos(2*np.pi*(np.arange(len(periods)) % 12)/12)
+
+    blocks = []
+    for var in variables:
+        vals = rng.normal(size = (n, 1)) + season[None, :] + 0.1*rng.normal(size = (n, len(periods)))
+        blocks.append(pd.DataFrame(vals, columns = [var + '_' + p for p in periods]))
+
+    cube = pd.concat(blocks, axis = 1)
+    cube['mean_elevation'] = rng.uniform(-20, 3000, size = n)
+    cube.index = pd.Index(counties, name = 'ADM2_EN')
+    return cube
+
+
+def grid_counties(n, seed = 0):
+    """
+    Stand-in contiguity for n counties: a near-square queen lattice (libpysal), for scaling the spatial statistics.
+    """
+    from libpysal.weights import lat2W
+    side = int(np.ceil(np.sqrt(n)))
+    W = lat2W(side, side, rook = False)
+    keep = np.arange(n)
+    return W.sparse.tocsr()[keep][:, keep]
+
+
+#%%
+if __name__ == '__main__':
+
+    gaz = gazetteer(429*10)
+    print(gaz.tail())
+    print(name_variants(gaz['county_en'].head(10), share = 1.0))
+    print(human_register(5, gaz).T)
+    print(animal_tests(5, gaz).T)
+    print(env_cube(gaz['county_en'].head(3), 2015, 2015).iloc[:, :4])
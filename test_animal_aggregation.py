@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for animal_aggregation: the county-month totals conserve the record counts.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import synthetic_data as syn
+from streaming_ingest import clean_animal, ANIMAL_COUNTS
+from animal_aggregation import aggregate_animal, check_totals
+
+
+@pytest.fixture(scope = 'module')
+def animal_data():
+    return clean_animal(syn.animal_tests(20000, syn.gazetteer(60), seed = 1), {})
+
+
+def _record_totals(animal_data, by):
+    data = animal_data.dropna(subset = [by, 'year', 'month'])
+    return data[ANIMAL_COUNTS].apply(pd.to_numeric, errors = 'coerce').fillna(0).groupby(data[by]).sum().sort_index()
+
+
+@pytest.mark.parametrize('by_type', [False, True])
+def test_totals_conserved(animal_data, by_type):
+    totals = aggregate_animal(animal_data, by_type = by_type)
+    source = _record_totals(animal_data, 'county')
+
+    per_county = totals.groupby('county')[ANIMAL_COUNTS].sum().sort_index()
+    assert per_county.index.equals(source.index)
+    assert np.allclose(per_county.values, source.values)
+    assert np.allclose(totals[ANIMAL_COUNTS].sum().values, source.sum().values)
+    assert check_totals(animal_data, totals)
+
+
+def test_types_add_up_to_county_months(animal_data):
+    cm = aggregate_animal(animal_data)
+    by_type = aggregate_animal(animal_data, by_type = True)
+    rolled = by_type.groupby(['county', 'month_key'])[ANIMAL_COUNTS].sum().reset_index(drop = True)
+    assert np.allclose(rolled.values, cm[ANIMAL_COUNTS].values)
+
+
+def test_check_totals_raises_on_lost_counts(animal_data):
+    totals = aggregate_animal(animal_data)
+    totals.loc[totals.index[0], 'n_infected'] += 1
+    with pytest.raises(ValueError):
+        check_totals(animal_data, totals)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for record_linkage: records whose province and county disagree don't reach a polygon.
+"""
+
+import pandas as pd
+import pytest
+
+from record_linkage import link_counties, apply_links
+from place_names import human_places
+from lazy_joins import outer_join
+from stage_timing import RunLog
+
+
+@pytest.fixture(scope = 'module')
+def iran_data():
+    return pd.DataFrame({'county_en': ['Behbahan', 'Abadan', 'Dezful', 'Dehdasht', 'Gachsaran', 'Yasuj'],
+                         'province_en': ['Khuzestan']*3 + ['Kohgiluyeh and Boyer-Ahmad']*3})
+
+
+@pytest.fixture(scope = 'module')
+def human_data():
+    return pd.DataFrame({'ID': [1, 2, 3],
+                         'Province': ['Khuzestan', 'Kohgiluyeh & Boyerahmad', 'Kohgiluyeh & Boyerahmad'],
+                         'County': ['Behbahan', 'Behbahan', 'Gachsaran']})
+
+
+def test_conflict_reported(iran_data, human_data):
+    records = human_data.assign(Province = human_data['Province'].replace({'Kohgiluyeh & Boyerahmad': 'Kohgiluyeh and Boyer-Ahmad'}))
+    links, conflicts = link_counties(records, iran_data, 'Province', 'County', manual = {})
+    assert conflicts[['province', 'county']].values.tolist() == [['Kohgiluyeh and Boyer-Ahmad', 'Behbahan']]
+    assert 'Behbahan in Khuzestan' in conflicts['reason'].iloc[0]
+
+    linked = apply_links(records, links, 'Province', 'County')
+    assert linked['county_en'].isna().tolist() == [False, True, False]
+    assert apply_links(records, links, 'Province', 'County', keep_unlinked = True)['county_en'].iloc[1] == 'Behbahan'
+
+
+def test_conflict_not_joined(iran_data, human_data):
+    linked, links, conflicts = human_places(human_data, iran_data, manual = {})
+    joined = outer_join(linked, iran_data, 'County', 'county_en')
+
+    ## Only the Khuzestan record joins to Behbahan; the conflicting record is kept without a polygon
+    assert joined.loc[joined['county_en'] == 'Behbahan', 'ID'].tolist() == [1]
+    conflict = joined[joined['ID'] == 2]
+    assert len(conflict) == 1 and conflict['county_en'].isna().all() and conflict['province_en'].isna().all()
+    assert joined.loc[joined['ID'] == 3, 'county_en'].tolist() == ['Gachsaran']
+
+
+def test_matching_timed(iran_data, human_data):
+    log = RunLog('test')
+    human_places(human_data, iran_data, manual = {}, log = log)
+    assert [(s['stage'], s['rows_in']) for s in log.stages] == [('human_name_matching', 3)]
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for stage_timing: nested stages under the cProfile profiler, and where reports are written.
+"""
+
+import os
+import sys
+import pandas as pd
+
+from stage_timing import RunLog
+
+
+def _work(n):
+    return pd.DataFrame({'x': range(n)}).groupby(pd.Series(range(n)) % 7).sum()
+
+
+def test_timed_inside_start_keeps_outer_profile():
+    run = RunLog('test', profile = 'cprofile', out_dir = None)
+    inner = run.timed('inner')(_work)
+
+    run.start('outer')
+    inner(1000)
+    _work(2000)
+    run.stop()
+
+    records = {r['stage']: r for r in run.stages}
+    assert set(records) == {'outer', 'inner'}
+    assert 'nested' in records['inner']['profile']
+    ## Work after the nested call is still in the outer stage's profile
+    assert '_work' in records['outer']['profile']
+    assert 'ncalls' in records['outer']['profile']
+    assert sys.getprofile() is None
+
+
+def test_nested_context_stages():
+    run = RunLog('test', profile = 'cprofile', out_dir = None)
+    with run.stage('outer'):
+        with run.stage('inner'):
+            _work(100)
+        _work(100)
+    with run.stage('after'):
+        _work(100)
+
+    records = {r['stage']: r for r in run.stages}
+    assert 'ncalls' in records['outer']['profile']
+    assert 'ncalls' in records['after']['profile']
+    assert 'nested' in records['inner']['profile']
+
+
+def test_default_folder_follows_working_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    run = RunLog('test')
+    monkeypatch.chdir(os.path.dirname(tmp_path))
+    path = run.write()
+    assert os.path.dirname(path) == os.path.join(str(tmp_path), 'Data', 'runs') and os.path.exists(path)
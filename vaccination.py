@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Livestock vaccination coverage
+
+Two sources describe vaccination:
+
+    animal_vac_data.csv      test records per unit, county, livestock type and date
+                             (n_sample tested, n_infected ...), plus a vaccinated count
+                             column when the extract has one
+    human register           Livestock_vac_hist (Yes/No/Null): whether the patient's
+                             livestock were vaccinated
+
+coverage_layer reduces both to one county-month table in a single groupby each, over
+categorical keys: vaccinated/tested/infected animal counts by livestock type and the
+share of human cases reporting vaccinated livestock. add_coverage writes the layer onto
+a county-month analysis table so it can be used as a covariate directly.
+
+The project goal is percent vaccinated out of the county's livestock population; there is
+no livestock census in the repository, so the animal coverage here is vaccinated over
+tested animals. Pass a population column to animal_counts when one is available.
+
+animal_vac_data.csv has no vaccinated column at the moment, so without vaccinated_col the
+layer has no animal coverage columns (only the tested/infected counts and the human reports).
+"""
+
+import numpy as np
+import pandas as pd
+
+from county_month import month_key
+
+
+######### Functions #############
+def _keys(data, county_col, year_col, month_col, extra = ()):
+    """
+    Categorical county (and extra) keys plus the integer month key; rows without them are dropped.
+    """
+    keys = pd.DataFrame({'county_en': pd.Categorical(data[county_col]),
+                         'month_key': month_key(data[year_col], data[month_col])}, index = data.index)
+    for col in extra:
+        keys[col] = pd.Categorical(data[col])
+    keys = keys.dropna()
+    keys['month_key'] = keys['month_key'].astype(np.int32)
+    return keys
+
+
+def animal_counts(animal_data, county_col = 'county', year_col = 'year', month_col = 'month', type_col = 'livestock_type',
+                  vaccinated_col = None, population_col = None):
+    """
+    Vaccinated, tested and infected animals per county, month and livestock type.
+    vaccinated_col / population_col name count columns if the extract has them (left NaN otherwise).
+    """
+    keys = _keys(animal_data, county_col, year_col, month_col, [type_col])
+    vals = pd.DataFrame({'tested': animal_data['n_sample'], 'infected': animal_data['n_infected']})
+    for out, col in [('vaccinated', vaccinated_col), ('population', population_col)]:
+        if col is not None:
+            vals[out] = animal_data[col]
+    vals = vals.loc[keys.index].apply(pd.to_numeric, errors = 'coerce')
+
+    counts = pd.concat([keys, vals], axis = 1).groupby(['county_en', 'month_key', type_col], observed = True).sum(min_count = 1)
+    for out in ['vaccinated', 'population']:
+        if out not in counts:
+            counts[out] = np.nan
+
+    counts = counts.reset_index().rename(columns = {type_col: 'livestock_type'})
+    denom = counts['population'].where(counts['population'] > 0, counts['tested'].where(counts['tested'] > 0))
+    counts['animal_vac_cov'] = counts['vaccinated']/denom
+    return counts
+
+
+def human_reports(human_data, county_col = 'county_en', year_col = 'year', month_col = 'month', vac_col = 'Livestock_vac_hist'):
+    """
+    Human cases per county and month by reported livestock vaccination (yes / no / unknown),
+    and the share of cases with a known answer that report vaccinated livestock.
+    """
+    keys = _keys(human_data, county_col, year_col, month_col)
+    answer = human_data.loc[keys.index, vac_col].astype(str).str.strip().str.capitalize()
+    keys['vac'] = pd.Categorical(answer.where(answer.isin(['Yes', 'No']), 'Unknown'), categories = ['Yes', 'No', 'Unknown'])
+
+    counts = keys.groupby(['county_en', 'month_key', 'vac'], observed = False).size().unstack('vac', fill_value = 0)
+    counts = counts[counts.sum(axis = 1) > 0]
+    counts.columns = ['cases_vac_yes', 'cases_vac_no', 'cases_vac_unknown']
+    known = counts['cases_vac_yes'] + counts['cases_vac_no']
+    counts['human_vac_cov'] = counts['cases_vac_yes']/known.where(known > 0)
+    return counts.reset_index()
+
+
+def coverage_layer(animal_data = None, human_data = None, animal_args = None, human_args = None):
+    """
+    County-month coverage table: animal counts summed over livestock types plus one coverage column
+    per type (animal_vac_cov_<type>), and the human-reported coverage. Either source can be left out.
+    Columns with no source (vaccinated or population counts not named in animal_args) are left out
+    rather than written as all NaN.
+    """
+    layers = []
+    if animal_data is not None:
+        animal_args = animal_args or {}
+        counts = animal_counts(animal_data, **animal_args)
+        total = counts.groupby(['county_en', 'month_key'], observed = True)[['vaccinated', 'tested', 'infected', 'population']].sum(min_count = 1)
+        if animal_args.get('vaccinated_col') is not None:
+            denom = total['population'].where(total['population'] > 0, total['tested'].where(total['tested'] > 0))
+            total['animal_vac_cov'] = total['vaccinated']/denom
+            by_type = counts.pivot_table(index = ['county_en', 'month_key'], columns = 'livestock_type', values = 'animal_vac_cov', observed = True)
+            by_type.columns = ['animal_vac_cov_' + str(c).lower() for c in by_type.columns]
+            total = total.join(by_type)
+        total = total.drop(columns = [out for out in ['vaccinated', 'population'] if animal_args.get(out + '_col') is None])
+        layers.append(total.rename(columns = {'vaccinated': 'animals_vaccinated', 'tested': 'animals_tested',
+                                              'infected': 'animals_infected', 'population': 'animals_population'}))
+    if human_data is not None:
+        layers.append(human_reports(human_data, **(human_args or {})).set_index(['county_en', 'month_key']))
+
+    layer = pd.concat(layers, axis = 1, join = 'outer').reset_index()
+    layer['county_en'] = layer['county_en'].astype(str)
+    layer.insert(2, 'year', layer['month_key']//12)
+    layer.insert(3, 'month', layer['month_key']%12 + 1)
+    return layer
+
+
+def add_coverage(table, layer, county_col = 'county_en', year_col = 'year', month_col = 'month', columns = None):
+    """
+    Writes the coverage columns onto a county-month (or record-level) table by integer lookup,
+    keeping the table's rows. Cells with no coverage data get NaN.
+    """
+    columns = columns or [c for c in layer.columns if c not in ('county_en', 'month_key', 'year', 'month')]
+    index = pd.MultiIndex.from_arrays([layer['county_en'], layer['month_key']])
+    keys = month_key(table[year_col], table[month_col])
+    pos = index.get_indexer(pd.MultiIndex.from_arrays([table[county_col].astype(str), np.nan_to_num(keys, nan = -1).astype(int)]))
+
+    ok = pos >= 0
+    for col in columns:
+        vals = layer[col].to_numpy(dtype = float)
+        table[col] = np.where(ok, vals[np.where(ok, pos, 0)], np.nan)
+    return table
+
+
+#%%
+if __name__ == '__main__':
+
+    import synthetic_data as syn
+    from streaming_ingest import clean_animal, clean_human
+    from national_0911 import jalali_to_gregorian
+
+    gaz = syn.gazetteer(429)
+    animal_data = clean_animal(syn.animal_tests(50000, gaz, share_misspelled = 0), {})
+    animal_data['n_vaccinated'] = np.random.default_rng(0).binomial(animal_data['n_sample'], 0.6)
+
+    human_data = clean_human(syn.human_register(5000, gaz, share_misspelled = 0), {})
+    human_data['year'], human_data['month'] = jalali_to_gregorian(human_data['Outbreak_yr'], human_data['Outbreak_mth'])
+    human_data = human_data.rename(columns = {'County': 'county_en'})
+
+    layer = coverage_layer(animal_data, human_data, animal_args = {'vaccinated_col': 'n_vaccinated'})
+    print(layer.head())
+
+    ## The current extract has no vaccinated column: no animal coverage columns at all
+    print(list(coverage_layer(animal_data.drop(columns = 'n_vaccinated'), human_data).columns))
+
+    table = human_data.groupby(['county_en', 'year', 'month']).size().rename('cases').reset_index()
+    print(add_coverage(table, layer).head())
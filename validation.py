@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+Input validation
+
+The cleaning scripts fix data problems silently where they are found ('Yasooj\\r', the
+Unnamed: 18/19 columns, 'Null' strings among the outbreak years) or not at all (addEnvData
+failing on NaN years). This checks the inputs up front. Each rule is one vectorized mask over
+a column (or a pair of columns) marking the rows that break it, and validate returns one
+report row per rule:
+
+    check       column      severity   n_bad   share   examples
+
+check() writes the report to Data/runs and, with fail_fast = True, raises ValidationError
+when any 'error' rule is broken, so later stages never run on bad inputs:
+
+    report = check(human_data, human_rules(), 'human', fail_fast = True)
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+from stage_timing import RUN_DIR
+
+
+## Values standing for "missing" in the registers
+MISSING = ['Null', 'null', 'NULL', '', 'nan', 'NaN']
+
+YES_NO = ['Yes', 'No']
+SEX = ['Male', 'Female']
+POP_SETTINGS = ['Urban', 'Rural', 'Itinerant', 'Nomadic']
+
+## Plausible ranges: jalali years of the registers, gregorian years of the animal tests, Iran's bounding box
+JALALI_YEARS = (1385, 1400)
+GREGORIAN_YEARS = (2006, 2021)
+IRAN_LAT = (25.0, 40.0)
+IRAN_LON = (44.0, 63.5)
+
+
+class ValidationError(ValueError):
+    """
+    Raised by check(fail_fast = True) when an error-level rule is broken.
+    """
+    def __init__(self, name, report):
+        self.report = report
+        bad = report[(report['severity'] == 'error') & (report['n_bad'] > 0)]
+        self.name = name
+        super().__init__('{} failed validation: {}'.format(name, ', '.join(bad['check'] + ' (' + bad['n_bad'].astype(str) + ')')))
+
+    def __reduce__(self):
+        ## So it survives being raised in a worker process
+        return ValidationError, (self.name, self.report)
+
+
+######### Functions #############
+def _by_value(s, func):
+    """
+    Applies func to the distinct values of s only and maps the result back to the rows
+    (register columns have few distinct values, so this is much faster than a row-wise parse).
+    """
+    codes, uniques = pd.factorize(s)
+    vals = np.asarray(func(pd.Series(uniques, dtype = object)))
+    out = vals[np.maximum(codes, 0)]
+    return out, codes < 0
+
+
+def _missing(s):
+    if pd.api.types.is_numeric_dtype(s):
+        return s.isna().to_numpy()
+    vals, na = _by_value(s, lambda u: u.astype(str).str.strip().isin(MISSING))
+    return vals.astype(bool) | na
+
+
+def _numbers(s):
+    if pd.api.types.is_numeric_dtype(s) and not isinstance(s.dtype, pd.CategoricalDtype):
+        return pd.Series(s.to_numpy(dtype = float), index = s.index)
+    vals, na = _by_value(s, lambda u: pd.to_numeric(u, errors = 'coerce').to_numpy(dtype = float))
+    return pd.Series(np.where(na, np.nan, vals.astype(float)), index = s.index)
+
+
+def rule(name, columns, test, severity = 'error'):
+    """
+    A rule: test(df) returns a boolean mask of the rows that break it.
+    """
+    return {'check': name, 'column': columns if isinstance(columns, str) else ', '.join(columns),
+            'severity': severity, 'test': test}
+
+
+def required(columns, severity = 'error'):
+    """
+    The columns exist (the mask marks every row if any is absent).
+    """
+    return rule('required columns', columns, lambda df: np.full(len(df), not set(columns) <= set(df.columns)), severity)
+
+
+def no_extra(prefix = 'Unnamed:', severity = 'warning'):
+    """
+    No leftover unnamed columns from trailing commas in the CSV.
+    """
+    return rule('unnamed columns', prefix, lambda df: np.full(len(df), any(str(c).startswith(prefix) for c in df.columns)), severity)
+
+
+def numeric(col, severity = 'error'):
+    """
+    Values are numbers or a missing token ('Null').
+    """
+    return rule('numeric', col, lambda df: ~_missing(df[col]) & _numbers(df[col]).isna(), severity)
+
+
+def in_range(col, lo, hi, severity = 'error'):
+    """
+    Numeric values fall in [lo, hi] (missing values pass; non-numbers are the numeric rule's job).
+    """
+    def test(df):
+        x = _numbers(df[col])
+        return ~x.between(lo, hi) & x.notna()
+    return rule('in range {}-{}'.format(lo, hi), col, test, severity)
+
+
+def allowed(col, values, severity = 'warning'):
+    """
+    Values are one of the allowed codes (or missing).
+    """
+    allowed_str = set(str(v) for v in values)
+    def test(df):
+        ok, na = _by_value(df[col], lambda u: u.astype(str).str.strip().isin(allowed_str))
+        return ~_missing(df[col]) & ~(ok.astype(bool) | na)
+    return rule('allowed codes', col, test, severity)
+
+
+def not_missing(col, severity = 'warning'):
+    return rule('not missing', col, lambda df: _missing(df[col]), severity)
+
+
+def not_negative(cols, severity = 'error'):
+    """
+    Counts are not negative.
+    """
+    return rule('not negative', cols, lambda df: (df[list(cols)].apply(_numbers) < 0).any(axis = 1), severity)
+
+
+def not_greater(col, limit_col, severity = 'error'):
+    """
+    col <= limit_col row by row, e.g. n_infected <= n_sample.
+    """
+    return rule('{} <= {}'.format(col, limit_col), [col, limit_col],
+                lambda df: _numbers(df[col]) > _numbers(df[limit_col]), severity)
+
+
+def clean_text(col, severity = 'warning'):
+    """
+    No control characters or surrounding spaces (the 'Yasooj\\r' problem).
+    """
+    return rule('clean text', col, lambda df: df[col].notna() & df[col].astype(str).str.contains(r'[\x00-\x1f]|^\s|\s$', regex = True), severity)
+
+
+def unique(col, severity = 'error'):
+    return rule('unique', col, lambda df: df[col].notna() & df[col].duplicated(keep = False), severity)
+
+
+def matched(col, keys, severity = 'warning', source_col = None):
+    """
+    Values are found in keys (e.g. linked county names in the layer). With source_col, only rows
+    that had a value there count (records with no county to begin with are not 'unmatched').
+    """
+    keys = pd.Index(pd.Series(keys).dropna().unique())
+    def test(df):
+        bad = ~df[col].isin(keys)
+        return bad & ~_missing(df[source_col]) if source_col else bad & ~_missing(df[col])
+    return rule('matched keys', [source_col, col] if source_col else col, test, severity)
+
+
+def human_rules(code_tables = None):
+    """
+    Rules for the human register after the column renames.
+    """
+    if code_tables is None:
+        from risk_codes import read_code_tables
+        code_tables = read_code_tables()
+    return [required(['Province', 'County', 'Outbreak_yr', 'Outbreak_mth', 'Age', 'Sex']),
+            no_extra(),
+            numeric('Outbreak_yr'), numeric('Outbreak_mth'), numeric('Age'),
+            not_missing('Outbreak_yr'),
+            in_range('Outbreak_yr', *JALALI_YEARS), in_range('Outbreak_mth', 1, 12),
+            in_range('Diagnosis_yr', *JALALI_YEARS, severity = 'warning'), in_range('Diagnosis_mth', 1, 12, severity = 'warning'),
+            in_range('Age', 0, 110, severity = 'warning'),
+            allowed('Sex', SEX), allowed('Pop_setting', POP_SETTINGS),
+            allowed('Occupation', code_tables['Job'].index), allowed('Livestock_int_type', code_tables['Interaction type'].index),
+            allowed('Livestock_int_hist', YES_NO), allowed('Livestock_vac_hist', YES_NO),
+            allowed('Unpast_dairy', YES_NO), allowed('Fam_members_inf', YES_NO),
+            not_missing('County'), clean_text('County'), clean_text('Province')]
+
+
+def animal_rules():
+    """
+    Rules for the animal tests after clean_animal (named columns, gregorian year and month).
+    """
+    counts = ['n_sample', 'n_checked', 'n_infected', 'n_rejected', 'n_suspicious']
+    def bad_year(df):
+        y = _numbers(df['year'])
+        y = y.where(y >= 100, y + 2000)
+        return ~y.between(*GREGORIAN_YEARS) & y.notna()
+    return [required(['province', 'county', 'year', 'month'] + counts)] + \
+           [numeric(c) for c in counts + ['lat', 'long']] + \
+           [not_negative(counts),
+            not_greater('n_infected', 'n_sample'), not_greater('n_rejected', 'n_sample'), not_greater('n_checked', 'n_sample', 'warning'),
+            rule('in range {}-{}'.format(*GREGORIAN_YEARS), 'year', bad_year),
+            not_missing('year'), in_range('month', 1, 12),
+            in_range('lat', *IRAN_LAT, severity = 'warning'), in_range('long', *IRAN_LON, severity = 'warning'),
+            not_missing('county'), clean_text('county')]
+
+
+def layer_rules():
+    """
+    Rules for the county layer attributes.
+    """
+    return [required(['county_en', 'province_en']), unique('ADM2_PCODE'), unique('county_en', 'warning'),
+            clean_text('county_en'), clean_text('province_en')]
+
+
+def validate(df, rules, n_examples = 5):
+    """
+    Runs every rule and returns the report (one row per rule). Rules on absent columns are
+    reported as skipped rather than failing.
+    """
+    rows = []
+    for r in rules:
+        entry = {k: r[k] for k in ['check', 'column', 'severity']}
+        try:
+            mask = np.asarray(r['test'](df), dtype = bool)
+        except KeyError as e:
+            rows.append({**entry, 'n_bad': 0, 'share': 0.0, 'examples': 'skipped: no column {}'.format(e)})
+            continue
+        n_bad = int(mask.sum())
+        cols = [c.strip() for c in r['column'].split(',') if c.strip() in df.columns]
+        examples = df.loc[mask, cols].drop_duplicates().head(n_examples) if n_bad and cols else None
+        rows.append({**entry, 'n_bad': n_bad, 'share': n_bad/max(len(df), 1),
+                     'examples': '' if examples is None else '; '.join(examples.apply(lambda r: '|'.join(map(str, r)), axis = 1).map(repr))})
+    return pd.DataFrame(rows, columns = ['check', 'column', 'severity', 'n_bad', 'share', 'examples'])
+
+
+def check(df, rules, name, fail_fast = False, out_dir = RUN_DIR):
+    """
+    Validates df, writes the report to out_dir/validation_<name>.csv (if out_dir) and, with
+    fail_fast, raises ValidationError when an error-level rule is broken.
+    """
+    report = validate(df, rules)
+    report.insert(0, 'table', name)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok = True)
+        report.to_csv(os.path.join(out_dir, 'validation_{}.csv'.format(name)), index = False)
+    if fail_fast and ((report['severity'] == 'error') & (report['n_bad'] > 0)).any():
+        raise ValidationError(name, report)
+    return report
+
+
+#%%
+if __name__ == '__main__':
+
+    import time
+    import synthetic_data as syn
+    from streaming_ingest import clean_human, clean_animal
+
+    gaz = syn.gazetteer(429)
+    human = clean_human(syn.human_register(500000, gaz), {})
+    animal = clean_animal(syn.animal_tests(500000, gaz), {})
+
+    ## A few of the problems the scripts fix by hand, plus some they don't
+    animal.loc[animal.index[:3], 'n_infected'] = animal.loc[animal.index[:3], 'n_sample'] + 1
+    animal.loc[animal.index[3], 'county'] = 'Yasooj\r'
+    human.loc[human.index[:2], 'Outbreak_yr'] = '2016'
+
+    t0 = time.perf_counter()
+    reports = pd.concat([check(human, human_rules(), 'human', out_dir = None),
+                         check(animal, animal_rules(), 'animal', out_dir = None)])
+    print('{} rules over {} records in {:.2f}s'.format(len(reports), len(human) + len(animal), time.perf_counter() - t0))
+    print(reports[reports['n_bad'] > 0].drop(columns = 'share').to_string())
+
+    try:
+        check(animal, animal_rules(), 'animal', fail_fast = True, out_dir = None)
+    except ValidationError as e:
+        print(e)
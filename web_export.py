@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Dashboard export
+
+A web map needs the county outlines once and the attributes of whichever month is shown.
+This writes
+
+    counties.geojson (or .topojson)   simplified, coordinate-rounded county layer with only
+                                      the county ID, county and province names
+    <variable>.bin                    one (month, county) array per variable, little-endian,
+                                      month-major so month t is one contiguous slice
+    manifest.json                     county ID order, months, and each variable's file, dtype and scale
+
+so switching months in the dashboard is reading n_counties values at offset t*n_counties
+from an already loaded array, never geometry again:
+
+    export_dashboard(iran_data, {'incidence': inc_arr, 'animal_inf_rate': ani_arr,
+                                 'lisa_class': lisa_class(lisa['q'], lisa['p_sim'])}, counties, months)
+
+Arrays come from county_month_array (rows by county_en or ADM2_PCODE). The layer is written as
+TopoJSON when the optional topojson package is installed, and as GeoJSON otherwise (or with fmt = 'geojson').
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+
+from county_month import key_to_period
+
+
+## Default output folder (relative to the working directory when the files are written)
+EXPORT_DIR = os.path.join('Data', 'web')
+
+## Attributes kept on the geometry; everything else goes in the side tables
+LAYER_COLUMNS = ['ADM2_PCODE', 'county_en', 'province_en']
+
+
+######### Functions #############
+def simplified_layer(gdf, id_col = 'ADM2_PCODE', tolerance = 0.005, precision = 4):
+    """
+    County layer for the web: WGS84, simplified by tolerance degrees (topology preserved)
+    and snapped to precision decimals, keeping only the ID and name columns.
+    """
+    import shapely
+    import geopandas as gpd
+
+    cols = [id_col] + [c for c in LAYER_COLUMNS if c in gdf.columns and c != id_col]
+    layer = gpd.GeoDataFrame(gdf[cols], geometry = gdf.geometry, crs = gdf.crs or 'EPSG:4326').to_crs('EPSG:4326')
+    geoms = layer.geometry.simplify(tolerance, preserve_topology = True)
+    layer['geometry'] = shapely.set_precision(geoms.values, 10.0**-precision)
+    return layer.rename(columns = {id_col: 'id'})
+
+
+def write_layer(layer, out_dir = EXPORT_DIR, fmt = None, quantization = 1e5):
+    """
+    Writes the layer as TopoJSON (shared borders stored once) or GeoJSON. fmt = None picks TopoJSON
+    when the topojson package is installed, GeoJSON otherwise. Returns the path written.
+    """
+    os.makedirs(out_dir, exist_ok = True)
+    if fmt is None:
+        try:
+            import topojson
+            fmt = 'topojson'
+        except ImportError:
+            fmt = 'geojson'
+
+    if fmt == 'topojson':
+        try:
+            import topojson
+        except ImportError:
+            print('topojson is not installed, writing GeoJSON instead')
+        else:
+            path = os.path.join(out_dir, 'counties.topojson')
+            topojson.Topology(layer, prequantize = quantization, toposimplify = False).to_json(path)
+            return path
+
+    path = os.path.join(out_dir, 'counties.geojson')
+    with open(path, 'w') as f:
+        f.write(layer.to_json(drop_id = True))
+    return path
+
+
+def _to_ids(arr, counties, ids, names = None):
+    """
+    Reorders array rows from counties (IDs or county_en names) to the layer's ID order, NaN for missing rows.
+    """
+    counties = pd.Index(counties)
+    if names is not None and not counties.isin(ids).all():
+        counties = pd.Index(pd.Series(names).reindex(counties).values)
+    pos = counties.get_indexer(ids)
+    arr = np.asarray(arr)
+    out = np.full((len(ids),) + arr.shape[1:], np.nan)
+    out[pos >= 0] = arr[pos[pos >= 0]]
+    return out
+
+
+def write_side_tables(arrays, counties, months, ids, out_dir = EXPORT_DIR, names = None):
+    """
+    Writes each (county, month) array as a month-major binary file in the ID order.
+    Rates and other floats are stored as float32; integer arrays (e.g. LISA classes) as int8
+    with -1 for missing. Returns the manifest entries.
+    """
+    os.makedirs(out_dir, exist_ok = True)
+    variables = {}
+    for name, arr in arrays.items():
+        arr = np.asarray(arr)
+        vals = _to_ids(arr, counties, ids, names)
+        if np.issubdtype(arr.dtype, np.integer):
+            data, dtype = np.where(np.isnan(vals), -1, vals).astype('<i1'), 'int8'
+        else:
+            data, dtype = vals.astype('<f4'), 'float32'
+
+        file = name + '.bin'
+        np.ascontiguousarray(data.T).tofile(os.path.join(out_dir, file))
+        finite = np.isfinite(vals)
+        variables[name] = {'file': file, 'dtype': dtype, 'shape': [len(months), len(ids)],
+                           'min': float(vals[finite].min()) if finite.any() else None,
+                           'max': float(vals[finite].max()) if finite.any() else None}
+    return variables
+
+
+def export_dashboard(iran_data, arrays, counties, months, out_dir = EXPORT_DIR, id_col = 'ADM2_PCODE', fmt = None,
+                     tolerance = 0.005, precision = 4):
+    """
+    Writes the simplified county layer, the side tables and the manifest. Returns the manifest.
+    """
+    layer = simplified_layer(iran_data, id_col, tolerance, precision)
+    ids = pd.Index(layer['id'])
+    names = pd.Series(layer['id'].values, index = layer['county_en'].values) if 'county_en' in layer else None
+
+    manifest = {'layer': os.path.basename(write_layer(layer, out_dir, fmt)),
+                'ids': list(ids),
+                'months': [str(p) for p in key_to_period(months)],
+                'variables': write_side_tables(arrays, counties, months, ids, out_dir, names)}
+    with open(os.path.join(out_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def read_month(out_dir, name, month, manifest = None):
+    """
+    One variable for one month (a 'YYYY-MM' string) as a Series indexed by county ID, read at its
+    offset in the binary file. This is what the dashboard does client-side.
+    """
+    if manifest is None:
+        with open(os.path.join(out_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+    var = manifest['variables'][name]
+    n = len(manifest['ids'])
+    t = manifest['months'].index(month)
+    dtype = np.dtype('<f4' if var['dtype'] == 'float32' else '<i1')
+    vals = np.fromfile(os.path.join(out_dir, var['file']), dtype = dtype, count = n, offset = t*n*dtype.itemsize)
+    return pd.Series(vals, index = manifest['ids'], name = name)
+
+
+#%%
+if __name__ == '__main__':
+
+    import tempfile
+    import geopandas as gpd
+    from shapely.geometry import box
+    from synthetic_data import grid_counties
+    from moran_permutation import moran_local
+    from map_render import lisa_class
+
+    side, n_months = 20, 24
+    ids = ['IR{:03d}'.format(i) for i in range(side*side)]
+    gdf = gpd.GeoDataFrame({'ADM2_PCODE': ids, 'county_en': ['c{:03d}'.format(i) for i in range(side*side)], 'province_en': 'p'},
+                           geometry = [box(44 + c*0.5, 39 - r*0.5, 44.5 + c*0.5, 39.5 - r*0.5) for r in range(side) for c in range(side)],
+                           crs = 'EPSG:4326')
+    rng = np.random.default_rng(0)
+    inc = rng.gamma(2, size = (side*side, n_months))
+    months = np.arange(2016*12, 2016*12 + n_months)
+    lisa = moran_local(inc, grid_counties(side*side), permutations = 99, workers = 1)
+
+    out_dir = tempfile.mkdtemp()
+    manifest = export_dashboard(gdf, {'incidence': inc, 'lisa_class': lisa_class(lisa['q'], lisa['p_sim'])},
+                                gdf['county_en'], months, out_dir)
+    print(sorted(os.listdir(out_dir)), {k: os.path.getsize(os.path.join(out_dir, k)) for k in os.listdir(out_dir)})
+
+    month = read_month(out_dir, 'incidence', '2016-05', manifest)
+    assert np.allclose(month.values, inc[:, 4].astype(np.float32))
+    print(read_month(out_dir, 'lisa_class', '2016-05', manifest).value_counts())